@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# Cost of validate_email(check_mx=True) once the MX lookup and the MX
+# check are cached: syntax check, known domain lookup and cache hits.  Also
+# counts how often pprint.pformat runs on that path, which should be never
+# while debug logging is off.
+#
+#     python benchmarks/bench_fast_path.py
+
+import os
+import pprint
+import shutil
+import sqlite3
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import validate_email as ve  # noqa: E402
+
+
+def known_domains(tmp):
+    path = os.path.join(tmp, 'known.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE connectionView (domain, server, username, password, ssl, port)')
+    conn.execute("INSERT INTO connectionView VALUES ('example.org', 'mx.example.org', NULL, NULL, 0, 25)")
+    conn.commit()
+    conn.close()
+    return ve.KnownDomains(path, check_interval=60)
+
+
+def main(number=100000):
+    tmp = tempfile.mkdtemp()
+    try:
+        known = known_domains(tmp)
+        ve.MX_CHECK_CACHE['mx.example.org'] = True
+
+        calls = []
+        pformat = pprint.pformat
+        pprint.pformat = lambda *args, **kwargs: calls.append(args) or pformat(*args, **kwargs)
+        try:
+            per_call = timeit.timeit(lambda: ve.validate_email('someone@example.org', check_mx=True, sql_conn=known),
+                                     number=number) / number
+        finally:
+            pprint.pformat = pformat
+        print('%-40s %10.2f us/call' % ('syntax + cached MX check', per_call * 1e6))
+        print('%-40s %10d' % ('pprint.pformat calls', len(calls)))
+
+        syntax = timeit.timeit(lambda: ve.validate_email('someone@example.org'), number=number) / number
+        print('%-40s %10.2f us/call' % ('syntax only', syntax * 1e6))
+        known.close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# Cold start cost: time to import validate_email in a fresh interpreter and
+# to run the first syntax check, which is what a short-lived process (a
+# serverless function, a CLI call) pays on every start.  Exits with status 1
+# when the median import time is over --budget milliseconds, or when the
+# import loaded one of the modules that are only needed for network checks.
+#
+#     python benchmarks/bench_import.py
+#     python benchmarks/bench_import.py --budget 30 --runs 20
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Only imported once a network check, a result store or a batch needs them.
+LAZY = ('smtplib', 'sqlite3', 'json', 'gzip', 'asyncio', 'dns', 'ssl', 'email')
+
+CHILD = '''
+import sys, time
+started = time.perf_counter()
+import validate_email
+imported = time.perf_counter()
+validate_email.is_valid_syntax('"quoted"@example.org')
+checked = time.perf_counter()
+loaded = [name for name in %r if name in sys.modules]
+import json
+print(json.dumps({"import": imported - started, "first_check": checked - imported, "loaded": loaded}))
+''' % (LAZY,)
+
+
+def run_once():
+    output = subprocess.check_output([sys.executable, '-c', CHILD], cwd=ROOT)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def median(values):
+    ordered = sorted(values)
+    return ordered[len(ordered) // 2]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure the import time of validate_email.')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budget', type=float, default=50.0, help='allowed median import time in ms')
+    args = parser.parse_args(argv)
+
+    run_once()  # Make sure the bytecode is cached.
+    runs = [run_once() for _ in range(args.runs)]
+    imports = [run["import"] * 1e3 for run in runs]
+    checks = [run["first_check"] * 1e3 for run in runs]
+    loaded = sorted(set(name for run in runs for name in run["loaded"]))
+
+    print('%-28s %8.2f ms (min %.2f, max %.2f)' % ('import validate_email', median(imports), min(imports),
+                                                   max(imports)))
+    print('%-28s %8.2f ms' % ('first is_valid_syntax()', median(checks)))
+    print('%-28s %8s' % ('budget', '%.2f ms' % args.budget))
+
+    status = 0
+    if median(imports) > args.budget:
+        print('over budget')
+        status = 1
+    if loaded:
+        print('loaded at import: %s' % ', '.join(loaded))
+        status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
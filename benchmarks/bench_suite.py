@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# Reproducible benchmarks of the hot paths, run offline against the stub
+# resolver and the fake SMTP server of fakes.py:
+#
+#   syntax        is_valid_syntax() over a mixed corpus
+#   screen        screen_emails() over columns of 10000 addresses
+#   mx_miss       get_mx_ip() for a domain not in MX_DNS_CACHE
+#   mx_hit        get_mx_ip() for a cached domain
+#   mx_memory     bytes of memory per domain in MX_DNS_CACHE
+#   sync          validate_email(verify=True), one address at a time
+#   batch         validate_emails() over chunks of --chunk addresses
+#   async         avalidate_email() with --concurrency checks in flight
+#
+# Each line gives the throughput and the p50/p99 latency of one operation
+# (an address, a lookup, a column or a validate_emails() call); mx_memory
+# gives bytes instead.  --save writes the numbers to a JSON baseline;
+# --compare reads one back and exits with status 1 when a benchmark got
+# slower, or mx_memory bigger, than --tolerance allows.
+#
+#     python benchmarks/bench_suite.py --save benchmarks/baseline.json
+#     python benchmarks/bench_suite.py --compare benchmarks/baseline.json
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import validate_email as ve  # noqa: E402
+from fakes import FakeSMTPServer, StubResolver  # noqa: E402
+
+CATCH_ALL_DOMAIN = 'catchall.bench'
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summary(samples, operations, elapsed):
+    return {"ops": operations, "ops_per_sec": operations / elapsed,
+            "p50_ms": percentile(samples, 0.5) * 1e3, "p99_ms": percentile(samples, 0.99) * 1e3}
+
+
+def timed(func, arguments):
+    samples = []
+    started = time.perf_counter()
+    for argument in arguments:
+        begin = time.perf_counter()
+        func(argument)
+        samples.append(time.perf_counter() - begin)
+    return summary(samples, len(samples), time.perf_counter() - started)
+
+
+def addresses(count, domains, seed, mix):
+    """Deterministic addresses spread over `domains`, their local parts
+    drawn from the weights in `mix`."""
+    rng = random.Random(seed)
+    kinds = [kind for kind, weight in mix for _ in range(weight)]
+    emails = []
+    for i in range(count):
+        domain = CATCH_ALL_DOMAIN if rng.random() < 0.05 else 'd%d.bench' % rng.randrange(domains)
+        emails.append('%s%d@%s' % (rng.choice(kinds), i, domain))
+    return emails
+
+
+def known_domains(tmp, port):
+    """Map the fake.bench provider, which every stub MX record points to, to the fake server."""
+    path = os.path.join(tmp, 'known.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE connectionView (domain, server, username, password, ssl, port)')
+    conn.execute("INSERT INTO connectionView VALUES ('fake.bench', '127.0.0.1', NULL, NULL, 0, ?)", (port,))
+    conn.commit()
+    conn.close()
+    return ve.KnownDomains(path, check_interval=60)
+
+
+def reset_caches():
+    ve.MX_DNS_CACHE.clear()
+    ve.MX_CHECK_CACHE.clear()
+    ve.CATCH_ALL_CACHE.clear()
+
+
+def bench_syntax(count, seed):
+    rng = random.Random(seed)
+    corpus = ['user%d@example%d.com' % (i, i % 100) for i in range(count // 2)]
+    corpus += ['"quoted %d"@example.com' % i for i in range(count // 8)]
+    corpus += ['first.last+tag%d@sub.example.co.uk' % i for i in range(count // 8)]
+    corpus += ['not an address %d' % i for i in range(count - len(corpus))]
+    rng.shuffle(corpus)
+    return timed(ve.is_valid_syntax, corpus)
+
+
+def bench_screen(count, domains, seed):
+    emails = addresses(count, domains, seed, [('ok', 1)])
+    emails += ['someone%d@yopmail.com' % i for i in range(count // 20)] + ['not an address'] * (count // 20)
+    random.Random(seed).shuffle(emails)
+    columns = [emails[i:i + 10000] for i in range(0, len(emails), 10000)]
+    result = timed(lambda column: ve.screen_emails(column, allow_disposable=False), columns)
+    elapsed = result["ops"] / result["ops_per_sec"]
+    result.update(ops=len(emails), ops_per_sec=len(emails) / elapsed)
+    return result
+
+
+def bench_mx(count, resolver):
+    reset_caches()
+    misses = timed(ve.get_mx_ip, ['miss%d.bench' % i for i in range(count)])
+    queries = resolver.queries
+    hits = timed(ve.get_mx_ip, ['miss%d.bench' % (i % 100) for i in range(count)])
+    assert resolver.queries == queries, 'cache hits went to the resolver'
+    return misses, hits
+
+
+def bench_memory(count, seed, resolver):
+    """Memory held per cached domain, 60% of the domains using the MX
+    servers of one of 20 providers and the others servers of their own."""
+    reset_caches()
+    rng = random.Random(seed)
+    providers = [[(10, 'mx1.provider%d.bench' % i), (20, 'mx2.provider%d.bench' % i)] for i in range(20)]
+    domains = ['mem%d.bench' % i for i in range(count)]
+    saved = resolver.records
+    resolver.records = dict((domain, rng.choice(providers) if rng.random() < 0.6 else
+                             [(10, 'mx1.' + domain), (20, 'mx2.' + domain)]) for domain in domains)
+    latency, resolver.latency = resolver.latency, 0
+    try:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for domain in domains:
+            ve.get_mx_ip(domain)
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+    finally:
+        resolver.records, resolver.latency = saved, latency
+    assert len(ve.MX_DNS_CACHE) == count, 'domains were evicted'
+    return {"ops": count, "bytes_per_domain": used / count}
+
+
+def bench_sync(emails, known, throttle, catch_all):
+    reset_caches()
+    return timed(lambda email: ve.validate_email(email, verify=True, sql_conn=known, throttle=throttle,
+                                                 detect_catch_all=catch_all), emails)
+
+
+def bench_batch(emails, known, throttle, catch_all, chunk):
+    reset_caches()
+    chunks = [emails[i:i + chunk] for i in range(0, len(emails), chunk)]
+    result = timed(lambda group: ve.validate_emails(group, sql_conn=known, throttle=throttle,
+                                                    detect_catch_all=catch_all), chunks)
+    elapsed = result["ops"] / result["ops_per_sec"]
+    result.update(ops=len(emails), ops_per_sec=len(emails) / elapsed)
+    return result
+
+
+def bench_async(emails, known, throttle, catch_all, concurrency, per_host):
+    reset_caches()
+
+    async def run():
+        limiter = ve.ConcurrencyLimiter(concurrency, per_host)
+        samples = []
+
+        async def one(email):
+            begin = time.perf_counter()
+            await ve.avalidate_email(email, verify=True, sql_conn=known, throttle=throttle, limiter=limiter,
+                                     detect_catch_all=catch_all)
+            samples.append(time.perf_counter() - begin)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[one(email) for email in emails])
+        return summary(samples, len(samples), time.perf_counter() - started)
+
+    return asyncio.run(run())
+
+
+def compare(results, baseline, tolerance):
+    """Print the change against the baseline; returns the regressed benchmarks."""
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get("results", {}).get(name)
+        if old is None:
+            continue
+        if "bytes_per_domain" in result:
+            growth = result["bytes_per_domain"] / old["bytes_per_domain"] - 1
+            flag = ''
+            if growth > tolerance:
+                regressions.append(name)
+                flag = '  REGRESSION'
+            print('%-10s bytes/domain %+7.1f%%%s' % (name, growth * 100, flag))
+            continue
+        speed = result["ops_per_sec"] / old["ops_per_sec"] - 1
+        tail = result["p99_ms"] / old["p99_ms"] - 1 if old["p99_ms"] else 0.0
+        flag = ''
+        if speed < -tolerance or tail > tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-10s throughput %+7.1f%%   p99 %+7.1f%%%s' % (name, speed * 100, tail * 100, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark validate_email offline.')
+    parser.add_argument('--only', nargs='*', help='benchmarks to run (default: all)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--syntax', type=int, default=100000, help='addresses for the syntax benchmark')
+    parser.add_argument('--screen', type=int, default=100000, help='addresses for the screen benchmark')
+    parser.add_argument('--lookups', type=int, default=20000, help='lookups for the MX cache benchmarks')
+    parser.add_argument('--cached', type=int, default=50000, help='domains cached by the mx_memory benchmark')
+    parser.add_argument('--sync', type=int, default=300, help='addresses for the sync benchmark')
+    parser.add_argument('--addresses', type=int, default=3000, help='addresses for the batch and async benchmarks')
+    parser.add_argument('--domains', type=int, default=50)
+    parser.add_argument('--chunk', type=int, default=100, help='addresses per validate_emails() call')
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--per-host', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.001, help='seconds per SMTP round trip')
+    parser.add_argument('--dns-latency', type=float, default=0.0005, help='seconds per stub DNS query')
+    parser.add_argument('--greylist', type=int, default=5, help='percentage of greylisted addresses')
+    parser.add_argument('--drop', type=int, default=0, help='percentage of addresses the server hangs up on')
+    parser.add_argument('--catch-all', action='store_true', help='detect catch-all domains')
+    parser.add_argument('--no-pipelining', action='store_true', help="don't offer PIPELINING")
+    parser.add_argument('--save', help='write the results to this JSON baseline')
+    parser.add_argument('--compare', help='compare with this JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before failing')
+    args = parser.parse_args(argv)
+    selected = set(args.only or ['syntax', 'screen', 'mx_miss', 'mx_hit', 'mx_memory', 'sync', 'batch', 'async'])
+
+    mix = [('ok', 70), ('no', 25 - args.drop), ('grey', args.greylist), ('drop', args.drop)]
+    mix = [(kind, weight) for kind, weight in mix if weight > 0]
+    emails = addresses(args.addresses, args.domains, args.seed, mix)
+    throttle = ve.MXThrottle(rate=1e9, burst=1e9, failure_threshold=10 ** 9)
+    resolver = StubResolver(default=[(10, 'mx1.fake.bench'), (20, 'mx2.fake.bench')],
+                            latency=args.dns_latency).install()
+    tmp = tempfile.mkdtemp()
+    results = {}
+    try:
+        if 'syntax' in selected:
+            results['syntax'] = bench_syntax(args.syntax, args.seed)
+        if 'screen' in selected:
+            results['screen'] = bench_screen(args.screen, args.domains, args.seed)
+        if selected & set(['mx_miss', 'mx_hit']):
+            misses, hits = bench_mx(args.lookups, resolver)
+            if 'mx_miss' in selected:
+                results['mx_miss'] = misses
+            if 'mx_hit' in selected:
+                results['mx_hit'] = hits
+        if 'mx_memory' in selected:
+            results['mx_memory'] = bench_memory(args.cached, args.seed, resolver)
+        with FakeSMTPServer(latency=args.latency, catch_all=[CATCH_ALL_DOMAIN],
+                            pipelining=not args.no_pipelining) as server:
+            known = known_domains(tmp, server.port)
+            if 'sync' in selected:
+                results['sync'] = bench_sync(emails[:args.sync], known, throttle, args.catch_all)
+            if 'batch' in selected:
+                results['batch'] = bench_batch(emails, known, throttle, args.catch_all, args.chunk)
+            if 'async' in selected:
+                results['async'] = bench_async(emails, known, throttle, args.catch_all, args.concurrency,
+                                               args.per_host)
+            known.close()
+    finally:
+        resolver.uninstall()
+        shutil.rmtree(tmp)
+
+    print('%-10s %10s %14s %10s %10s' % ('benchmark', 'ops', 'ops/s', 'p50 ms', 'p99 ms'))
+    for name, result in results.items():
+        if "bytes_per_domain" in result:
+            print('%-10s %10d %14s %10.1f bytes per cached domain' % (name, result["ops"], '',
+                                                                      result["bytes_per_domain"]))
+            continue
+        print('%-10s %10d %14.1f %10.3f %10.3f' % (name, result["ops"], result["ops_per_sec"],
+                                                  result["p50_ms"], result["p99_ms"]))
+
+    status = 0
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.tolerance):
+                status = 1
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                       "options": vars(args), "results": results}, f, indent=2, sort_keys=True)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# Syntax stage benchmark: throughput on typical signup addresses and
+# worst case timings on inputs built to make a backtracking regexp blow up.
+#
+#     python benchmarks/bench_syntax.py
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from validate_email import VALID_ADDRESS_REGEXP, is_valid_syntax  # noqa: E402
+
+TYPICAL = [
+    'someone@gmail.com',
+    'some.one+tag@example.co.uk',
+    'first.last@sub.domain.example.org',
+    'not an address',
+    'someone@',
+    '"quoted local"@example.com',
+    'user@[192.168.0.1]',
+    u'用户@例子.广告',
+]
+
+HOSTILE = {
+    'quoted string of folded white space': lambda n: '"' + '\r\n a' * n,
+    'comment of folded white space': lambda n: '(' + '\r\n a' * n,
+    'folded white space runs': lambda n: '\r\n ' * n + '!',
+    'comments and white space': lambda n: '(a)\r\n ' * n + '!',
+    'trailing comment': lambda n: 'a@b' + ' ' * n + '(',
+}
+
+
+def throughput(number=200000):
+    per_call = timeit.timeit(lambda: [is_valid_syntax(email) for email in TYPICAL],
+                             number=number // len(TYPICAL)) / (number // len(TYPICAL) * len(TYPICAL))
+    print('%-40s %12.0f addresses/s' % ('is_valid_syntax (mixed input)', 1 / per_call))
+    fast = timeit.timeit(lambda: is_valid_syntax('some.one+tag@example.co.uk'), number=number) / number
+    print('%-40s %12.0f addresses/s' % ('is_valid_syntax (dot-atom)', 1 / fast))
+    regexp = timeit.timeit(lambda: re.match(VALID_ADDRESS_REGEXP, 'some.one+tag@example.co.uk'),
+                           number=number) / number
+    print('%-40s %12.0f addresses/s' % ('re.match(VALID_ADDRESS_REGEXP)', 1 / regexp))
+
+
+def worst_case(sizes=(1000, 2000, 4000, 8000)):
+    for name, build in sorted(HOSTILE.items()):
+        timings = []
+        for n in sizes:
+            email = build(n)
+            timings.append(min(timeit.repeat(lambda: is_valid_syntax(email), number=1, repeat=3)))
+        print('%-40s %s' % (name, '  '.join('n=%d %.2fms' % (n, t * 1000) for n, t in zip(sizes, timings))))
+
+
+if __name__ == '__main__':
+    throughput()
+    worst_case()
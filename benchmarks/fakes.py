@@ -0,0 +1,153 @@
+"""Local stand-ins for DNS and SMTP used by the benchmarks, so they run
+offline and give the same numbers from one run to the next.
+
+StubResolver is a validate_email.Resolver answering MX queries from a
+table after a fixed latency, so no DNS traffic (nor dnspython) is needed.
+install() makes it the module's RESOLVER; a Validator can also be given
+one.
+
+FakeSMTPServer is an asyncio SMTP server running in a thread of its own.
+What it answers to RCPT TO depends on the local part: 'ok...' addresses
+exist, 'grey...' ones are greylisted (450), 'drop...' ones make the server
+hang up, and everything else is rejected (550).  Domains listed in
+`catch_all` accept every address.  It offers PIPELINING unless told not
+to, and `latency` seconds pass before each batch of replies, once per
+round trip: commands sent together get their replies together.
+"""
+
+import asyncio
+import threading
+import time
+
+import validate_email as ve
+
+
+class StubResolver(ve.Resolver):
+    """MX answers from `records` ({domain: [(preference, exchange)]}); other
+    domains get `default` when given and NXDOMAIN otherwise."""
+
+    def __init__(self, records=None, default=None, latency=0.0, ttl=3600):
+        self.records = dict(records or {})
+        self.default = default
+        self.latency = latency
+        self.ttl = ttl
+        self.queries = 0
+        self._previous = None
+
+    def _answer(self, hostname):
+        self.queries += 1
+        records = self.records.get(hostname, self.default)
+        if records is None:
+            raise ve.NoSuchDomain(hostname)
+        return ve.MXAnswer(list(records), self.ttl)
+
+    def mx(self, hostname):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._answer(hostname)
+
+    async def amx(self, hostname):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._answer(hostname)
+
+    def install(self):
+        """Make this the resolver of the calls made outside of a Validator."""
+        self._previous, ve.RESOLVER = ve.RESOLVER, self
+        return self
+
+    def uninstall(self):
+        if self._previous is not None:
+            ve.RESOLVER, self._previous = self._previous, None
+
+
+class FakeSMTPServer(object):
+    """Asyncio SMTP server on 127.0.0.1, started and stopped as a context
+    manager.  Counts connections and RCPT TO commands."""
+
+    def __init__(self, latency=0.0, catch_all=(), pipelining=True):
+        self.latency = latency
+        self.catch_all = set(catch_all)
+        self.pipelining = pipelining
+        self.connections = 0
+        self.rcpts = 0
+        self.port = None
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, '127.0.0.1', 0))
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run)
+        self._thread.daemon = True
+        self._thread.start()
+        started.wait()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def rcpt_reply(self, address):
+        local, _, domain = address.partition('@')
+        if domain in self.catch_all or local.startswith('ok'):
+            return b'250 OK'
+        if local.startswith('grey'):
+            return b'450 Greylisted, try again later'
+        if local.startswith('drop'):
+            return None
+        return b'550 No such user'
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+
+        replies = []
+
+        async def send(*lines):
+            replies.extend(lines)
+            if getattr(reader, '_buffer', None):  # More pipelined commands to answer first.
+                return
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            writer.write(b''.join(line + b'\r\n' for line in replies))
+            del replies[:]
+            await writer.drain()
+
+        try:
+            await send(b'220 fake.bench ESMTP')
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                verb = line[:4].upper()
+                if verb == b'RCPT':
+                    self.rcpts += 1
+                    reply = self.rcpt_reply(line[line.index(b'<') + 1:line.rindex(b'>')].decode('utf-8'))
+                    if reply is None:
+                        break
+                    await send(reply)
+                elif verb == b'EHLO':
+                    extensions = [b'250-PIPELINING'] if self.pipelining else []
+                    await send(b'250-fake.bench', *(extensions + [b'250 AUTH PLAIN LOGIN']))
+                elif verb == b'AUTH':
+                    await send(b'235 Authentication successful')
+                elif verb == b'QUIT':
+                    await send(b'221 Bye')
+                    break
+                else:
+                    await send(b'250 OK')
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
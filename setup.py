@@ -11,4 +11,10 @@ setup(
     keywords='email validation verification mx verify',
     url='https://github.com/wtayyeb/validate_email',
     license='LGPL',
+    python_requires='>=3.8',
+    classifiers=[
+        'License :: OSI Approved :: GNU Lesser General Public License v3 (LGPLv3)',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+    ],
 )
@@ -1,7 +1,141 @@
 # encoding: utf-8
+import asyncio
+import functools
+import gzip
+import io
+import itertools
+import json
+import os
+import re
+import shutil
+import smtplib
+import socket
+import socketserver
+import subprocess
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import types
 import unittest
+from collections import OrderedDict
+from unittest import mock
+
+import validate_email as ve
+from validate_email import avalidate_email, avalidate_many, validate_email, validate_emails
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """Minimal SMTP server on localhost that accepts RCPT TO only for the
+    local parts in `mailboxes` (or any with catch_all), greylists those in
+    `greylisted`, and counts connections and commands.  PIPELINING is
+    offered unless `pipelining` is false, on `host`.  `replies` maps a verb to the
+    reply it gets instead: None drops the connection and '' leaves the rest
+    of the session unanswered.  AUTH is refused until EHLO was sent."""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, mailboxes=(), greylisted=(), catch_all=False, pipelining=True, replies=None,
+                 host='127.0.0.1'):
+        socketserver.ThreadingTCPServer.__init__(self, (host, 0), FakeSMTPHandler)
+        self.mailboxes = set(mailboxes)
+        self.greylisted = set(greylisted)
+        self.catch_all = catch_all
+        self.pipelining = pipelining
+        self.replies = dict(replies or {})
+        self.connections = 0
+        self.active = 0
+        self.max_active = 0
+        self.commands = []
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, verb):
+        return len([command for command in self.commands if command.upper().startswith(verb)])
+
+    def rcpt_reply(self, address):
+        if address.split('@')[0] in self.greylisted:
+            return '450 Greylisted, try again later'
+        if self.catch_all or address.split('@')[0] in self.mailboxes:
+            return '250 OK'
+        return '550 No such user'
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+
+    def send(self, line):
+        self.wfile.write((line + '\r\n').encode('utf-8'))
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            self.dialogue(server)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def dialogue(self, server):
+        self.send('220 fake.example.com ESMTP')
+        greeted = False
+        for raw in self.rfile:
+            line = raw.decode('utf-8').strip()
+            with server.lock:
+                server.commands.append(line)
+            verb = line.split(' ', 1)[0].upper()
+            if verb in server.replies:
+                reply = server.replies[verb]
+                if reply is None:
+                    return
+                if not reply:
+                    for raw in self.rfile:
+                        pass
+                    return
+                self.send(reply)
+            elif verb == 'RCPT':
+                self.send(server.rcpt_reply(line[line.index('<') + 1:line.rindex('>')]))
+            elif verb == 'EHLO':
+                greeted = True
+                self.send('250-fake.example.com')
+                if server.pipelining:
+                    self.send('250-PIPELINING')
+                self.send('250 AUTH PLAIN LOGIN')
+            elif verb == 'AUTH' and not greeted:
+                self.send('503 Send EHLO first')
+            elif verb == 'AUTH':
+                self.send('235 Authentication successful')
+            elif verb == 'QUIT':
+                self.send('221 Bye')
+                return
+            else:
+                self.send('250 OK')
+
+
+def known_domain_db(port, domain='example.com', username=None, password=None):
+    """Route `domain` to the fake SMTP server through the known domain view."""
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE connectionView (domain, server, username, password, ssl, port)')
+    conn.execute('INSERT INTO connectionView VALUES (?, ?, ?, ?, 0, ?)',
+                 (domain, '127.0.0.1', username, password, port))
+    return conn
 
-from validate_email import validate_email
 
 class AddressPatternTests(unittest.TestCase):
     
@@ -56,4 +190,1259 @@ class AddressPatternTests(unittest.TestCase):
         self.assertFalse(validate_email(r'DörteSörensen.example.com')) # No @
         self.assertFalse(validate_email(r'Dörte@Sörensenexamplecom')) # No .
         self.assertFalse(validate_email(r'Dörte@Sörensen.')) # Nothing after the .
-        self.assertFalse(validate_email(r'@Sörensen.example.com')) # Nothing before the @
\ No newline at end of file
+        self.assertFalse(validate_email(r'@Sörensen.example.com')) # Nothing before the @
+
+
+class SyntaxCheckerTests(unittest.TestCase):
+
+    def test_matches_rfc_regexp(self):
+        pattern = re.compile(ve.VALID_ADDRESS_REGEXP)
+        alphabet = ['a', '.', '@', '"', '(', ')', '[', ']', '\\', ' ', '\r\n', '\x0b', u'é']
+        for length in range(6):
+            for chars in itertools.product(alphabet, repeat=length):
+                email = ''.join(chars)
+                self.assertEqual(ve.is_valid_syntax(email), pattern.match(email) is not None, repr(email))
+
+    def test_no_catastrophic_backtracking(self):
+        for email in ['"' + '\r\n a' * 5000, '(' + '\r\n a' * 5000, '\r\n ' * 5000 + '!']:
+            start = time.time()
+            self.assertFalse(ve.is_valid_syntax(email))
+            self.assertLess(time.time() - start, 1)
+
+    def test_pluggable_checker(self):
+        self.assertFalse(validate_email('someone@gmail.com', syntax_checker=lambda email: False))
+        self.assertTrue(validate_email('someone', syntax_checker=lambda email: True))
+
+
+class DisposableTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_builtin_list(self):
+        self.assertTrue(ve.is_disposable('someone@yopmail.com'))
+        self.assertTrue(ve.is_disposable('someone@x.Mailinator.com'))
+        self.assertFalse(ve.is_disposable('someone@gmail.com'))
+        self.assertFalse(validate_email('disposable@yopmail.com', allow_disposable=False))
+        self.assertTrue(validate_email('someone@gmail.com', allow_disposable=False))
+
+    def test_public_suffixes_are_matched_exactly(self):
+        for email in ['shop@mercadolibre.com.ar', 'prof@nus.edu.sg', 'x@um.edu.my', 'x@company.org.ua',
+                      'x@kyiv.pp.ua', 'x@mail.id.au', 'x@site.nom.za', 'x@host.us.to', 'x@a.cu.cc']:
+            self.assertFalse(ve.is_disposable(email), email)
+        self.assertTrue(ve.is_disposable('x@jetable.pp.ua'))
+
+    def test_public_suffixes_are_not_loaded(self):
+        index = ve.DisposableIndex(['pp.ua', 'jetable.pp.ua'])
+        self.assertEqual(len(index), 1)
+        self.assertTrue(ve.is_disposable('x@jetable.pp.ua', index))
+        self.assertFalse(ve.is_disposable('x@kyiv.pp.ua', index))
+
+    def test_spellings_agree_with_screening(self):
+        index = ve.DisposableIndex(['xn--bcher-kva.test', 'yopmail.com'])
+        emails = [u'a@bücher.test', u'b@BÜCHER.test', 'c@xn--bcher-kva.test', 'd@YopMail.COM', 'e@example.org']
+        flags = [ve.is_disposable(email, index) for email in emails]
+        self.assertEqual(flags, [True] * 4 + [False])
+        codes = ve.screen_emails(emails, allow_disposable=False, index=index)
+        self.assertEqual([code == ve.SCREEN_DISPOSABLE for code in codes], flags)
+
+    def test_reloads_changed_file(self):
+        path = os.path.join(self.tmp, 'domains.txt')
+        with open(path, 'w') as f:
+            f.write('# comment\nthrowaway.test\n')
+        index = ve.DisposableIndex(path=path, check_interval=0)
+        self.assertTrue(ve.is_disposable('a@mx.throwaway.test', index))
+        self.assertFalse(ve.is_disposable('a@burner.test', index))
+
+        with open(path, 'w') as f:
+            f.write('burner.test\n')
+        os.utime(path, (0, 0))
+        self.assertTrue(ve.is_disposable('a@burner.test', index))
+        self.assertFalse(ve.is_disposable('a@throwaway.test', index))
+
+    def test_compressed_file(self):
+        path = os.path.join(self.tmp, 'domains.txt.gz')
+        with gzip.open(path, 'wt') as f:
+            f.write('throwaway.test\n')
+        self.assertEqual(len(ve.DisposableIndex(path=path)), 1)
+
+
+class MXCacheTests(unittest.TestCase):
+
+    def test_ttls(self):
+        cache = ve.MXCache(min_ttl=60, max_ttl=600, negative_ttl=120, failure_ttl=5)
+        with mock.patch('validate_email.time.time', return_value=1000):
+            cache.set('short.test', {'mx.short.test': {}}, 1)
+            cache.set('long.test', {'mx.long.test': {}}, 10 ** 6)
+            cache.set('missing.test', None)
+            cache.set('failing.test', False)
+        with mock.patch('validate_email.time.time', return_value=1059):
+            self.assertEqual(cache.get('short.test'), {'mx.short.test': {}})
+            self.assertIs(cache.get('missing.test', False), None)
+            self.assertNotIn('failing.test', cache)
+        with mock.patch('validate_email.time.time', return_value=1599):
+            self.assertIs(cache.get('short.test', False), False)
+            self.assertIn('long.test', cache)
+        with mock.patch('validate_email.time.time', return_value=1600):
+            self.assertNotIn('long.test', cache)
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_lru_eviction(self):
+        cache = ve.MXCache(max_size=2)
+        cache['a.test'] = {}
+        cache['b.test'] = {}
+        cache.get('a.test')
+        cache['c.test'] = {}
+        self.assertEqual(sorted(cache._entries), ['a.test', 'c.test'])
+        self.assertEqual(cache.stats(), {'size': 2, 'hits': 1, 'misses': 0, 'evictions': 1, 'expirations': 0})
+
+    def test_compact_records(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            store = ve.ResultStore(os.path.join(tmp, 'results.db'))
+            resolver = ve.StaticResolver({'a.test': [(20, 'MX2.shared.test.'), (10, 'mx1.shared.test')],
+                                          'b.test': [(10, 'mx1.shared.test')]})
+            validator = ve.Validator(resolver=resolver)
+            a = validator._run(ve.get_mx_ip, 'a.test', result_store=store)
+            b = validator._run(ve.get_mx_ip, 'b.test')
+            self.assertEqual(a, {'mx1.shared.test': dict(ve.DEFAULT_MX_OPTIONS), 'mx2.shared.test': {
+                'domain': None, 'username': None, 'password': None, 'is_ssl': 0, 'port': 25}})
+            self.assertEqual(list(a), ['mx1.shared.test', 'mx2.shared.test'])
+            self.assertIs(a['mx2.shared.test'], b['mx1.shared.test'])
+            self.assertIs(list(a)[0], list(b)[0])
+            self.assertEqual((a['mx1.shared.test']['port'], a['mx1.shared.test'].get('rate')), (25, None))
+
+            stored = ve._stored_mx_ip('a.test', store)
+            self.assertIsInstance(stored, ve.MXHosts)
+            self.assertEqual(stored, a)
+            self.assertIs(stored.options, ve.DEFAULT_MX_OPTIONS)
+        finally:
+            shutil.rmtree(tmp)
+        known = ve._known_domain_options(('k.test', 'smtp.k.test', 'me', 'secret', 1, 465, 5, 10))
+        self.assertEqual(dict(known['smtp.k.test']), {'domain': 'k.test', 'username': 'me', 'password': 'secret',
+                                                      'is_ssl': 1, 'port': 465, 'rate': 5, 'burst': 10})
+
+    def test_normalize_domain(self):
+        self.assertEqual(ve.normalize_domain('Gmail.COM.'), 'gmail.com')
+        self.assertEqual(ve.normalize_domain(u'Sörensen.example.com'), 'xn--srensen-90a.example.com')
+        self.assertEqual(ve.normalize_domain(u'例子.广告'), 'xn--fsqu00a.xn--4rr70v')
+        self.assertEqual(ve.normalize_domain(u'bad\u200d' + 'x' * 70 + '.test'), u'bad\u200d' + 'x' * 70 + '.test')
+
+    def test_spellings_share_entries(self):
+        ve.MX_DNS_CACHE.set('example.org', {'mx.example.org': {'port': 25}}, 60)
+        try:
+            for hostname in ('example.org', 'Example.ORG', 'example.org.'):
+                self.assertEqual(ve.get_mx_ip(hostname), {'mx.example.org': {'port': 25}})
+            self.assertNotIn('Example.ORG', ve.MX_DNS_CACHE)
+        finally:
+            ve.MX_DNS_CACHE.clear()
+        with FakeSMTPServer(mailboxes=['alice']) as server:
+            db = known_domain_db(server.port, domain='example.org')
+            self.assertTrue(validate_email('alice@Example.Org', verify=True, sql_conn=db))
+            self.assertEqual(validate_emails(['alice@EXAMPLE.org', 'bob@example.org'], sql_conn=db),
+                             {'alice@EXAMPLE.org': True, 'bob@example.org': False})
+
+
+class ResolverTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.zone = os.path.join(self.tmp, 'mx.zone')
+        with open(self.zone, 'w') as f:
+            f.write('$TTL 600\n'
+                    '; offline MX records\n'
+                    'a.test.  IN MX 20 mx2.fake.test.\n'
+                    'A.test.  300 IN MX 10 mx1.fake.test.  ; preferred\n'
+                    'b.test   MX 10 mx.b.test\n'
+                    'b.test.  IN A 127.0.0.1\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_static_zone_file(self):
+        resolver = ve.StaticResolver({'c.test': [(10, 'mx.c.test')]}, path=self.zone)
+        self.assertEqual(resolver.mx('a.test'), ve.MXAnswer([(20, 'mx2.fake.test'), (10, 'mx1.fake.test')], 300))
+        self.assertEqual(resolver.mx('B.test.'), ve.MXAnswer([(10, 'mx.b.test')], 600))
+        self.assertEqual(asyncio.run(resolver.amx('c.test')), ve.MXAnswer([(10, 'mx.c.test')], 3600))
+        self.assertRaises(ve.NoSuchDomain, resolver.mx, 'd.test')
+
+    def test_validator_resolver(self):
+        validator = ve.Validator(verify=True, resolver=ve.StaticResolver(path=self.zone))
+        with FakeSMTPServer(mailboxes=['alice']) as server:
+            db = known_domain_db(server.port, domain='fake.test')
+            self.assertTrue(validator.validate('alice@a.test', sql_conn=db))
+            self.assertFalse(validator.validate('alice@d.test', sql_conn=db))
+            self.assertTrue(asyncio.run(validator.avalidate('alice@a.test', sql_conn=db)))
+        self.assertIs(validator.mx_cache.get('d.test', ve._MISSING), None)
+        self.assertNotIn('a.test', ve.MX_DNS_CACHE)
+
+    def dnspython_stub(self, error):
+        """(dns.resolver, dns.exception) stand-ins whose lookups raise `error`."""
+        exception = types.SimpleNamespace(DNSException=type('DNSException', (Exception,), {}))
+        exception.Timeout = type('Timeout', (exception.DNSException,), {})
+        resolver = types.SimpleNamespace(**{name: type(name, (exception.DNSException,), {})
+                                            for name in ('NXDOMAIN', 'NoAnswer', 'NoNameservers', 'YXDOMAIN')})
+
+        def resolve(hostname, rdtype, tcp=False):
+            raise getattr(resolver, error, None) or getattr(exception, error)()
+
+        resolver.resolve = resolve
+        return resolver, exception
+
+    def test_dnspython_errors(self):
+        for error, expected, verdict in [('NXDOMAIN', ve.NoSuchDomain, False), ('NoAnswer', ve.NoSuchDomain, False),
+                                         ('NoNameservers', ve.DNSFailure, None), ('Timeout', ve.DNSFailure, None),
+                                         ('YXDOMAIN', ve.DNSFailure, None)]:
+            with mock.patch.object(ve, '_DNS', self.dnspython_stub(error)):
+                resolver = ve.DNSPythonResolver()
+                self.assertRaises(expected, resolver.mx, 'nomx.test')
+                validator = ve.Validator(check_mx=True, resolver=resolver)
+                self.assertIs(validator.validate('alice@nomx.test'), verdict, error)
+                self.assertEqual(validator.validate_many(['alice@nomx.test']), {'alice@nomx.test': verdict})
+
+
+class ResultStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'results.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_shared_between_stores(self):
+        writer = ve.ResultStore(self.path, verdict_ttls={None: 0})
+        reader = ve.ResultStore(self.path)
+        writer.set('mx', 'example.com', {'mx.example.com': {'port': 25}})
+        writer.set('verdict', 'alice@example.com', False)
+        writer.set('verdict', 'bob@example.com', None)
+        self.assertEqual(reader.get('mx', 'example.com'), {'mx.example.com': {'port': 25}})
+        self.assertIs(reader.get('verdict', 'alice@example.com', ve._MISSING), False)
+        self.assertIs(reader.get('verdict', 'bob@example.com', ve._MISSING), ve._MISSING)
+        self.assertEqual(reader._conn().execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+    def test_verdicts_skip_the_network(self):
+        store = ve.ResultStore(self.path)
+        with FakeSMTPServer(mailboxes=['alice']) as server:
+            db = known_domain_db(server.port)
+            self.assertTrue(validate_email('alice@example.com', verify=True, sql_conn=db, result_store=store))
+            self.assertEqual(validate_emails(['alice@example.com', 'mallory@example.com'], sql_conn=db,
+                                             result_store=store),
+                             {'alice@example.com': True, 'mallory@example.com': False})
+        self.assertEqual(server.connections, 2)
+        self.assertEqual(server.count('RCPT'), 2)
+        self.assertFalse(validate_email('mallory@example.com', verify=True, sql_conn=db,
+                                        result_store=ve.ResultStore(self.path)))
+
+
+class ScreenTests(unittest.TestCase):
+
+    def test_reason_codes(self):
+        index = ve.DisposableIndex(['yopmail.com'])
+        emails = ['alice@example.org', 'not an address', None, 'bob@yopmail.com', 'carol@known.test',
+                  '"quoted"@example.org']
+        codes = ve.screen_emails(emails, allow_disposable=False, sql_conn=known_domain_db(25, domain='known.test'),
+                                 index=index)
+        self.assertEqual(codes.typecode, 'B')
+        self.assertEqual(list(codes), [ve.SCREEN_OK, ve.SCREEN_INVALID, ve.SCREEN_INVALID, ve.SCREEN_DISPOSABLE,
+                                       ve.SCREEN_KNOWN, ve.SCREEN_OK])
+        self.assertEqual(list(ve.screen_emails(emails, index=index))[3], ve.SCREEN_OK)
+
+    def test_one_lookup_per_domain(self):
+        class Column(object):
+            def tolist(self):
+                return ['user%d@%s' % (i, domain) for i, domain in enumerate(['a.test', 'b.test'] * 50)]
+
+        with mock.patch('validate_email.get_known_domain', return_value=None) as lookup:
+            codes = ve.screen_emails(Column(), allow_disposable=False, sql_conn=object())
+        self.assertEqual(list(codes), [ve.SCREEN_OK] * 100)
+        self.assertEqual(sorted(call[0][0] for call in lookup.call_args_list), ['a.test', 'b.test'])
+
+    def test_domain_spellings_share_a_lookup(self):
+        emails = ['a@known.test', 'b@Known.Test', 'c@KNOWN.test', u'd@bücher.test', 'e@xn--bcher-kva.test',
+                  u'f@BÜCHER.test', 'g@YopMail.com', 'h@yopmail.COM']
+        with mock.patch('validate_email.get_known_domain',
+                        side_effect=lambda domain, *args: domain == 'known.test') as lookup:
+            codes = ve.screen_emails(emails, allow_disposable=False, sql_conn=object(),
+                                     index=ve.DisposableIndex(['yopmail.com']))
+        self.assertEqual(list(codes), [ve.SCREEN_KNOWN] * 3 + [ve.SCREEN_OK] * 3 + [ve.SCREEN_DISPOSABLE] * 2)
+        self.assertEqual(sorted(call[0][0] for call in lookup.call_args_list), ['known.test', 'xn--bcher-kva.test'])
+
+
+class BulkValidationTests(unittest.TestCase):
+
+    def test_one_session_for_many_recipients(self):
+        with FakeSMTPServer(mailboxes=['alice', 'bob', 'carol']) as server:
+            emails = ['alice@example.com', 'bob@example.com', 'mallory@example.com',
+                      'carol@example.com', 'not an address', 'alice@example.com']
+            results = validate_emails(emails, sql_conn=known_domain_db(server.port), batch_size=2)
+
+        self.assertEqual(list(results), emails[:5])
+        self.assertEqual(results, {
+            'alice@example.com': True,
+            'bob@example.com': True,
+            'mallory@example.com': False,
+            'carol@example.com': True,
+            'not an address': False,
+        })
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(server.count('RCPT'), 4)
+        self.assertEqual(server.count('MAIL'), 2)
+        self.assertEqual(server.count('RSET'), 1)
+
+    def test_unreachable_server(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        results = validate_emails(['alice@example.com'], sql_conn=known_domain_db(port), smtp_timeout=1)
+        self.assertEqual(results, {'alice@example.com': None})
+
+    def test_as_completed(self):
+        with FakeSMTPServer(mailboxes=['alice']) as first, FakeSMTPServer(mailboxes=['bob']) as second:
+            db = known_domain_db(first.port, domain='a.test')
+            db.execute("INSERT INTO connectionView VALUES ('b.test', 'localhost', NULL, NULL, 0, ?)", (second.port,))
+            emails = ['alice@a.test', 'bob@b.test', 'nope', 'carol@a.test', 'alice@a.test', 'dave@b.test']
+            pairs = list(ve.validate_emails_as_completed(emails, sql_conn=db))
+        self.assertEqual(pairs[0], ('nope', False))
+        self.assertEqual(dict(pairs), {'alice@a.test': True, 'bob@b.test': True, 'nope': False,
+                                       'carol@a.test': False, 'dave@b.test': False})
+        self.assertEqual(len(pairs), 5)
+        self.assertEqual((first.connections, second.connections), (1, 1))
+
+    def test_resolves_each_domain_once(self):
+        calls = []
+        active = [0, 0]
+
+        async def aget_mx_ip(hostname, *args):
+            calls.append(hostname)
+            active[0] += 1
+            active[1] = max(active)
+            await asyncio.sleep(0.01)
+            active[0] -= 1
+            return None
+
+        emails = ['user%d@%s.test' % (i, 'abcd'[i % 4]) for i in range(12)] + ['user0@A.test']
+        with mock.patch('validate_email.aget_mx_ip', aget_mx_ip):
+            results = validate_emails(emails, concurrency=3)
+        self.assertEqual(sorted(calls), ['a.test', 'b.test', 'c.test', 'd.test'])
+        self.assertEqual(active[1], 3)
+        self.assertEqual(set(results.values()), set([False]))
+
+    def test_failing_lookup_spares_other_domains(self):
+        class Resolver(ve.StaticResolver):
+            def mx(self, hostname):
+                if hostname == 'bad.test':
+                    raise UnicodeError('label too long')
+                return ve.StaticResolver.mx(self, hostname)
+
+        resolver = Resolver({'a.test': [(10, 'mx.fake.test')], 'b.test': [(10, 'mx.fake.test')]})
+        emails = ['alice@a.test', 'alice@bad.test', 'bob@b.test', 'carol@c.test']
+        with FakeSMTPServer(mailboxes=['alice', 'bob']) as server:
+            db = known_domain_db(server.port, domain='fake.test')
+            for concurrency in (1, 8):
+                validator = ve.Validator(verify=True, resolver=resolver)
+                self.assertEqual(validator.validate_many(emails, sql_conn=db, concurrency=concurrency),
+                                 {'alice@a.test': True, 'alice@bad.test': None, 'bob@b.test': True,
+                                  'carol@c.test': False})
+
+    def test_connection_checks_reuse_the_lookups(self):
+        lookups = []
+
+        class Resolver(ve.StaticResolver):
+            def mx(self, hostname):
+                lookups.append(hostname)
+                if hostname == 'bad.test':
+                    raise UnicodeError('label too long')
+                return ve.StaticResolver.mx(self, hostname)
+
+        resolver = Resolver({'a.test': [(10, 'mx.fake.test')]})
+        emails = ['alice@a.test', 'alice@bad.test', 'bob@bad.test', 'carol@c.test']
+        with FakeSMTPServer() as server:
+            db = known_domain_db(server.port, domain='fake.test')
+            validator = ve.Validator(check_mx=True, verify=False, resolver=resolver)
+            self.assertEqual(validator.validate_many(emails, sql_conn=db),
+                             {'alice@a.test': True, 'alice@bad.test': None, 'bob@bad.test': None,
+                              'carol@c.test': False})
+        self.assertEqual(sorted(lookups), ['a.test', 'bad.test', 'c.test'])
+
+    def test_domains_sharing_a_server_keep_their_options(self):
+        with FakeSMTPServer(mailboxes=['alice']) as first, FakeSMTPServer(mailboxes=['bob']) as second:
+            db = known_domain_db(first.port, domain='example.org')
+            db.execute('INSERT INTO connectionView VALUES (?, ?, NULL, NULL, 0, ?)',
+                       ('example.net', '127.0.0.1', second.port))
+            results = validate_emails(['alice@example.org', 'bob@example.net'], sql_conn=db)
+        self.assertEqual(results, {'alice@example.org': True, 'bob@example.net': True})
+
+
+class AsyncValidationTests(unittest.TestCase):
+
+    def test_matches_sync_verdicts(self):
+        with FakeSMTPServer(mailboxes=['alice']) as server:
+            db = known_domain_db(server.port)
+            emails = ['alice@example.com', 'mallory@example.com', 'not an address']
+            expected = [validate_email(email, verify=True, sql_conn=db) for email in emails]
+            results = asyncio.run(avalidate_many(emails, verify=True, sql_conn=db))
+        self.assertEqual(list(results.values()), expected)
+        self.assertEqual(expected, [True, False, False])
+
+    def test_login_after_ehlo(self):
+        with FakeSMTPServer(mailboxes=['alice']) as server:
+            db = known_domain_db(server.port, username='robot@example.com', password='secret')
+            self.assertTrue(asyncio.run(avalidate_email('alice@example.com', verify=True, sql_conn=db)))
+            verbs = [command.split(' ', 1)[0].upper() for command in server.commands]
+        self.assertEqual(verbs[:2], ['EHLO', 'AUTH'])
+
+    def test_login_needs_the_auth_extension(self):
+        smtp = ve.AsyncSMTP()
+        smtp.ehlo_resp = b'fake.example.com'
+        self.assertRaises(smtplib.SMTPNotSupportedError, asyncio.run, smtp.login('robot', 'secret'))
+
+    def test_per_host_concurrency(self):
+        with FakeSMTPServer(mailboxes=['user%d' % i for i in range(20)]) as server:
+            emails = ['user%d@example.com' % i for i in range(20)]
+            results = asyncio.run(avalidate_many(emails, per_host=3, verify=True,
+                                                 sql_conn=known_domain_db(server.port)))
+        self.assertTrue(all(results.values()))
+        self.assertEqual(server.connections, 20)
+        self.assertLessEqual(server.max_active, 3)
+
+    def test_check_mx_without_verify(self):
+        with FakeSMTPServer() as server:
+            ve.MX_CHECK_CACHE.clear()
+            self.assertTrue(asyncio.run(avalidate_email('bob@example.com', check_mx=True,
+                                                        sql_conn=known_domain_db(server.port))))
+
+
+class SMTPPoolTests(unittest.TestCase):
+
+    def test_reuses_logged_in_sessions(self):
+        pool = ve.SMTPPool()
+        with FakeSMTPServer(mailboxes=['alice']) as server:
+            db = known_domain_db(server.port, username='me@example.com', password='secret')
+            verdicts = [validate_email(email, verify=True, sql_conn=db, smtp_pool=pool)
+                        for email in ['alice@example.com', 'mallory@example.com', 'alice@example.com']]
+            self.assertEqual(verdicts, [True, False, True])
+            self.assertEqual(server.connections, 1)
+            self.assertEqual(server.count('AUTH'), 1)
+
+            # A session the server dropped is replaced on the next borrow.
+            smtp, released = pool._idle[('127.0.0.1', server.port, False, 'me@example.com')][0]
+            smtp.sock.shutdown(socket.SHUT_RDWR)
+            self.assertTrue(validate_email('alice@example.com', verify=True, sql_conn=db, smtp_pool=pool))
+            self.assertEqual(server.connections, 2)
+            pool.close()
+
+    def test_idle_timeout_and_max_size(self):
+        pool = ve.SMTPPool(max_size=1, idle_timeout=0, wait_timeout=0.1)
+        with FakeSMTPServer() as server:
+            options = {'username': 'me', 'password': 'secret', 'is_ssl': 0, 'port': server.port}
+            smtp = pool.acquire('127.0.0.1', options)
+            self.assertRaises(smtplib.SMTPException, pool.acquire, '127.0.0.1', options)
+            pool.release(smtp)
+            pool.release(pool.acquire('127.0.0.1', options))
+            self.assertEqual(server.connections, 2)
+            pool.close()
+
+
+class PipeliningTests(unittest.TestCase):
+
+    def envelopes(self, pipelining):
+        """Verify three addresses in one batch and return the verdicts and
+        the payloads written to the server."""
+        sent = []
+        send = smtplib.SMTP.send
+
+        def record(smtp, data):
+            sent.append(data)
+            return send(smtp, data)
+
+        with FakeSMTPServer(mailboxes=['alice', 'carol'], pipelining=pipelining) as server, \
+                mock.patch.object(smtplib.SMTP, 'send', record):
+            db = known_domain_db(server.port, domain='example.org')
+            verdicts = validate_emails(['alice@example.org', 'bob@example.org', 'carol@example.org'], sql_conn=db)
+            self.assertEqual(server.count('EHLO'), 1)
+        self.assertEqual(verdicts, {'alice@example.org': True, 'bob@example.org': False, 'carol@example.org': True})
+        return [data.decode('ascii') if isinstance(data, bytes) else data for data in sent]
+
+    def test_envelope_is_sent_in_one_write(self):
+        sent = self.envelopes(pipelining=True)
+        self.assertIn(1, [data.lower().count('mail from') for data in sent])
+        envelope = [data for data in sent if data.lower().startswith('mail from')][0]
+        self.assertEqual(envelope.lower().count('rcpt to'), 3)
+
+    def test_lock_step_without_pipelining(self):
+        sent = self.envelopes(pipelining=False)
+        self.assertTrue(all(data.count('\r\n') == 1 for data in sent))
+
+    def test_unread_replies_are_drained(self):
+        with FakeSMTPServer(mailboxes=['alice']) as server:
+            smtp = ve.smtp_connect('127.0.0.1', {'port': server.port, 'is_ssl': 0, 'username': None,
+                                                 'password': None})
+            self.assertEqual(ve.smtp_greet(smtp)[0], 250)
+            replies = ve.smtp_envelope(smtp, 'me@example.org', ['alice@example.org', 'bob@example.org'])
+            self.assertEqual(next(replies)[0], 250)
+            replies.close()
+            self.assertEqual(smtp.noop()[0], 250)
+            ve.smtp_quit(smtp)
+
+    def test_async_envelope_is_pipelined(self):
+        ve.MX_CHECK_CACHE.clear()
+        with FakeSMTPServer(mailboxes=['alice']) as server:
+            db = known_domain_db(server.port, domain='example.org')
+            self.assertTrue(asyncio.run(avalidate_email('alice@example.org', verify=True, sql_conn=db)))
+            self.assertFalse(asyncio.run(avalidate_email('bob@example.org', verify=True, sql_conn=db)))
+            self.assertEqual(server.count('EHLO'), 2)
+
+
+class MXRaceTests(unittest.TestCase):
+
+    def test_mx_hosts_sorted_by_preference(self):
+        answer = ve.MXAnswer([(20, 'mx2.example.org'), (5, 'mx0.example.org'), (10, 'mx1.example.org')], 60)
+        mx_hosts, known = ve._mx_hosts_from_answer('example.org', answer)
+        self.assertFalse(known)
+        self.assertEqual(list(mx_hosts), ['mx0.example.org', 'mx1.example.org', 'mx2.example.org'])
+
+    def test_race_prefers_first_and_discards_losers(self):
+        discarded = []
+
+        def attempt(value, delay, fail=False):
+            def run(cancelled):
+                time.sleep(delay)
+                if fail:
+                    raise socket.error(value)
+                return value
+            return run
+
+        self.assertEqual(ve._race([attempt('a', 0), attempt('b', 0)], discarded.append, delay=1), 'a')
+        self.assertEqual(ve._race([attempt('a', 0.5), attempt('b', 0)], discarded.append, delay=0.05), 'b')
+        self.assertEqual(ve._race([attempt('a', 0, True), attempt('b', 0)], discarded.append, delay=5), 'b')
+        self.assertRaises(socket.error, ve._race, [attempt('a', 0, True), attempt('b', 0, True)], delay=5)
+        time.sleep(0.6)
+        self.assertEqual(discarded, ['a'])
+
+    def test_silent_primary_is_raced(self):
+        silent = socket.socket()
+        silent.bind(('127.0.0.1', 0))
+        silent.listen(5)
+        try:
+            with FakeSMTPServer(mailboxes=['alice']) as server:
+                options = {'domain': 'example.org', 'username': None, 'password': None, 'is_ssl': 0}
+                mx_hosts = {'127.0.0.1': dict(options, port=silent.getsockname()[1]),
+                            'localhost': dict(options, port=server.port)}
+                details = {}
+                started = time.time()
+                verdict = ve._check_mx_hosts('alice@example.org', 'example.org', mx_hosts, verify=True,
+                                             smtp_timeout=ve.SMTPTimeouts(1, 3, 3), details=details)
+                self.assertTrue(verdict)
+                self.assertEqual(details['mx'], 'localhost')
+                self.assertLess(time.time() - started, 2)
+        finally:
+            silent.close()
+
+
+    def test_dead_primary_falls_through(self):
+        with FakeSMTPServer(mailboxes=['alice']) as server:
+            for username, password in [(None, None), ('robot@example.org', 'secret')]:
+                options = {'domain': 'example.org', 'username': username, 'password': password, 'is_ssl': 0,
+                           'port': server.port}
+                mx_hosts = OrderedDict([('127.0.0.2', options), ('127.0.0.1', options)])  # Nothing on 127.0.0.2.
+
+                async def aget_mx_ip(*args):
+                    return mx_hosts
+
+                with mock.patch.object(ve, 'get_mx_ip', return_value=mx_hosts), \
+                        mock.patch.object(ve, 'aget_mx_ip', aget_mx_ip):
+                    for kwargs in [{'verify': True}, {'check_mx': True}]:
+                        verdicts = [ve.Validator(smtp_pool=ve.SMTPPool()).validate('alice@example.org', **kwargs),
+                                    asyncio.run(ve.Validator().avalidate('alice@example.org', **kwargs))]
+                        self.assertEqual(verdicts, [True, True], (username, kwargs))
+                    self.assertEqual(ve.Validator(smtp_pool=ve.SMTPPool()).validate_many(['alice@example.org']),
+                                     {'alice@example.org': True})
+
+
+class MXThrottleTests(unittest.TestCase):
+
+    def test_token_bucket(self):
+        throttle = ve.MXThrottle(rate=100, burst=2)
+        self.assertEqual([throttle.reserve('mx'), throttle.reserve('mx')], [0, 0])
+        self.assertAlmostEqual(throttle.reserve('mx'), 0.01, delta=0.005)
+        # Known domains bring their own limits.
+        options = ve._known_domain_options(('d', 'smtp.d', None, None, 0, 25, 1.0, 1))['smtp.d']
+        self.assertEqual((options['rate'], options['burst']), (1.0, 1))
+        self.assertEqual(throttle.reserve('smtp.d', options), 0)
+        self.assertAlmostEqual(throttle.reserve('smtp.d', options), 1.0, delta=0.05)
+
+    def test_unthrottled_by_default(self):
+        emails = ['user%d@example.org' % i for i in range(120)]
+        with FakeSMTPServer(catch_all=True) as server:
+            started = time.time()
+            results = validate_emails(emails, sql_conn=known_domain_db(server.port, domain='example.org'))
+            self.assertLess(time.time() - started, 2)
+        self.assertEqual(set(results.values()), set([True]))
+        self.assertEqual(ve.MXThrottle().reserve('mx', count=50), 0)
+
+    def test_backoff_and_circuit_breaker(self):
+        throttle = ve.MXThrottle(rate=8, failure_threshold=2, cooldown=0.2)
+        throttle.record('mx', (451, b'Try later'))
+        self.assertEqual(throttle._hosts['mx'].rate, 4)
+        throttle.succeeded('mx')
+        self.assertAlmostEqual(throttle._hosts['mx'].rate, 4.8)
+
+        throttle.failed('mx')
+        throttle.failed('mx')
+        self.assertFalse(throttle.available('mx'))
+        self.assertIsNone(throttle.reserve('mx'))
+        time.sleep(0.25)
+        self.assertTrue(throttle.available('mx'))
+        self.assertIsNotNone(throttle.reserve('mx'))  # The trial...
+        self.assertFalse(throttle.available('mx'))    # ...is the only one let through.
+        throttle.failed('mx')
+        self.assertIsNone(throttle.reserve('mx'))
+        time.sleep(0.25)
+        self.assertIsNotNone(throttle.reserve('mx'))
+        throttle.succeeded('mx')
+        self.assertTrue(throttle.available('mx'))
+
+    def half_open(self, throttle, mx):
+        throttle.failed(mx)
+        time.sleep(0.15)
+        self.assertTrue(throttle.available(mx))
+
+    def test_trial_without_definite_answer(self):
+        for replies, error in [({'MAIL': '553 Sender rejected'}, None),
+                               ({'RCPT': '553 Mailbox name not allowed'}, None),
+                               ({'MAIL': None}, None),
+                               ({'MAIL': ''}, None),
+                               ({}, socket.timeout)]:
+            throttle = ve.MXThrottle(failure_threshold=1, cooldown=0.1)
+            with FakeSMTPServer(mailboxes=['alice'], replies=replies) as server:
+                mx_hosts = ve.get_mx_ip('example.org', known_domain_db(server.port, domain='example.org'))
+                self.half_open(throttle, '127.0.0.1')
+                probe = functools.partial(ve._check_mx_hosts, 'alice@example.org', 'example.org', mx_hosts,
+                                          verify=True, smtp_timeout=0.5, throttle=throttle)
+                with mock.patch.object(ve, 'smtp_envelope', side_effect=error or ve.smtp_envelope):
+                    self.assertIsNone(probe())
+                self.assertFalse(throttle.available('127.0.0.1'), replies)
+                self.assertFalse(throttle._hosts['127.0.0.1'].trial)
+
+                # The server recovered: the next trial closes the circuit.
+                server.replies.clear()
+                time.sleep(0.15)
+                self.assertTrue(probe())
+                self.assertTrue(throttle.available('127.0.0.1'))
+
+    def test_failed_greeting_leaves_the_trial(self):
+        throttle = ve.MXThrottle(failure_threshold=1, cooldown=0.1)
+        with FakeSMTPServer(mailboxes=['alice'], replies={'EHLO': '554 No', 'HELO': '554 No'}) as server:
+            mx_hosts = ve.get_mx_ip('example.org', known_domain_db(server.port, domain='example.org'))
+            self.half_open(throttle, '127.0.0.1')
+            self.assertIsNone(ve._check_mx_hosts('alice@example.org', 'example.org', mx_hosts, verify=True,
+                                                 throttle=throttle))
+            self.assertTrue(throttle.available('127.0.0.1'))
+
+    def test_bulk_and_async_trials(self):
+        with FakeSMTPServer(mailboxes=['alice'], replies={'MAIL': '553 Sender rejected'}) as server:
+            db = known_domain_db(server.port, domain='example.org')
+            throttle = ve.MXThrottle(failure_threshold=1, cooldown=0.1)
+            self.half_open(throttle, '127.0.0.1')
+            self.assertEqual(validate_emails(['alice@example.org'], verify=True, sql_conn=db, throttle=throttle),
+                             {'alice@example.org': None})
+            self.assertFalse(throttle.available('127.0.0.1'))
+            self.assertFalse(throttle._hosts['127.0.0.1'].trial)
+
+            throttle = ve.MXThrottle(failure_threshold=1, cooldown=0.1)
+            self.half_open(throttle, '127.0.0.1')
+            self.assertIsNone(asyncio.run(avalidate_email('alice@example.org', verify=True, sql_conn=db,
+                                                          throttle=throttle)))
+            self.assertFalse(throttle.available('127.0.0.1'))
+            self.assertFalse(throttle._hosts['127.0.0.1'].trial)
+
+    def test_greylisting_fails_fast(self):
+        throttle = ve.MXThrottle(failure_threshold=2, cooldown=60)
+        with FakeSMTPServer(mailboxes=['alice'], greylisted=['bob']) as server:
+            db = known_domain_db(server.port, domain='example.org')
+            details = {}
+            mx_hosts = ve.get_mx_ip('example.org', db)
+            self.assertIsNone(ve._check_mx_hosts('bob@example.org', 'example.org', mx_hosts, verify=True,
+                                                 details=details, throttle=throttle))
+            self.assertTrue(details['retry'])
+            self.assertIsNone(validate_email('bob@example.org', verify=True, sql_conn=db, throttle=throttle))
+            self.assertEqual(server.connections, 2)
+            # The circuit is open: no more connections until the cool-down is over.
+            self.assertIsNone(validate_email('alice@example.org', verify=True, sql_conn=db, throttle=throttle))
+            self.assertEqual(server.connections, 2)
+
+
+class RetryQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'retries.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_backoff_per_mx(self):
+        queue = ve.RetryQueue(self.path, base_delay=10, max_delay=25)
+        self.assertEqual([queue.defer(['a@example.org'], 'mx') for _ in range(3)], [10, 20, 25])
+        queue.defer(['b@example.org'], 'other')
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.due(), {})
+        self.assertEqual(queue.due(time.time() + 30), {'mx': {'a@example.org': 3}, 'other': {'b@example.org': 1}})
+
+    def test_greylisted_addresses_are_retried(self):
+        queue = ve.RetryQueue(self.path, base_delay=0, max_attempts=2)
+        throttle = ve.MXThrottle(failure_threshold=100)
+        emails = ['alice@example.org', 'bob@example.org', 'carol@example.org', 'dave@example.org']
+        with FakeSMTPServer(mailboxes=['alice', 'bob'], greylisted=['bob', 'carol']) as server:
+            db = known_domain_db(server.port, domain='example.org')
+            results = validate_emails(emails, sql_conn=db, throttle=throttle, retry_queue=queue)
+            self.assertEqual(list(results.values()), [True, None, None, False])
+            self.assertEqual(len(queue), 2)
+
+            # Bob's greylisting is over; carol is given up on after her second try.
+            server.greylisted.discard('bob')
+            verdicts = sorted(queue.run(sql_conn=db, throttle=throttle))
+            self.assertEqual(verdicts, [('bob@example.org', True), ('carol@example.org', None)])
+            self.assertEqual(server.connections, 2)
+            self.assertEqual(len(queue), 0)
+
+            server.greylisted.add('bob')
+            self.assertIsNone(asyncio.run(avalidate_email('bob@example.org', verify=True, sql_conn=db,
+                                                          throttle=throttle, retry_queue=queue)))
+            self.assertEqual(queue.due(), {'127.0.0.1': {'bob@example.org': 1}})
+
+
+class CatchAllTests(unittest.TestCase):
+
+    def setUp(self):
+        ve.CATCH_ALL_CACHE.clear()
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        ve.CATCH_ALL_CACHE.clear()
+        shutil.rmtree(self.tmp)
+
+    def test_catch_all_domain_is_probed_once(self):
+        store = ve.ResultStore(os.path.join(self.tmp, 'cache.db'), verdict_ttls={True: 0})
+        with FakeSMTPServer(catch_all=True) as server:
+            db = known_domain_db(server.port, domain='example.org')
+            self.assertIs(validate_email('alice@example.org', verify=True, sql_conn=db), True)
+            self.assertEqual(validate_email('alice@example.org', verify=True, sql_conn=db, detect_catch_all=True,
+                                            result_store=store), ve.ACCEPT_ALL)
+            self.assertEqual(server.count('RCPT'), 3)
+            self.assertEqual(server.connections, 2)
+
+            # Later addresses of the domain are answered without SMTP, also from the store.
+            self.assertEqual(validate_email('bob@example.org', verify=True, sql_conn=db, detect_catch_all=True),
+                             ve.ACCEPT_ALL)
+            ve.CATCH_ALL_CACHE.clear()
+            results = validate_emails(['carol@example.org', 'dave@example.org'], sql_conn=db,
+                                      detect_catch_all=True, result_store=store)
+            self.assertEqual(list(results.values()), [ve.ACCEPT_ALL, ve.ACCEPT_ALL])
+            self.assertEqual(server.connections, 2)
+        store.close()
+
+    def test_regular_domain(self):
+        with FakeSMTPServer(mailboxes=['alice']) as server:
+            db = known_domain_db(server.port, domain='example.org')
+            self.assertIs(validate_email('alice@example.org', verify=True, sql_conn=db, detect_catch_all=True), True)
+            self.assertEqual(server.count('RCPT'), 2)
+            self.assertIs(validate_email('alice@example.org', verify=True, sql_conn=db, detect_catch_all=True), True)
+            self.assertEqual(server.count('RCPT'), 3)
+
+    def test_bulk_probe_rides_along(self):
+        with FakeSMTPServer(catch_all=True) as server:
+            db = known_domain_db(server.port, domain='example.org')
+            results = validate_emails(['alice@example.org', 'bob@example.org'], sql_conn=db, detect_catch_all=True)
+            self.assertEqual(list(results.values()), [ve.ACCEPT_ALL, ve.ACCEPT_ALL])
+            self.assertEqual(server.count('RCPT'), 3)
+            self.assertEqual(server.connections, 1)
+
+
+class ValidationResultTests(unittest.TestCase):
+
+    def test_local_stages(self):
+        result = ve.validate_email_result('not an address')
+        self.assertEqual((result.verdict, result.reason), (False, 'syntax'))
+        self.assertFalse(result)
+        self.assertEqual(sorted(result.timings), ['syntax', 'total'])
+        result = ve.validate_email_result('someone@mailinator.com', allow_disposable=False)
+        self.assertEqual((result.verdict, result.reason), (False, 'disposable'))
+        result = ve.validate_email_result('someone@example.org')
+        self.assertEqual((result.verdict, result.reason), (True, 'syntax_ok'))
+        self.assertRaises(AttributeError, setattr, result, 'extra', 1)
+
+    def test_smtp_stages_and_metrics(self):
+        metrics = ve.ValidationMetrics()
+        with FakeSMTPServer(mailboxes=['alice']) as server:
+            db = known_domain_db(server.port, domain='example.org', username='me@example.org', password='secret')
+            pool = ve.SMTPPool()
+            alice = ve.validate_email_result('alice@example.org', verify=True, sql_conn=db, smtp_pool=pool,
+                                             metrics=metrics)
+            bob = ve.validate_email_result('bob@example.org', verify=True, sql_conn=db, smtp_pool=pool,
+                                           metrics=metrics)
+            pool.close()
+        self.assertEqual((alice.verdict, alice.reason, alice.smtp_code, alice.mx), (True, 'accepted', 250, '127.0.0.1'))
+        self.assertEqual((bob.verdict, bob.reason, bob.smtp_code, bob.smtp_message),
+                         (False, 'rejected', 550, 'No such user'))
+        self.assertTrue(set(['sql', 'connect', 'banner', 'login', 'helo', 'mail', 'rcpt', 'total'])
+                        <= set(alice.timings))
+        self.assertNotIn('connect', bob.timings)  # The pooled session was reused.
+        self.assertTrue(all(seconds >= 0 for seconds in alice.timings.values()))
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters'][('reason', 'accepted')], 1)
+        self.assertEqual(snapshot['counters'][('mx_reason', '127.0.0.1', 'rejected')], 1)
+        self.assertEqual(snapshot['histograms'][('rcpt', '127.0.0.1')]['count'], 2)
+        self.assertEqual(sum(snapshot['histograms'][('total', '127.0.0.1')]['counts']), 2)
+
+
+    def test_metrics_of_at_most_max_hosts_servers(self):
+        metrics = ve.ValidationMetrics(max_hosts=2)
+        for mx in ('mx1.test', 'mx2.test', 'mx1.test', 'mx3.test'):
+            result = ve.ValidationResult('alice@example.org')
+            result.reason, result.mx, result.timings = 'accepted', mx, {'rcpt': 0.01}
+            metrics.record(result)
+        snapshot = metrics.snapshot()
+        self.assertEqual(sorted(name[1] for name in snapshot['histograms']), ['mx1.test', 'mx3.test'])
+        self.assertNotIn(('mx_reason', 'mx2.test', 'accepted'), snapshot['counters'])
+        self.assertEqual(snapshot['counters'][('mx_reason', 'mx1.test', 'accepted')], 2)
+        self.assertEqual(snapshot['counters'][('reason', 'accepted')], 4)
+
+class KnownDomainsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'known.db')
+        conn = sqlite3.connect(self.path)
+        conn.execute('CREATE TABLE connectionView (domain, server, username, password, ssl, port)')
+        conn.execute("INSERT INTO connectionView VALUES ('gmail.com', 'smtp.gmail.com', 'resu', 'ssap', 1, 465)")
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_snapshot_decrypts_once(self):
+        calls = []
+
+        def decrypt(value):
+            calls.append(value)
+            return value[::-1]
+
+        known = ve.KnownDomains(self.path, decrypt, check_interval=0)
+        found = []
+        threads = [threading.Thread(target=lambda: found.append(ve.get_known_domain('gmail.com', known)))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(found, [{'smtp.gmail.com': {'domain': 'gmail.com', 'username': 'user', 'password': 'pass',
+                                                     'is_ssl': 1, 'port': 465}}] * 8)
+        self.assertEqual(len(calls), 2)
+        self.assertIsNone(ve.get_known_domain('yahoo.com', known))
+
+    def test_refreshes_on_change(self):
+        known = ve.KnownDomains(self.path, check_interval=0)
+        self.assertFalse(known.refresh())
+        conn = sqlite3.connect(self.path)
+        conn.execute("INSERT INTO connectionView VALUES ('yahoo.com', 'smtp.mail.yahoo.com', NULL, NULL, 1, 465)")
+        conn.commit()
+        conn.close()
+        self.assertIn('smtp.mail.yahoo.com', ve.get_known_domain('yahoo.com', known))
+
+
+class SingleFlightTests(unittest.TestCase):
+
+    def run_threads(self, target, count=8):
+        threads = [threading.Thread(target=target) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_concurrent_calls_share_one_run(self):
+        flights = ve.SingleFlight()
+        calls, results = [], []
+        started, release = threading.Event(), threading.Event()
+
+        def lookup():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'answer'
+
+        def call():
+            results.append(flights.do('example.org', lookup))
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(5)
+        threads = [threading.Thread(target=call) for i in range(7)]
+        for thread in threads:
+            thread.start()
+        while flights.shared < 7:
+            time.sleep(0.001)
+        release.set()
+        for thread in [leader] + threads:
+            thread.join()
+        self.assertEqual((len(calls), results), (1, ['answer'] * 8))
+        self.assertEqual(flights.do('example.org', lambda: 'again'), 'again')
+
+    def test_errors_are_shared_too(self):
+        flights = ve.SingleFlight()
+        calls, errors = [], []
+
+        def fail():
+            calls.append(1)
+            time.sleep(0.05)
+            raise ValueError('SERVFAIL')
+
+        def call():
+            try:
+                flights.do('example.org', fail)
+            except ValueError as e:
+                errors.append(e)
+
+        self.run_threads(call)
+        self.assertEqual(len(errors), 8)
+        self.assertEqual(len(calls) + flights.shared, 8)
+        self.assertLess(len(calls), 8)
+
+    def test_tasks_share_one_run(self):
+        flights = ve.SingleFlight()
+        calls = []
+
+        async def lookup():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'answer'
+
+        async def run():
+            return await asyncio.gather(*[flights.ado('example.org', lookup) for i in range(5)])
+
+        self.assertEqual(asyncio.run(run()), ['answer'] * 5)
+        self.assertEqual((len(calls), flights.shared), (1, 4))
+
+
+class ValidatorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'known.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def known_domains(self, port):
+        conn = sqlite3.connect(self.path)
+        conn.execute('CREATE TABLE connectionView (domain, server, username, password, ssl, port)')
+        conn.execute("INSERT INTO connectionView VALUES ('example.org', '127.0.0.1', NULL, NULL, 0, ?)", (port,))
+        conn.commit()
+        conn.close()
+
+    def test_caches_are_its_own(self):
+        ve.MX_CHECK_CACHE.clear()
+        with FakeSMTPServer(mailboxes=['alice']) as server:
+            self.known_domains(server.port)
+            validator = ve.Validator(check_mx=True, database=self.path)
+            self.assertTrue(validator.validate('bob@example.org'))
+            self.assertTrue(validator.validate_result('bob@example.org').host_cached)
+            self.assertTrue(validator.validate('alice@example.org', verify=True))
+            self.assertFalse(validator.validate('bob@example.org', verify=True))
+        self.assertIn('127.0.0.1', validator.check_cache)
+        self.assertNotIn('127.0.0.1', ve.MX_CHECK_CACHE)
+        validator.clear()
+        self.assertEqual(len(validator.check_cache), 0)
+
+    def test_threads_share_one_connection_check(self):
+        with FakeSMTPServer() as server:
+            self.known_domains(server.port)
+            validator = ve.Validator(check_mx=True, database=self.path)
+            connections, verdicts = set(), []
+            barrier = threading.Barrier(8)
+
+            def call():
+                connections.add(id(validator.connection()))
+                barrier.wait()
+                verdicts.append(validator.validate('bob@example.org'))
+
+            threads = [threading.Thread(target=call) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(verdicts, [True] * 8)
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(len(connections), 8)
+
+    def test_async_calls_use_its_caches(self):
+        ve.MX_CHECK_CACHE.clear()
+        with FakeSMTPServer(mailboxes=['alice']) as server:
+            self.known_domains(server.port)
+            validator = ve.Validator(check_mx=True, database=self.path)
+
+            async def run():
+                return await asyncio.gather(*[validator.avalidate('bob@example.org') for i in range(4)])
+
+            self.assertEqual(asyncio.run(run()), [True] * 4)
+        self.assertEqual(server.connections, 1)
+        self.assertNotIn('127.0.0.1', ve.MX_CHECK_CACHE)
+
+
+class StreamTests(unittest.TestCase):
+
+    def setUp(self):
+        self.taken = []
+
+    def source(self, count):
+        for i in range(count):
+            self.taken.append(i)
+            yield 'user%d@example.org' % i
+
+    def test_window_bounds_the_source(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'known.db')
+            with FakeSMTPServer(mailboxes=['user%d' % i for i in range(0, 30, 2)]) as server:
+                conn = sqlite3.connect(path)
+                conn.execute('CREATE TABLE connectionView (domain, server, username, password, ssl, port)')
+                conn.execute("INSERT INTO connectionView VALUES ('example.org', '127.0.0.1', NULL, NULL, 0, ?)",
+                             (server.port,))
+                conn.commit()
+                conn.close()
+                validator = ve.Validator(verify=True, database=path, throttle=ve.MXThrottle(rate=1000, burst=1000))
+                results = {}
+                for email, verdict in validator.validate_stream(self.source(30), window=4):
+                    self.assertLessEqual(len(self.taken), len(results) + 4)
+                    results[email] = verdict
+        finally:
+            shutil.rmtree(tmp)
+        self.assertEqual(results, dict(('user%d@example.org' % i, i % 2 == 0) for i in range(30)))
+        self.assertLessEqual(server.max_active, 4)
+
+    def test_close_stops_taking(self):
+        stream = ve.validate_stream(self.source(1000), window=3)
+        self.assertEqual(next(stream)[1], True)
+        stream.close()
+        self.assertLessEqual(len(self.taken), 4)
+
+    def test_async_stream(self):
+        async def source():
+            for email in self.source(20):
+                yield email
+
+        async def run(db):
+            results = {}
+            async for email, verdict in ve.avalidate_stream(source(), window=5, verify=True, sql_conn=db,
+                                                             throttle=ve.MXThrottle(rate=1000, burst=1000)):
+                self.assertLessEqual(len(self.taken), len(results) + 6)
+                results[email] = verdict
+            stream = ve.avalidate_stream(['alice@example.org'] * 100, window=5)
+            await stream.__anext__()
+            await stream.aclose()
+            return results
+
+        with FakeSMTPServer(mailboxes=['user3']) as server:
+            results = asyncio.run(run(known_domain_db(server.port, domain='example.org')))
+        self.assertEqual(results, dict(('user%d@example.org' % i, i == 3) for i in range(20)))
+
+
+    def test_many_servers_in_bounded_memory(self):
+        limiters = []
+        base = ve.ConcurrencyLimiter
+
+        class Limiter(base):
+            def __init__(self, *args):
+                base.__init__(self, *args)
+                limiters.append(self)
+
+        # Every domain has an MX server of its own, all answered by one fake server.
+        domains = ['d%d.test' % i for i in range(200)]
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'known.db')
+        with FakeSMTPServer(catch_all=True, host='0.0.0.0') as server:
+            conn = sqlite3.connect(path)
+            conn.execute('CREATE TABLE connectionView (domain, server, username, password, ssl, port)')
+            conn.executemany('INSERT INTO connectionView VALUES (?, ?, NULL, NULL, 0, ?)',
+                             [(domain, '127.0.%d.%d' % divmod(i + 2, 256), server.port)
+                              for i, domain in enumerate(domains)])
+            conn.commit()
+            conn.close()
+            validator = ve.Validator(verify=True, database=ve.KnownDomains(path),
+                                     throttle=ve.MXThrottle(rate=1000, burst=1000, max_hosts=20))
+            validator.check_cache = ve.MXCache(max_size=20)
+
+            async def run():
+                verdicts = []
+                async for email, verdict in validator.avalidate_stream(['a@' + domain for domain in domains],
+                                                                        window=10):
+                    self.assertLessEqual(len(limiters[0].hosts), 10)
+                    verdicts.append(verdict)
+                return verdicts
+
+            with mock.patch.object(ve, 'ConcurrencyLimiter', Limiter):
+                verdicts = asyncio.run(run())
+            self.assertEqual(verdicts, [True] * 200)
+            self.assertEqual(limiters[0].hosts, {})
+            self.assertEqual(len(validator.settings['throttle']._hosts), 20)
+            self.assertEqual(len(validator.check_cache), 20)
+
+            results = dict(validator.validate_stream(['b@' + domain for domain in domains], window=10))
+            self.assertEqual(set(results.values()), set([True]))
+            self.assertEqual(len(validator.settings['throttle']._hosts), 20)
+            self.assertEqual(len(validator.check_cache), 20)
+
+
+class BatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.database = os.path.join(self.tmp, 'known.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def run_batch(self, port, rows=('alice@example.org', 'nope', 'x@yopmail.com', 'mallory@example.org',
+                                    'bob@example.org'), **kwargs):
+        conn = known_domain_db(port, domain='example.org')
+        conn.execute("ATTACH DATABASE ? AS disk", (self.database,))
+        conn.execute('CREATE TABLE IF NOT EXISTS disk.connectionView AS SELECT * FROM connectionView')
+        conn.commit()
+        conn.close()
+        source = os.path.join(self.tmp, 'emails.csv')
+        with open(source, 'w') as f:
+            f.write('name,email\n' + ''.join('%d,%s\n' % row for row in enumerate(rows)))
+        output = os.path.join(self.tmp, 'results.jsonl')
+        written = ve.validate_file(source, output, verify=True, allow_disposable=False, database=self.database,
+                                   processes=2, **kwargs)
+        with open(output) as f:
+            return written, [json.loads(line) for line in f]
+
+    def test_batch_file(self):
+        with FakeSMTPServer(mailboxes=['alice', 'bob']) as server:
+            written, records = self.run_batch(server.port)
+        self.assertEqual(written, 5)
+        self.assertEqual([(r['email'], r['verdict'], r['reason'], r['mx']) for r in records], [
+            ('alice@example.org', True, 'accepted', '127.0.0.1'),
+            ('nope', False, 'syntax', None),
+            ('x@yopmail.com', False, 'disposable', None),
+            ('mallory@example.org', False, 'rejected', '127.0.0.1'),
+            ('bob@example.org', True, 'accepted', '127.0.0.1'),
+        ])
+
+    def test_resume_from_checkpoint(self):
+        with FakeSMTPServer(mailboxes=['alice', 'bob']) as server:
+            written, expected = self.run_batch(server.port)
+            output = os.path.join(self.tmp, 'results.jsonl')
+            with open(output) as f:
+                offset = len(f.readline()) + len(f.readline())
+            with open(output, 'a') as f:
+                f.write('{"email": "half a rec')
+            with open(output + '.checkpoint', 'w') as f:
+                json.dump({'rows': 2, 'offset': offset}, f)
+            written, records = self.run_batch(server.port, resume=True)
+        self.assertEqual(written, 3)
+        self.assertEqual(records, expected)
+
+    def test_local_rows_beyond_the_window(self):
+        rows = ['alice@example.org'] + ['nope'] * 50 + ['bob@example.org']
+        finished = []
+        with FakeSMTPServer(mailboxes=['alice', 'bob']) as server:
+            thread = threading.Thread(target=lambda: finished.append(self.run_batch(server.port, rows, window=10)))
+            thread.daemon = True
+            thread.start()
+            thread.join(30)
+        self.assertTrue(finished, 'validate_file() hung')
+        written, records = finished[0]
+        self.assertEqual(written, 52)
+        self.assertEqual([r['verdict'] for r in records], [True] + [False] * 50 + [True])
+
+    def test_local_rows_stay_in_process(self):
+        source = os.path.join(self.tmp, 'emails.txt')
+        with open(source, 'w') as f:
+            f.write('alice@example.org\nnope\n')
+        output = os.path.join(self.tmp, 'results.jsonl')
+        with mock.patch('multiprocessing.Pool') as pool:
+            self.assertEqual(ve.validate_file(source, output), 2)
+        self.assertFalse(pool.called)
+        with open(output) as f:
+            self.assertEqual([json.loads(line)['verdict'] for line in f], [True, False])
+
+    def test_malformed_jsonl_rows(self):
+        source = os.path.join(self.tmp, 'emails.jsonl')
+        with open(source, 'w') as f:
+            f.write('"alice@example.org"\n{"email": "bob@example.org"}\n42\n[1]\nnull\n{"email": 7}\n{"email\n')
+        output = os.path.join(self.tmp, 'results.jsonl')
+        self.assertEqual(ve.validate_file(source, output), 7)
+        with open(output) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([(r['email'], r['verdict'], r['reason']) for r in records], [
+            ('alice@example.org', True, 'syntax_ok'),
+            ('bob@example.org', True, 'syntax_ok'),
+            ('42', None, 'malformed'),
+            ('[1]', None, 'malformed'),
+            ('null', None, 'malformed'),
+            ('{"email": 7}', None, 'malformed'),
+            ('{"email', None, 'malformed'),
+        ])
+
+
+class LoggingTests(unittest.TestCase):
+
+    def test_no_formatting_when_debug_is_off(self):
+        with FakeSMTPServer() as server:
+            db = known_domain_db(server.port)
+            ve.MX_CHECK_CACHE['127.0.0.1'] = True
+            with mock.patch('pprint.pformat') as pformat:
+                self.assertTrue(validate_email('bob@example.com', check_mx=True, sql_conn=db))
+        self.assertFalse(pformat.called)
+
+    def test_debug_is_scoped_to_the_call(self):
+        stream = io.StringIO()
+        with FakeSMTPServer() as server, mock.patch.object(ve.ch, 'stream', stream):
+            db = known_domain_db(server.port)
+            self.assertTrue(validate_email('bob@example.com', check_mx=True, sql_conn=db, debug=True))
+            self.assertIn('Looking for MX Records for example.com', stream.getvalue())
+            self.assertEqual(ve.logger.level, ve.logging.CRITICAL)
+
+            stream.truncate(0)
+            validate_email('bob@example.com', check_mx=True, sql_conn=db)
+            self.assertEqual(stream.getvalue(), '')
+
+    def test_logger_is_a_logger(self):
+        self.assertIsInstance(ve.logger, ve.logging.Logger)
+        handler = ve.logging.StreamHandler(io.StringIO())
+        ve.logger.addHandler(handler)
+        ve.logger.setLevel(ve.logging.DEBUG)
+        try:
+            ve.is_disposable('x@yopmail.com')
+            self.assertIn('flagged as disposable', handler.stream.getvalue())
+        finally:
+            ve.logger.setLevel(ve.logging.CRITICAL)
+            ve.logger.removeHandler(handler)
+
+    def test_import_adds_no_output_handler(self):
+        self.assertEqual([type(h) for h in ve.logger.handlers], [ve.logging.NullHandler])
+
+
+class ImportTests(unittest.TestCase):
+
+    def test_network_stack_is_imported_lazily(self):
+        code = ('import sys, validate_email; validate_email.is_valid_syntax("a b@example.org"); '
+                'print(",".join(m for m in ("smtplib", "sqlite3", "json", "gzip", "asyncio", "dns") '
+                'if m in sys.modules))')
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+        self.assertEqual(output.decode('utf-8').strip(), '')
+
+    def test_full_pattern_is_still_exported(self):
+        self.assertTrue(ve.VALID_ADDRESS_RE.match('"a b"@example.org'))
+        self.assertRaises(AttributeError, getattr, ve, 'NO_SUCH_PATTERN')
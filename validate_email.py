@@ -17,23 +17,23 @@
 # exception of a circular definition (see comments below), and
 # with the omission of the pattern components marked as "obsolete".
 
+import contextlib
+import functools
+import itertools
 import logging
-import pprint
 import os
 import sys
 import re
-import smtplib
 import socket
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from collections.abc import Mapping
+from contextvars import ContextVar
 
-# sqlite3 imports for looking up known MX servers.
-try:
-    import sqlite3
-except (ImportError, AttributeError):
-    pass
-
-
-    class ServerError(Exception):
-        pass
+# smtplib, sqlite3, json, gzip, asyncio and dnspython are imported by the
+# functions using them, so that importing this module for syntax checks
+# stays cheap.
 
 # All we are really doing is comparing the input string to one
 # gigantic regular expression.  But building that regexp, and
@@ -72,108 +72,1807 @@ DOMAIN_LITERAL = CFWS + r'?' + r'\[' + r'(?:' + FWS + r'?' + DCONTENT + r')*' +
 DOMAIN = r'(?:' + DOT_ATOM + r'|' + DOMAIN_LITERAL + r')'  # see 3.4.1
 ADDR_SPEC = LOCAL_PART + r'@' + DOMAIN  # see 3.4.1
 VALID_ADDRESS_REGEXP = '^' + ADDR_SPEC + '$'  # A valid address will match exactly the 3.4.1 addr-spec.
-MX_DNS_CACHE = {}
-MX_CHECK_CACHE = {}
 
-# Set up the global logger to stdout
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.CRITICAL)
-ch = logging.StreamHandler(sys.stdout)
-ch.setLevel(logging.CRITICAL)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-ch.setFormatter(formatter)
-logger.addHandler(ch)
+# The tokens above follow the RFC closely, but FWS and the bodies of
+# comments, quoted strings and domain literals can split the same run of
+# white space in many different ways, so VALID_ADDRESS_REGEXP backtracks
+# exponentially on input like '"' followed by many '\r\n a'.  Since WSP
+# already includes \r and \n, FWS matches exactly one or more WSP, and
+# each body is just a run of single characters or quoted pairs.  The
+# patterns below are built on that and accept exactly the same strings
+# without the ambiguity.
+_BODY = r'(?:[\s%s]|' + QUOTED_PAIR + r')*'
+_COMMENT = r'\(' + _BODY % (NO_WS_CTL + r'\x21-\x27\x2a-\x5b\x5d-\x7e') + r'\)'
+_CFWS = r'(?:' + WSP + r'|' + _COMMENT + r')+'
+_DOT_ATOM = r'(?:' + _CFWS + r')?' + DOT_ATOM_TEXT + r'(?:' + _CFWS + r')?'
+_QUOTED_STRING = r'(?:' + _CFWS + r')?"' + _BODY % (NO_WS_CTL + r'\x21\x23-\x5b\x5d-\x7e') + r'"(?:' + _CFWS + r')?'
+_DOMAIN_LITERAL = r'(?:' + _CFWS + r')?\[' + _BODY % (NO_WS_CTL + r'\x21-\x5a\x5e-\x7e') + r'\](?:' + _CFWS + r')?'
+_ADDR_SPEC = r'(?:' + _DOT_ATOM + r'|' + _QUOTED_STRING + r')@(?:' + _DOT_ATOM + r'|' + _DOMAIN_LITERAL + r')'
+
+# Most addresses are a plain dot-atom on both sides of the @.  Those are
+# accepted by the cheap pattern below; anything without white space,
+# quotes, comments or domain literals that it rejects can't match the
+# addr-spec either, so only the rest goes through the full pattern, which
+# is compiled the first time it is needed (see _valid_address_re()).
+FAST_ADDRESS_RE = re.compile(DOT_ATOM_TEXT + r'@' + DOT_ATOM_TEXT)
+SLOW_PATH_RE = re.compile(r'[\s"(\[]')
+_VALID_ADDRESS_RE = None
+
+
+def _valid_address_re():
+    global _VALID_ADDRESS_RE
+    if _VALID_ADDRESS_RE is None:
+        _VALID_ADDRESS_RE = re.compile('^' + _ADDR_SPEC + '$')
+    return _VALID_ADDRESS_RE
+
+
+def __getattr__(name):
+    # Module attributes built on first use.
+    if name == 'VALID_ADDRESS_RE':
+        return _valid_address_re()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+class MXCache(object):
+    """Size-bounded cache of MX lookups keyed by hostname.  Answers are kept
+    for their record TTL clamped to [min_ttl, max_ttl], missing domains
+    (None) for negative_ttl and failed lookups (False) for failure_ttl.
+    The least recently used entries are evicted past max_size."""
+
+    def __init__(self, max_size=100000, min_ttl=60, max_ttl=86400, negative_ttl=300, failure_ttl=30,
+                 default_ttl=3600):
+        self.max_size = max_size
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.failure_ttl = failure_ttl
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, hostname, default=None):
+        """Return the cached answer for hostname, or default when it is
+        missing or expired."""
+        with self._lock:
+            entry = self._entries.get(hostname)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._entries.move_to_end(hostname)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[hostname]
+                self.expirations += 1
+            self.misses += 1
+            return default
+
+    def set(self, hostname, value, ttl=None):
+        """Cache value for hostname and return the ttl it is kept for.
+        None and False are kept for the negative and failure ttl, answers
+        for ttl (default_ttl when not given) clamped to [min_ttl, max_ttl]."""
+        if value is None:
+            ttl = self.negative_ttl
+        elif value is False:
+            ttl = self.failure_ttl
+        else:
+            ttl = min(max(self.default_ttl if ttl is None else ttl, self.min_ttl), self.max_ttl)
+        with self._lock:
+            self._entries[hostname] = (time.time() + ttl, value)
+            self._entries.move_to_end(hostname)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return ttl
+
+    def stats(self):
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "expirations": self.expirations}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, hostname):
+        entry = self._entries.get(hostname)
+        return entry is not None and entry[0] > time.time()
+
+    def __getitem__(self, hostname):
+        entry = self._entries.get(hostname)
+        if entry is None or entry[0] <= time.time():
+            raise KeyError(hostname)
+        return entry[1]
+
+    def __setitem__(self, hostname, value):
+        self.set(hostname, value)
+
+    def __delitem__(self, hostname):
+        with self._lock:
+            del self._entries[hostname]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _Flight(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """De-duplicates concurrent work: while a call for some key is running,
+    other calls for the same key wait for it and share its result (or
+    exception) instead of repeating it.  MX lookups are keyed by domain and
+    connection checks by MX servers.  `shared` counts the calls that
+    waited for another one."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._futures = {}
+        self.shared = 0
+
+    def do(self, key, func, *args, **kwargs):
+        """Return func(*args, **kwargs), or the result of the call for key
+        that is already running."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = func(*args, **kwargs)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    async def ado(self, key, func, *args, **kwargs):
+        """do() for coroutine functions, shared between the tasks of an
+        event loop.  When the running call is cancelled, one of the waiting
+        tasks takes over."""
+        import asyncio
+        loop = asyncio.get_event_loop()
+        with self._lock:
+            future = self._futures.get((loop, key))
+            if future is None:
+                future = self._futures[(loop, key)] = loop.create_future()
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+        if not leader:
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():  # This task was cancelled.
+                    raise
+            return await self.ado(key, func, *args, **kwargs)
+        try:
+            result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # Retrieved, in case no task was waiting.
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                del self._futures[(loop, key)]
+        return result
+
+
+class _SQLiteFile(object):
+    """A SQLite database file opened once per thread and process."""
+
+    def __init__(self, path, timeout=30, wal=True):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        if wal:
+            self._conn().execute('PRAGMA journal_mode=WAL')
+
+    def _conn(self):
+        # sqlite3 connections can't be shared between threads, nor survive a fork.
+        import sqlite3
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class ResultStore(_SQLiteFile):
+    """Persistent cache of MX answers ('mx'), reachable MX servers ('host'),
+    catch-all status of domains ('catch_all') and per-address verdicts
+    ('verdict') in a SQLite database.  The
+    database runs in WAL mode so several processes on one machine can
+    share it.  `verdict_ttls` maps each verdict (True, False, None) to the
+    number of seconds it is kept; a ttl of 0 disables caching it."""
+
+    def __init__(self, path, mx_ttl=3600, host_ttl=3600, verdict_ttls=None, timeout=30, catch_all_ttl=86400):
+        _SQLiteFile.__init__(self, path, timeout)
+        self.ttls = {'mx': mx_ttl, 'host': host_ttl, 'catch_all': catch_all_ttl}
+        self.verdict_ttls = {True: 30 * 86400, False: 7 * 86400, None: 3600}
+        if verdict_ttls:
+            self.verdict_ttls.update(verdict_ttls)
+        self._conn().execute('''CREATE TABLE IF NOT EXISTS results
+                                (kind varchar, key varchar, value text, expires real,
+                                 PRIMARY KEY (kind, key))''')
+
+    def lookup(self, kind, key):
+        """Return a (value, seconds left) tuple, or None when nothing
+        unexpired is stored for key."""
+        import json
+        row = self._conn().execute('SELECT value, expires FROM results WHERE kind = ? AND key = ?',
+                                   (kind, key)).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return json.loads(row[0]), row[1] - time.time()
+
+    def get(self, kind, key, default=None):
+        found = self.lookup(kind, key)
+        return default if found is None else found[0]
+
+    def set(self, kind, key, value, ttl=None):
+        import json
+        if ttl is None:
+            ttl = self.verdict_ttls.get(value, 0) if kind == 'verdict' else self.ttls[kind]
+        if ttl <= 0:
+            return
+        self._conn().execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                             (kind, key, json.dumps(value, default=dict), time.time() + ttl))
+
+    def purge(self):
+        """Delete expired entries."""
+        self._conn().execute('DELETE FROM results WHERE expires <= ?', (time.time(),))
+
+
+class RetryQueue(_SQLiteFile):
+    """Persistent queue of addresses whose verification hit a temporary
+    failure (greylisting, other 4xx replies, unreachable or throttled
+    servers), parked in a SQLite database until their primary MX server is
+    due for another try.  Every deferral on a server doubles its delay,
+    from `base_delay` up to `max_delay` seconds, and a definite answer from
+    it resets the delay.  Addresses still unresolved after `max_attempts`
+    tries are given up on.  Pass it to validate_emails() or
+    avalidate_email() as `retry_queue`, then call run() periodically."""
+
+    def __init__(self, path, base_delay=300, max_delay=4 * 3600, max_attempts=5, timeout=30):
+        _SQLiteFile.__init__(self, path, timeout)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        conn = self._conn()
+        conn.execute('''CREATE TABLE IF NOT EXISTS retries
+                        (email varchar PRIMARY KEY, mx varchar, attempts integer)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS retry_hosts
+                        (mx varchar PRIMARY KEY, failures integer, due real)''')
+
+    def __len__(self):
+        return self._conn().execute('SELECT COUNT(*) FROM retries').fetchone()[0]
+
+    def defer(self, emails, mx):
+        """Park `emails` until mx is due again; returns the delay."""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT failures FROM retry_hosts WHERE mx = ?', (mx,)).fetchone()
+            failures = (row[0] if row else 0) + 1
+            delay = min(self.max_delay, self.base_delay * 2 ** (failures - 1))
+            conn.execute('INSERT OR REPLACE INTO retry_hosts VALUES (?, ?, ?)', (mx, failures, time.time() + delay))
+            conn.executemany('''INSERT INTO retries VALUES (?, ?, 1)
+                                ON CONFLICT (email) DO UPDATE SET attempts = attempts + 1, mx = excluded.mx''',
+                             [(email, mx) for email in emails])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        _log.debug(u"    ~~~ Deferred %d addresses on %s for %ds", len(emails), mx, delay)
+        return delay
+
+    def due(self, now=None):
+        """Return {mx: {email: attempts}} for the addresses whose server is due."""
+        rows = self._conn().execute('''SELECT r.mx, r.email, r.attempts FROM retries AS r
+                                       INNER JOIN retry_hosts AS h ON r.mx = h.mx
+                                       WHERE h.due <= ? ORDER BY r.mx''', (now or time.time(),))
+        parked = OrderedDict()
+        for mx, email, attempts in rows:
+            parked.setdefault(mx, OrderedDict())[email] = attempts
+        return parked
+
+    def _attempts(self, emails):
+        conn = self._conn()
+        return dict(row for email in emails
+                    for row in conn.execute('SELECT email, attempts FROM retries WHERE email = ?', (email,)))
+
+    def discard(self, emails):
+        self._conn().executemany('DELETE FROM retries WHERE email = ?', [(email,) for email in emails])
+
+    def run(self, now=None, **kwargs):
+        """Retry the parked addresses of every server that is due, with one
+        validate_emails() call (taking `kwargs`) per server so its addresses
+        share an SMTP session.  Yields (email, verdict) for every address
+        that got a definite answer, or None once it is given up on; the
+        others are parked again."""
+        for mx, parked in self.due(now).items():
+            verdicts = validate_emails(list(parked), verify=True, retry_queue=self, **kwargs)
+            attempts = self._attempts(parked)
+            done = []
+            for email in parked:
+                verdict = verdicts[email]
+                if verdict is None and parked[email] < attempts.get(email, 0) < self.max_attempts:
+                    continue  # Parked again.
+                done.append((email, verdict))
+            if any(verdict is not None for email, verdict in done):
+                self._conn().execute('UPDATE retry_hosts SET failures = 0 WHERE mx = ?', (mx,))
+            self.discard([email for email, verdict in done])
+            for item in done:
+                yield item
+
+
+_MISSING = object()
+MX_DNS_CACHE = MXCache()
+# MX servers known to accept connections, checked again after a day.
+MX_CHECK_CACHE = MXCache(default_ttl=86400)
+SINGLE_FLIGHT = SingleFlight()
+
+# Verdict for an address a catch-all domain accepted: the server accepts
+# any address of the domain, so the answer says nothing about this one.
+ACCEPT_ALL = 'accept-all'
+# What an accepted RCPT TO means on each probed domain: ACCEPT_ALL on
+# catch-all domains, True on domains rejecting unknown recipients and None
+# (kept for a short while) when the probe was inconclusive.
+CATCH_ALL_CACHE = MXCache(default_ttl=86400)
+
+# The Validator running the current call, whose caches are used instead of
+# the module's.
+_validator = ContextVar('validate_email_validator', default=None)
+
+
+def _caches():
+    """The (MX answers, reachable MX servers, catch-all status, SingleFlight)
+    of the current call: the Validator's, or the module's outside of one."""
+    validator = _validator.get()
+    if validator is None:
+        return MX_DNS_CACHE, MX_CHECK_CACHE, CATCH_ALL_CACHE, SINGLE_FLIGHT
+    return validator.mx_cache, validator.check_cache, validator.catch_all_cache, validator.flights
+
+# The module logger leaves output to the application's handlers.  The
+# stdout handler is only used for the calls made under debug_logging().
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.CRITICAL)
+logger.addHandler(logging.NullHandler())
+ch = logging.StreamHandler(sys.stdout)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+
+_debug_scope = ContextVar('validate_email_debug', default=False)
+
+
+class _ScopedLogger(logging.LoggerAdapter):
+    """What the module logs through.  Inside debug_logging() records below
+    the level of `logger` are still written to the stdout handler, without
+    changing the level of the logger shared by every other caller."""
+
+    def isEnabledFor(self, level):
+        return self.logger.isEnabledFor(level) or _debug_scope.get()
+
+    def debug(self, msg, *args, **kwargs):
+        # Called on every hot path, so bail out before building anything.
+        if _debug_scope.get() or self.logger.isEnabledFor(logging.DEBUG):
+            self.log(logging.DEBUG, msg, *args, **kwargs)
+
+    def log(self, level, msg, *args, **kwargs):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, msg, *args, **kwargs)
+        elif _debug_scope.get():
+            ch.handle(self.logger.makeRecord(self.logger.name, level, __file__, 0, msg, args, None))
+
+
+_log = _ScopedLogger(logger, {})
+
+
+class debug_logging(object):
+    """Context manager writing this module's debug messages to stdout for
+    the calls made inside it only.  Under asyncio the scope is local to the
+    task that entered it."""
+
+    def __init__(self):
+        self._tokens = []
+
+    def __enter__(self):
+        self._tokens.append(_debug_scope.set(True))
+        return self
+
+    def __exit__(self, *exc_info):
+        _debug_scope.reset(self._tokens.pop())
+
+
+class _Pretty(object):
+    """Log argument pretty-printed only when the record is emitted."""
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        import pprint
+        return pprint.pformat(self.obj, indent=4)
+
+
+def is_valid_syntax(email):
+    """Indicate whether the given string matches the RFC 2822 addr-spec.
+    This is the default syntax checker of validate_email()."""
+    if FAST_ADDRESS_RE.fullmatch(email) is not None:
+        return True
+    if SLOW_PATH_RE.search(email) is None:
+        return False
+    return _valid_address_re().match(email) is not None
+
+
+# Registries under which anyone can register a domain.  Listing one as
+# disposable would flag every domain under it, so they are never loaded.
+PUBLIC_SUFFIXES = frozenset([
+    'com.ar', 'cu.cc', 'edu.my', 'edu.sg', 'id.au', 'msk.ru', 'net.ua', 'nom.za', 'org.ua', 'pp.ua', 'spb.ru',
+    'uk.to', 'us.to', 'uu.gl', 'web.id', 'za.com', 'zp.ua',
+])
+
+
+class DisposableIndex(object):
+    """Set of disposable email domains.  A hostname is disposable when it
+    or any of its parent domains is listed, so x.mailinator.com matches
+    mailinator.com.  Entries naming a public suffix (see PUBLIC_SUFFIXES)
+    are skipped.  An index loaded from a file (one domain per line,
+    optionally gzip compressed) is reloaded when the file changes."""
+
+    def __init__(self, domains=(), path=None, check_interval=5):
+        self.path = path
+        self.check_interval = check_interval
+        # `domains` is only normalized on the first lookup.
+        self._listed = domains
+        self._domains = None
+        self._mtime = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        if path is not None:
+            self.reload()
+
+    @staticmethod
+    def _normalized(domains):
+        domains = frozenset(domain.strip().lower().rstrip('.') for domain in domains)
+        suffixes = domains & PUBLIC_SUFFIXES
+        if suffixes:
+            _log.warning(u"Not listing public suffixes as disposable: %s", u', '.join(sorted(suffixes)))
+        return domains - suffixes
+
+    @classmethod
+    def read(cls, path):
+        """Read the domains listed in a text file, skipping blank lines,
+        '#' comments and public suffixes.  Files ending in .gz are
+        decompressed."""
+        import gzip
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt') as f:
+            return cls._normalized(line for line in f if line.strip() and not line.lstrip().startswith('#'))
+
+    def load(self, path):
+        """Replace the index with the domains listed in `path` and watch it."""
+        self.path = path
+        self.reload()
+
+    def reload(self):
+        mtime = os.stat(self.path).st_mtime
+        domains = self.read(self.path)
+        # Lookups keep using the previous set until the new one is swapped in.
+        self._domains = domains
+        self._mtime = mtime
+        self._checked = time.time()
+        _log.debug(u"Loaded %d disposable domains from %s", len(domains), self.path)
+
+    def _maybe_reload(self):
+        if time.time() - self._checked < self.check_interval:
+            return
+        if not self._lock.acquire(False):  # Another thread is already checking.
+            return
+        try:
+            self._checked = time.time()
+            if os.stat(self.path).st_mtime != self._mtime:
+                self.reload()
+        except (IOError, OSError) as e:
+            _log.warning(u"Keeping disposable domains, reloading %s failed: %s", self.path, e)
+        finally:
+            self._lock.release()
+
+    def _index(self):
+        domains = self._domains
+        if domains is None:
+            domains = self._domains = self._normalized(self._listed)
+            self._listed = ()
+        return domains
+
+    def __contains__(self, hostname):
+        if self.path is not None:
+            self._maybe_reload()
+        domains = self._index()
+        hostname = hostname.lower().rstrip('.')
+        while hostname:
+            if hostname in domains:
+                return True
+            hostname = hostname.partition('.')[2]
+        return False
+
+    def __len__(self):
+        return len(self._index())
+
+
+def is_disposable(email, index=None):
+    """Indicate whether the email is known as being a disposable email or not"""
+    if index is None:
+        index = DISPOSABLE_DOMAINS
+    domain = _domain_of(email)
+    if domain in index:
+        _log.warning("Email %s is flagged as disposable (domain=%s)", email, domain)
+        return True
+    return False
+
+
+def _canonical_domain(hostname):
+    """normalize_domain() without the memo."""
+    hostname = hostname.strip().rstrip('.')
+    if hostname.isascii():
+        lowered = hostname.lower()
+        return hostname if lowered == hostname else lowered  # Don't keep two copies of the name.
+    try:
+        try:
+            import idna
+        except ImportError:
+            return hostname.lower().encode('idna').decode('ascii')
+        return idna.encode(hostname, uts46=True).decode('ascii')
+    except UnicodeError:
+        _log.debug(u"Can't IDNA encode %s", hostname)
+        return hostname.lower()
+
+
+@functools.lru_cache(maxsize=100000)
+def normalize_domain(hostname):
+    """Return hostname the way it is looked up and cached: lower case,
+    without the trailing dot and, for internationalized domains, in its
+    IDNA (punycode) form, so that Gmail.com, gmail.com and gmail.com. share
+    their cache entries.  Uses the idna package (UTS #46) when installed
+    and the IDNA 2003 codec of the standard library otherwise.  Domains
+    that can't be encoded are only lower cased.  Memoized."""
+    return _canonical_domain(hostname)
+
+
+def _domain_of(email):
+    """The normalized domain of an address."""
+    return normalize_domain(email[email.rfind('@') + 1:])
+
+
+class MXOptions(Mapping):
+    """Connection options of an MX server: a read-only mapping with the
+    'domain', 'username', 'password', 'is_ssl' and 'port' keys, plus 'rate'
+    and 'burst' when the known domain database gives them.  Slotted, so
+    that caching millions of them stays cheap."""
+
+    __slots__ = ('domain', 'username', 'password', 'is_ssl', 'port', 'rate', 'burst')
+    _keys = ('domain', 'username', 'password', 'is_ssl', 'port')
+
+    def __init__(self, domain=None, username=None, password=None, is_ssl=0, port=25, rate=None, burst=None):
+        self.domain = domain
+        self.username = username
+        self.password = password
+        self.is_ssl = is_ssl
+        self.port = port
+        self.rate = rate
+        self.burst = burst
+
+    def __getitem__(self, key):
+        if key in self._keys or key in ('rate', 'burst') and getattr(self, key) is not None:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        for key in self._keys:
+            yield key
+        if self.rate is not None or self.burst is not None:
+            yield 'rate'
+            yield 'burst'
+
+    def __len__(self):
+        return len(self._keys) + (2 if self.rate is not None or self.burst is not None else 0)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+# The options of every MX server found in DNS rather than in the known
+# domain database.
+DEFAULT_MX_OPTIONS = MXOptions()
+
+
+class MXHosts(Mapping):
+    """The {server: options} mapping get_mx_ip() returns, in preference
+    order, as a tuple of server names sharing one MXOptions:
+    DEFAULT_MX_OPTIONS for servers found in DNS."""
+
+    __slots__ = ('servers', 'options')
+
+    def __init__(self, servers, options):
+        self.servers = tuple(servers)
+        self.options = options
+
+    @classmethod
+    def compact(cls, mx_hosts):
+        """mx_hosts as an MXHosts when its servers share their options, as
+        the mappings read back from a ResultStore usually do."""
+        if isinstance(mx_hosts, cls) or not mx_hosts:
+            return mx_hosts
+        options = list(mx_hosts.values())
+        if any(option != options[0] for option in options) or set(options[0]) - set(MXOptions.__slots__):
+            return mx_hosts
+        shared = MXOptions(**options[0])
+        if shared == DEFAULT_MX_OPTIONS:
+            shared = DEFAULT_MX_OPTIONS
+        return cls([sys.intern(server) for server in mx_hosts], shared)
+
+    def __getitem__(self, server):
+        if server in self.servers:
+            return self.options
+        raise KeyError(server)
+
+    def __iter__(self):
+        return iter(self.servers)
+
+    def __len__(self):
+        return len(self.servers)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def _known_domain_options(data, decrypt=None):
+    """Turn a connectionView row into the {server: options} mapping."""
+    # Decrypt username and password data if it exists.
+    username = data[2]
+    password = data[3]
+    if data[2] is not None:
+        if decrypt is not None:
+            username = decrypt(data[2])
+            _log.debug(u"Looked up username: %s", username)
+    if data[3] is not None:
+        if decrypt is not None:
+            password = decrypt(data[3])
+    options = MXOptions(data[0], username, password, data[4], data[5])
+    if len(data) > 7:  # Databases with the rate_limits table also give the MXThrottle limits.
+        options.rate, options.burst = data[6], data[7]
+    return MXHosts((data[1],), options)
+
+
+class KnownDomains(object):
+    """In-memory snapshot of the connectionView of a known domain database,
+    with credentials decrypted once.  Lookups only read the snapshot, so it
+    can be shared by any number of threads; the view is read again when
+    PRAGMA data_version shows another connection committed changes.  Pass
+    it to validate_email() and friends as `sql_conn`."""
+
+    def __init__(self, database, decrypt=None, check_interval=1):
+        import sqlite3
+        self.database = database
+        self.decrypt = decrypt
+        self.check_interval = check_interval
+        # Only used under the lock, to poll data_version and reload the view.
+        self._conn = sqlite3.connect(database, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._domains = {}
+        self._version = None
+        self._checked = 0
+        self.refresh()
+
+    def refresh(self):
+        """Reload the view if the database changed; returns whether it did."""
+        with self._lock:
+            self._checked = time.time()
+            version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+            if version == self._version:
+                return False
+            domains = {}
+            for data in self._conn.execute('SELECT * FROM connectionView'):
+                if data[0] not in domains:  # Same row as the per-domain query with fetchone().
+                    domains[data[0]] = _known_domain_options(data, self.decrypt)
+            self._domains = domains
+            self._version = version
+            _log.debug(u"Loaded %d known domains from %s", len(domains), self.database)
+            return True
+
+    def get(self, hostname):
+        if time.time() - self._checked >= self.check_interval:
+            self.refresh()
+        return self._domains.get(hostname)
+
+    def close(self):
+        self._conn.close()
+
+
+def get_known_domain(hostname, sql_conn=None, decrypt=None):
+    # A KnownDomains snapshot already holds decrypted rows.
+    if isinstance(sql_conn, KnownDomains):
+        return sql_conn.get(hostname)
+    # If sql_conn defined first check if this is a known domain we have options for.
+    if sql_conn:
+        c = sql_conn.cursor()
+        _log.debug(u"Selecting from view")
+        c.execute('SELECT * FROM connectionView WHERE domain = ?', [(hostname)])
+        data = c.fetchone()
+        _log.debug(u"SQL DATA: %s", _Pretty(data))
+        if data:
+            return _known_domain_options(data, decrypt)
+    _log.debug(u"RETURNING NONE")
+    return None
+
+
+def _mx_hosts_from_answer(hostname, answer, sql_conn=None, decrypt=None):
+    """Turn an MXAnswer into the {server: options} mapping returned by
+    get_mx_ip().  Returns a (mx_hosts, known) tuple, known being True when
+    one of the MX servers maps to a known domain in the database.  The
+    servers are kept in MX preference order, most preferred first."""
+    # Store the DNS cache entry with same options as sql_conn cached item.
+    servers = []
+    for _, exchange in sorted(answer.records, key=lambda record: record[0]):
+        # Many domains share their MX servers: keep one copy of each name.
+        server = sys.intern(_canonical_domain(exchange))
+        _log.debug(u"  ~~~~ get_mx_ip checking server %s!!!", server)
+        # Check if this domain maps to a known top level domain
+        topleveldomain = '.'.join(server.split('.')[-2:])
+        _log.debug(u"  ~~~~ get_mx_ip topleveldomain %s!!!", topleveldomain)
+        known_domain = get_known_domain(topleveldomain, sql_conn, decrypt)
+        if known_domain:
+            _log.debug(u"  ~~~~ get_mx_ip known_domain %s!!!", known_domain)
+            return known_domain, True
+        if server not in servers:
+            servers.append(server)
+    # TODO: create way to discover if is_ssl (maybe check port(s) 465 and 587)
+    return MXHosts(servers, DEFAULT_MX_OPTIONS), False
+
+
+_DNS = None
+
+
+def _dns():
+    """dnspython's (resolver, exception) modules, imported on the first
+    lookup that misses the caches."""
+    global _DNS
+    if _DNS is None:
+        from dns import resolver, exception
+        _DNS = resolver, exception
+    return _DNS
+
+
+MXAnswer = namedtuple('MXAnswer', 'records ttl')
+MXAnswer.__doc__ = """The MX records of a domain, as (preference, exchange) pairs, and the
+seconds they may be cached for."""
+
+
+class NoSuchDomain(Exception):
+    """The domain doesn't exist (NXDOMAIN) or has no MX records."""
+
+
+class DNSFailure(Exception):
+    """The lookup timed out or the name servers failed (SERVFAIL)."""
+
+
+class Resolver(object):
+    """Where get_mx_ip() gets MX records from.  mx() returns the MXAnswer of
+    a domain, raising NoSuchDomain when it doesn't exist or has no MX
+    records and DNSFailure when the lookup failed; amx() is its asynchronous version, running mx()
+    in the default executor unless overridden."""
+
+    def mx(self, hostname):
+        raise NotImplementedError
+
+    async def amx(self, hostname):
+        import asyncio
+        return await asyncio.get_event_loop().run_in_executor(None, self.mx, hostname)
+
+
+class DNSPythonResolver(Resolver):
+    """Resolver querying DNS with dnspython.  Without arguments it uses the
+    system's settings like dnspython's module functions do.  `nameservers`
+    (addresses, queried on `port`) replaces the servers of
+    /etc/resolv.conf, `timeout` bounds each query to a server and
+    `lifetime` the whole lookup, in seconds.  `edns` is the EDNS version to
+    use (0, or -1 to disable it) with `payload` as the advertised UDP
+    payload size, 1232 bytes unless given; a payload alone turns EDNS 0
+    on.  Truncated UDP answers are retried over TCP; with tcp,
+    every query goes over TCP.  amx() uses dnspython's asyncio resolver
+    when there is one."""
+
+    def __init__(self, nameservers=None, port=None, timeout=None, lifetime=None, edns=None, payload=None,
+                 tcp=False):
+        self.nameservers = nameservers
+        self.port = port
+        self.timeout = timeout
+        self.lifetime = lifetime
+        self.edns = edns
+        self.payload = payload
+        self.tcp = tcp
+        self._resolvers = {}
+        self._lock = threading.Lock()
+
+    def _configured(self):
+        return (self.nameservers, self.port, self.timeout, self.lifetime, self.edns,
+                self.payload) != (None,) * 6 or self.tcp
+
+    def _resolver(self, module):
+        """A resolver object of dnspython's `module` (dns.resolver or
+        dns.asyncresolver) with the settings applied."""
+        with self._lock:
+            resolver = self._resolvers.get(module.__name__)
+            if resolver is None:
+                resolver = module.Resolver(configure=self.nameservers is None)
+                if self.nameservers is not None:
+                    resolver.nameservers = list(self.nameservers)
+                if self.port is not None:
+                    resolver.port = self.port
+                if self.timeout is not None:
+                    resolver.timeout = self.timeout
+                if self.lifetime is not None:
+                    resolver.lifetime = self.lifetime
+                if self.edns is not None or self.payload is not None:
+                    resolver.use_edns(0 if self.edns is None else self.edns, 0, self.payload or 1232)
+                self._resolvers[module.__name__] = resolver
+            return resolver
+
+    @staticmethod
+    def _records(answer):
+        return MXAnswer([(rdata.preference, rdata.exchange.to_text(omit_final_dot=True)) for rdata in answer],
+                        answer.rrset.ttl)
+
+    def mx(self, hostname):
+        resolver, exception = _dns()
+        source = self._resolver(resolver) if self._configured() else resolver
+        query = getattr(source, 'resolve', None) or source.query  # dnspython < 2.0 only has query()
+        try:
+            answer = query(hostname, 'MX', tcp=self.tcp)
+        except (resolver.NXDOMAIN, resolver.NoAnswer) as e:
+            raise NoSuchDomain(str(e))
+        except exception.DNSException as e:  # Timeout, SERVFAIL and the like
+            raise DNSFailure(str(e))
+        return self._records(answer)
+
+    async def amx(self, hostname):
+        resolver, exception = _dns()
+        try:
+            from dns import asyncresolver
+        except ImportError:  # dnspython < 2.0
+            return await Resolver.amx(self, hostname)
+        source = self._resolver(asyncresolver) if self._configured() else asyncresolver
+        try:
+            answer = await source.resolve(hostname, 'MX', tcp=self.tcp)
+        except (resolver.NXDOMAIN, resolver.NoAnswer) as e:
+            raise NoSuchDomain(str(e))
+        except exception.DNSException as e:
+            raise DNSFailure(str(e))
+        return self._records(answer)
+
+
+class StaticResolver(Resolver):
+    """Resolver answering from a fixed table of MX records, for offline runs
+    and load tests: `records` maps domains to lists of (preference,
+    exchange) pairs, and `path` names a zone file whose MX records are
+    added to them, replacing those of the domains it lists.  Only the MX
+    records of the file are read, written as `owner [ttl] [IN] MX
+    preference exchange`, with names taken as absolute and ';' starting a
+    comment; a $TTL line sets the TTL of the records without one.  Domains
+    not listed don't exist."""
+
+    def __init__(self, records=None, path=None, ttl=3600):
+        self.ttl = ttl
+        self.records = {}
+        for domain, mx in (records or {}).items():
+            self.records[normalize_domain(domain)] = MXAnswer(list(mx), ttl)
+        if path is not None:
+            self.records.update(self.read(path, ttl))
+
+    @staticmethod
+    def read(path, ttl=3600):
+        """The {domain: MXAnswer} table of the MX records in a zone file."""
+        records = {}
+        with open(path) as f:
+            for line in f:
+                fields = line.partition(';')[0].split()
+                if len(fields) == 2 and fields[0].upper() == '$TTL':
+                    ttl = int(fields[1])
+                    continue
+                upper = [field.upper() for field in fields]
+                if 'MX' not in upper[1:] or len(fields) != upper.index('MX') + 3:
+                    continue
+                mx = upper.index('MX')
+                ttls = [int(field) for field in fields[1:mx] if field.isdigit()]
+                domain = normalize_domain(fields[0])
+                answer = records.get(domain, MXAnswer([], ttls[0] if ttls else ttl))
+                # Like DNS, the answer lives as long as its shortest lived record.
+                records[domain] = MXAnswer(answer.records + [(int(fields[mx + 1]), normalize_domain(fields[mx + 2]))],
+                                           min([answer.ttl] + ttls))
+        return records
+
+    def mx(self, hostname):
+        answer = self.records.get(normalize_domain(hostname))
+        if answer is None:
+            raise NoSuchDomain(hostname)
+        return answer
+
+    async def amx(self, hostname):
+        return self.mx(hostname)
+
+
+# Used by get_mx_ip() outside of a Validator, and by Validators without one
+# of their own.
+RESOLVER = DNSPythonResolver()
+
+
+def _resolver():
+    """The Resolver of the current call (see _caches())."""
+    validator = _validator.get()
+    if validator is None or validator.resolver is None:
+        return RESOLVER
+    return validator.resolver
+
+
+def _cache_dns_error(hostname, e, result_store=None):
+    """Cache and return the get_mx_ip() answer for a failed MX lookup:
+    None when the domain doesn't exist and False when the lookup timed out
+    or the servers failed."""
+    value = None if isinstance(e, NoSuchDomain) else False
+    ttl = _caches()[0].set(hostname, value)
+    if result_store is not None:
+        result_store.set('mx', hostname, value, ttl)
+    return value
+
+
+def _stored_mx_ip(hostname, result_store):
+    """Look up hostname in the result store, copying a hit into the MX cache."""
+    if result_store is None:
+        return _MISSING
+    found = result_store.lookup('mx', hostname)
+    if found is None:
+        return _MISSING
+    mx_hosts = MXHosts.compact(found[0])
+    _caches()[0].set(hostname, mx_hosts, found[1])
+    return mx_hosts
+
+
+def _cache_mx_hosts(hostname, mx_hosts, ttl, result_store=None):
+    ttl = _caches()[0].set(hostname, mx_hosts, ttl)
+    if result_store is not None:
+        result_store.set('mx', hostname, mx_hosts, ttl)
+
+
+def _catch_all_status(hostname, result_store=None):
+    """Cached catch-all status of hostname (see CATCH_ALL_CACHE), or _MISSING
+    when the domain hasn't been probed."""
+    catch_all_cache = _caches()[2]
+    status = catch_all_cache.get(hostname, _MISSING)
+    if status is _MISSING and result_store is not None:
+        found = result_store.lookup('catch_all', hostname)
+        if found is not None:
+            status = found[0]
+            catch_all_cache.set(hostname, status, found[1])
+    return status
+
+
+def _catch_all_probe(hostname):
+    """A random, almost certainly nonexistent address of hostname."""
+    import uuid
+    return 'validate-email-%s@%s' % (uuid.uuid4().hex, hostname)
+
+
+def _set_catch_all(hostname, accepted, result_store=None):
+    """Cache the catch-all status of hostname given the check() of a RCPT TO
+    for an address that doesn't exist there, and return it."""
+    status = ACCEPT_ALL if accepted else (None if accepted is None else True)
+    _log.debug(u"    ~~~ Catch-all status of %s: %s", hostname, status)
+    ttl = _caches()[2].set(hostname, status, result_store.ttls['catch_all'] if result_store is not None else None)
+    if result_store is not None:
+        result_store.set('catch_all', hostname, status, ttl)
+    return status
+
+
+def _timing(details, stage, started):
+    """Add the time since `started` to the `stage` timing of details and
+    return the current time."""
+    now = time.monotonic()
+    timings = details.setdefault('timings', {})
+    timings[stage] = timings.get(stage, 0.0) + now - started
+    return now
+
+
+def _resolve_mx(hostname, sql_conn=None, decrypt=None, result_store=None):
+    """Query the MX records of hostname and cache the answer.  Called for
+    cache misses, once for the concurrent misses of a domain."""
+    mx_hosts = _caches()[0].get(hostname, _MISSING)
+    if mx_hosts is not _MISSING:  # Cached by a lookup that just finished.
+        return mx_hosts
+    try:
+        _log.debug(u"  ~~~~ get_mx_ip hostname not in MX_DNS_CACHE!!!")
+        answer = _resolver().mx(hostname)
+    except (NoSuchDomain, DNSFailure) as e:
+        return _cache_dns_error(hostname, e, result_store)
+    mx_hosts, known = _mx_hosts_from_answer(hostname, answer, sql_conn, decrypt)
+    # The options of known domains may hold credentials, keep them off disk.
+    _cache_mx_hosts(hostname, mx_hosts, answer.ttl, None if known else result_store)
+    return mx_hosts
+
+
+def get_mx_ip(hostname, sql_conn=None, decrypt=None, result_store=None, details=None):
+    """Return the {server: options} mapping of hostname's MX servers, None
+    when the domain doesn't exist and False when the lookup failed.
+    Domains missing from the caches are looked up with RESOLVER (or the
+    Validator's resolver), concurrent lookups of a domain sharing one
+    query.  When a details dict is given, the time spent on the known
+    domain lookup and on DNS goes to its 'sql' and 'dns' timings, and
+    details['mx_cached'] tells whether the answer came from a cache."""
+    hostname = normalize_domain(hostname)
+    _log.debug(u"Looking for MX Records for %s", hostname)
+    started = time.monotonic() if details is not None else 0
+    known_domain = get_known_domain(hostname, sql_conn, decrypt)
+    if details is not None:
+        started = _timing(details, 'sql', started)
+    if known_domain:
+        _log.debug(u"Results of first lookup: %s", _Pretty(known_domain))
+        return known_domain
+
+    # Perform DNS lookup with dnspython if this isn't already in cache.
+    mx_cache, _, _, flights = _caches()
+    mx_hosts = mx_cache.get(hostname, _MISSING)
+    if mx_hosts is _MISSING:
+        mx_hosts = _stored_mx_ip(hostname, result_store)
+    if details is not None:
+        details['mx_cached'] = mx_hosts is not _MISSING
+    if mx_hosts is _MISSING:
+        mx_hosts = flights.do(('mx', hostname), _resolve_mx, hostname, sql_conn, decrypt, result_store)
+    if details is not None:
+        _timing(details, 'dns', started)
+
+    _log.debug(u"  ~~~~ LOOKED UP %s!!!", mx_hosts)
+    return mx_hosts
+
+
+def check_command(result_tuple, server_name='server', ok_codes=[250], fail_codes=[550]):
+    status, mes = result_tuple
+    if status in fail_codes:
+        _log.debug(u'%s in fail codes, answer: %s - %s', server_name, status, mes)
+        return False
+    if status in ok_codes:
+        _log.debug(u'%s in success codes, answer: %s - %s', server_name, status, mes)
+        return True
+    return None
+
+
+def check_command_for_server(server_name):
+    def wrapper(*args, **kwargs):
+        kwargs['server_name'] = server_name
+        return check_command(*args, **kwargs)
+    return wrapper
+
+
+SMTPTimeouts = namedtuple('SMTPTimeouts', 'connect banner command')
+SMTPTimeouts.__doc__ = """Separate budgets, in seconds, for opening the TCP connection, for
+the server's greeting (and TLS handshake), and for each later command.
+Accepted wherever an smtp_timeout is; a plain number is used for all three."""
+
+# Delay before racing the next MX server or address while the previous
+# attempt is still pending (RFC 8305 recommends 250ms).
+HAPPY_EYEBALLS_DELAY = 0.25
+
+
+def _smtp_timeouts(smtp_timeout):
+    if isinstance(smtp_timeout, SMTPTimeouts):
+        return smtp_timeout
+    return SMTPTimeouts(smtp_timeout, smtp_timeout, smtp_timeout)
+
+
+def _race(attempts, discard=None, delay=None):
+    """Run the callables in `attempts` happy-eyeballs style: each one is
+    started when the previous one failed or after `delay` seconds, and the
+    first one to return wins.  Every attempt is passed a threading.Event
+    set once there is a winner, so slower ones can give up; results they
+    still produce are passed to `discard`.  Raises the last error when all
+    attempts fail."""
+    import queue
+    if delay is None:
+        delay = HAPPY_EYEBALLS_DELAY
+    cancelled = threading.Event()
+    if len(attempts) == 1:
+        return attempts[0](cancelled)
+
+    done = queue.Queue()
+    lock = threading.Lock()
+
+    def run(attempt):
+        try:
+            result = attempt(cancelled)
+        except Exception as e:
+            done.put((False, e))
+            return
+        with lock:
+            won = not cancelled.is_set()
+            cancelled.set()
+        if won:
+            done.put((True, result))
+        elif discard is not None:
+            discard(result)
+
+    def start():
+        thread = threading.Thread(target=run, args=(pending.pop(0),))
+        thread.daemon = True
+        thread.start()
+
+    pending = list(attempts)
+    start()
+    running = 1
+    while True:
+        try:
+            won, value = done.get(timeout=delay if pending else None)
+        except queue.Empty:  # Still waiting: start the next attempt alongside.
+            start()
+            running += 1
+            continue
+        if won:
+            return value
+        running -= 1
+        if pending:
+            start()
+            running += 1
+        elif not running:
+            raise value
+
+
+def _connect_socket(host, port, timeout):
+    """Open a TCP connection to host, racing its addresses and alternating
+    between IPv6 and IPv4 as in RFC 8305."""
+    families = OrderedDict()
+    for info in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+        families.setdefault(info[0], []).append(info)
+    infos = [info for group in itertools.zip_longest(*families.values()) for info in group if info]
+
+    def attempt(info):
+        def connect(cancelled):
+            family, socktype, proto, _, address = info
+            sock = socket.socket(family, socktype, proto)
+            try:
+                sock.settimeout(timeout)
+                sock.connect(address)
+            except Exception:
+                sock.close()
+                raise
+            return sock
+        return connect
+
+    return _race([attempt(info) for info in infos], discard=lambda sock: sock.close())
+
+
+_SMTP_CLASSES = None
+
+
+def _smtp_classes():
+    """The smtplib.SMTP and SMTP_SSL subclasses used by smtp_connect(),
+    defined on first use since they need smtplib."""
+    global _SMTP_CLASSES
+    if _SMTP_CLASSES is not None:
+        return _SMTP_CLASSES
+    import smtplib
+
+    class _PreconnectedSMTP(smtplib.SMTP):
+        """smtplib.SMTP running over a socket opened by _connect_socket().
+        `timings` holds the seconds spent opening the session, per stage."""
+
+        def __init__(self, sock, **kwargs):
+            self._preconnected = sock
+            self.timings = {}
+            smtplib.SMTP.__init__(self, **kwargs)
+
+        def _get_socket(self, host, port, timeout):
+            sock, self._preconnected = self._preconnected, None
+            return sock
+
+    class _PreconnectedSMTP_SSL(smtplib.SMTP_SSL, _PreconnectedSMTP):
+        """SMTP_SSL wraps the socket handed over by _PreconnectedSMTP."""
+
+        def __init__(self, sock, **kwargs):
+            self._preconnected = sock
+            self.timings = {}
+            smtplib.SMTP_SSL.__init__(self, **kwargs)
+
+        def _get_socket(self, host, port, timeout):
+            started = time.monotonic()
+            sock = smtplib.SMTP_SSL._get_socket(self, host, port, timeout)
+            self.timings['tls'] = time.monotonic() - started
+            return sock
+
+    _SMTP_CLASSES = _PreconnectedSMTP, _PreconnectedSMTP_SSL
+    return _SMTP_CLASSES
+
+
+def smtp_connect(mx, options, smtp_timeout=5, cancelled=None):
+    """Open an SMTP session to the given MX server using the connection
+    options from get_mx_ip(), logging in when credentials are known.
+    smtp_timeout is a number of seconds or an SMTPTimeouts.  Gives up
+    with socket.error when the `cancelled` event gets set."""
+    timeouts = _smtp_timeouts(smtp_timeout)
+    preconnected, preconnected_ssl = _smtp_classes()
+    if options['is_ssl'] > 0:
+        _log.debug(u"    ~~~ Connecting to: %s:%s over SSL socket", mx, options['port'])
+        smtp_class = preconnected_ssl
+    else:
+        _log.debug(u"    ~~~ Connecting to: %s:%s over standard socket", mx, options['port'])
+        smtp_class = preconnected
+
+    started = time.monotonic()
+    sock = _connect_socket(mx, options['port'], timeouts.connect)
+    smtp = smtp_class(sock, timeout=timeouts.command)
+    try:
+        if cancelled is not None and cancelled.is_set():
+            raise socket.error('Connection to %s cancelled' % (mx,))
+        now = time.monotonic()
+        smtp.timings['connect'] = now - started
+        sock.settimeout(timeouts.banner)
+        smtp.connect(host=mx, port=options['port'])
+        smtp.sock.settimeout(timeouts.command)
+        started, now = now, time.monotonic()
+        smtp.timings['banner'] = now - started - smtp.timings.get('tls', 0.0)
+
+        if options['username'] and options['password']:  # Login is required.
+            if cancelled is not None and cancelled.is_set():
+                raise socket.error('Connection to %s cancelled' % (mx,))
+            _log.debug(u"    ~~~ Logging Into: %s with user %s", mx, options['username'])
+            smtp.login(options['username'], options['password'])
+            smtp.timings['login'] = time.monotonic() - now
+    except Exception:
+        smtp.close()
+        sock.close()
+        raise
+    return smtp
+
+
+def smtp_quit(smtp):
+    """Close an SMTP session, ignoring servers that already hung up."""
+    import smtplib
+    if smtp is None:
+        return
+    try:
+        smtp.quit()
+    except (smtplib.SMTPServerDisconnected, socket.error):
+        smtp.close()
+
+
+def smtp_greet(smtp):
+    """Greet the server with EHLO, so that its extensions are known, and
+    with HELO when it doesn't speak ESMTP.  Returns the reply."""
+    reply = smtp.ehlo()
+    if reply[0] != 250:
+        reply = smtp.helo()
+    return reply
+
+
+def smtp_envelope(smtp, sender, recipients):
+    """Yield the replies to MAIL FROM for sender and to RCPT TO for each of
+    the recipients, in that order.  When the server offers PIPELINING (RFC
+    2920) all the commands go out in a single write before the first reply
+    is read, so the envelope costs one round trip; other servers get them
+    in lock-step, the RCPT TOs only once MAIL FROM was accepted.  Replies
+    still unread when the generator is closed are read then, keeping the
+    session in step."""
+    import smtplib
+    if not smtp.has_extn('pipelining'):
+        reply = smtp.mail(sender)
+        yield reply
+        if reply[0] == 250:
+            for recipient in recipients:
+                yield smtp.rcpt(recipient)
+        return
+
+    commands = ['mail FROM:%s' % smtplib.quoteaddr(sender)]
+    commands += ['rcpt TO:%s' % smtplib.quoteaddr(recipient) for recipient in recipients]
+    smtp.send(''.join(command + '\r\n' for command in commands))
+    unread = len(commands)
+    try:
+        while unread:
+            unread -= 1
+            yield smtp.getreply()
+    except GeneratorExit:
+        try:
+            for _ in range(unread):
+                smtp.getreply()
+        except (smtplib.SMTPException, socket.error):
+            smtp.close()
+        raise
+
+
+class SMTPPool(object):
+    """Pool of logged-in SMTP sessions, keyed by (server, port, ssl,
+    username), so known providers aren't sent a TLS handshake and AUTH
+    for every address.  At most max_size sessions are open per key; idle
+    sessions are closed after idle_timeout seconds and checked with NOOP
+    before being handed out again, reconnecting when the server hung up."""
+
+    def __init__(self, max_size=4, idle_timeout=60, wait_timeout=30):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self._idle = {}
+        self._open = {}
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def key(mx, options):
+        return (mx, options['port'], options['is_ssl'] > 0, options['username'])
+
+    def acquire(self, mx, options, smtp_timeout=5):
+        """Borrow a session to mx, opening one when none is idle."""
+        import smtplib
+        key = self.key(mx, options)
+        while True:
+            smtp = self._take(key)
+            if smtp is None:
+                break
+            try:
+                if smtp.noop()[0] == 250:
+                    _log.debug(u"    ~~~ Reusing pooled session to %s", mx)
+                    smtp.timings = {}
+                    return smtp
+            except (smtplib.SMTPException, socket.error):
+                pass
+            _log.debug(u"    ~~~ Pooled session to %s went away, reconnecting", mx)
+            self._discard(smtp)
+
+        try:
+            smtp = smtp_connect(mx, options, smtp_timeout)
+        except Exception:
+            with self._cond:
+                self._open[key] -= 1
+                self._cond.notify()
+            raise
+        smtp.pool_key = key
+        return smtp
+
+    def _take(self, key):
+        """Return an idle session for key, or None after reserving a slot
+        for a new one, waiting while the key is at max_size."""
+        import smtplib
+        deadline = time.time() + self.wait_timeout
+        stale = []
+        try:
+            with self._cond:
+                while True:
+                    idle = self._idle.get(key)
+                    while idle:
+                        smtp, released = idle.pop()
+                        if time.time() - released < self.idle_timeout:
+                            return smtp
+                        self._open[key] -= 1
+                        stale.append(smtp)
+                    if self._open.get(key, 0) < self.max_size:
+                        self._open[key] = self._open.get(key, 0) + 1
+                        return None
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise smtplib.SMTPException('Timed out waiting for a pooled session to %s' % (key[0],))
+                    self._cond.wait(remaining)
+        finally:
+            for smtp in stale:
+                smtp_quit(smtp)
+
+    def release(self, smtp):
+        """Return a borrowed session, resetting its mail transaction.
+        Sessions that fail the reset are closed."""
+        import smtplib
+        try:
+            reusable = smtp.rset()[0] == 250
+        except (smtplib.SMTPException, socket.error):
+            reusable = False
+        if not reusable:
+            self._discard(smtp)
+            return
+        with self._cond:
+            self._idle.setdefault(smtp.pool_key, []).append((smtp, time.time()))
+            self._cond.notify()
+
+    def _discard(self, smtp):
+        smtp_quit(smtp)
+        with self._cond:
+            self._open[smtp.pool_key] -= 1
+            self._cond.notify()
+
+    def close(self):
+        """Close every idle session."""
+        with self._cond:
+            for key, idle in self._idle.items():
+                for smtp, released in idle:
+                    self._open[key] -= 1
+                    smtp_quit(smtp)
+            self._idle.clear()
+
+
+SMTP_POOL = SMTPPool()
+
+
+def _temporary(reply):
+    """Whether an SMTP reply is a temporary (4xx) failure."""
+    return 400 <= reply[0] < 500
+
+
+class _MXState(object):
+    __slots__ = ('limit', 'rate', 'burst', 'tokens', 'stamp', 'failures', 'opened', 'trial')
+
+    def __init__(self, rate, burst):
+        self.limit = self.rate = rate
+        self.burst = self.tokens = burst
+        self.stamp = time.monotonic()
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+
+
+# The (throttle, mx) half-open trials started by the current call, which
+# MXThrottle.settle() resolves.
+_trials = ContextVar('validate_email_trials', default=())
+
+
+class MXThrottle(object):
+    """Token-bucket rate limiter and circuit breaker per MX server, used by
+    the calls given one as `throttle`.
+
+    Every RCPT TO sent to a server takes a token from its bucket, which
+    refills at `rate` tokens per second up to `burst`.  The default burst
+    covers a whole validate_emails() batch (50 recipients); keep it at
+    least as large as a custom batch_size.  Known domains can
+    override both with the rate and burst columns of their connectionView
+    row.  Temporary failures (4xx replies, dropped or refused connections)
+    halve the server's rate, which climbs back by a tenth of its limit for
+    every definite answer.  After `failure_threshold` failures in a row the
+    circuit opens: the server is skipped and its addresses come back as
+    None ("unknown, retry later") until `cooldown` seconds have passed and
+    a single trial is let through, closing the circuit again on success.
+    A trial ending without a definite answer, or with an exception, opens
+    the circuit again once settle() is called at the end of the session.
+    The state of at most `max_hosts` servers is kept; the least recently
+    used are forgotten past that."""
+
+    def __init__(self, rate=10.0, burst=50, failure_threshold=5, cooldown=300, min_rate=0.1, max_hosts=100000):
+        self.rate = rate
+        self.burst = burst
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.min_rate = min_rate
+        self.max_hosts = max_hosts
+        self._hosts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _state(self, mx, options=None):
+        state = self._hosts.get(mx)
+        if state is None:
+            options = options or {}
+            state = self._hosts[mx] = _MXState(options.get('rate') or self.rate, options.get('burst') or self.burst)
+            while len(self._hosts) > self.max_hosts:
+                self._hosts.popitem(last=False)
+        else:
+            self._hosts.move_to_end(mx)
+        return state
+
+    def available(self, mx):
+        """Whether mx may be tried: its circuit is closed, or its cool-down
+        is over and no trial is under way."""
+        with self._lock:
+            state = self._hosts.get(mx)
+            return (state is None or state.opened is None
+                    or (not state.trial and time.monotonic() - state.opened >= self.cooldown))
+
+    def reserve(self, mx, options=None, count=1):
+        """Take `count` tokens for mx.  Returns the number of seconds to wait
+        before using them, or None when the circuit of mx is open."""
+        with self._lock:
+            state = self._state(mx, options)
+            now = time.monotonic()
+            if state.opened is not None:
+                if state.trial or now - state.opened < self.cooldown:
+                    return None
+                state.trial = True  # Half open: let this one through.
+                _trials.set(_trials.get() + ((self, mx),))
+            state.tokens = min(state.burst, state.tokens + (now - state.stamp) * state.rate)
+            state.stamp = now
+            state.tokens -= count
+            return max(0.0, -state.tokens / state.rate)
+
+    def acquire(self, mx, options=None, count=1):
+        """Blocking reserve(): returns False when the circuit of mx is open."""
+        delay = self.reserve(mx, options, count)
+        if delay is None:
+            return False
+        if delay:
+            _log.debug(u"    ~~~ Rate limiting %s for %.2fs", mx, delay)
+            time.sleep(delay)
+        return True
+
+    def succeeded(self, mx, options=None):
+        with self._lock:
+            state = self._state(mx, options)
+            state.failures = 0
+            state.opened = None
+            state.trial = False
+            state.rate = min(state.limit, state.rate + state.limit / 10.0)
+
+    def failed(self, mx, options=None):
+        with self._lock:
+            self._failed(mx, self._state(mx, options))
+
+    def _failed(self, mx, state):
+        state.failures += 1
+        state.rate = max(self.min_rate, state.rate / 2.0)
+        if state.trial or state.failures >= self.failure_threshold:
+            _log.debug(u"    ~~~ Opening circuit for %s after %d failures", mx, state.failures)
+            state.opened = time.monotonic()
+            state.trial = False
+
+    def settle(self, mx, options=None):
+        """End a session with mx.  A trial the current call started that
+        got neither succeeded() nor failed() counts as failed."""
+        trials = _trials.get()
+        if (self, mx) not in trials:
+            return
+        _trials.set(tuple(trial for trial in trials if trial != (self, mx)))
+        with self._lock:
+            state = self._state(mx, options)
+            if state.trial:
+                _log.debug(u"    ~~~ Trial of %s got no definite answer", mx)
+                self._failed(mx, state)
+
+    def record(self, mx, reply, options=None):
+        """Count a 4xx reply as a failure of mx; returns the reply."""
+        if _temporary(reply):
+            self.failed(mx, options)
+        return reply
+
+
+class _Unthrottled(MXThrottle):
+    """The throttle of calls made without one: nothing is paced or skipped."""
+
+    def available(self, mx):
+        return True
+
+    def reserve(self, mx, options=None, count=1):
+        return 0.0
 
+    def succeeded(self, mx, options=None):
+        pass
 
-def is_disposable(email):
-    """Indicate whether the email is known as being a disposable email or not"""
-    email_domain = email.rsplit('@', 1)
-    if email_domain in _disposable:
-        logger.warn("Email %s is flagged as disposable (domain=%s)", email, domain)
+    def failed(self, mx, options=None):
+        pass
+
+    def settle(self, mx, options=None):
+        pass
+
+
+_UNTHROTTLED = _Unthrottled()
+
+
+def _open_session(mx, options, smtp_timeout=5, smtp_pool=None):
+    """Connect to mx, borrowing from the pool when the server requires a login."""
+    if options['username'] and options['password']:
+        return (smtp_pool or SMTP_POOL).acquire(mx, options, smtp_timeout)
+    return smtp_connect(mx, options, smtp_timeout)
+
+
+def _raced(mx_hosts, servers):
+    """The servers _race_sessions() tries: only the first when it requires
+    a login."""
+    options = mx_hosts[servers[0]]
+    return servers[:1] if options['username'] and options['password'] else servers
+
+
+def _race_sessions(mx_hosts, servers, smtp_timeout=5, smtp_pool=None):
+    """Open a session to whichever of `servers` (in MX preference order)
+    answers first, returning (mx, smtp).  Servers requiring a login are
+    borrowed from the pool instead of being raced."""
+    options = mx_hosts[servers[0]]
+    if options['username'] and options['password']:
+        return servers[0], _open_session(servers[0], options, smtp_timeout, smtp_pool)
+
+    def attempt(mx):
+        return lambda cancelled: (mx, smtp_connect(mx, mx_hosts[mx], smtp_timeout, cancelled))
+
+    return _race([attempt(mx) for mx in servers], discard=lambda session: smtp_quit(session[1]))
+
+
+def _session_key(mx_hosts):
+    """What a session to the MX servers of a domain depends on: the servers,
+    in preference order, with the port, SSL and login of each.  Domains
+    sharing a server may still connect to it differently."""
+    return tuple((mx, options['port'], options['is_ssl'], options['username']) for mx, options in mx_hosts.items())
+
+
+def _close_session(smtp, smtp_pool=None):
+    if smtp is not None and getattr(smtp, 'pool_key', None) is not None:
+        (smtp_pool or SMTP_POOL).release(smtp)
+    else:
+        smtp_quit(smtp)
+
+
+def _check_mx_hosts(email, hostname, mx_hosts, verify=False, smtp_timeout=5, sending_email=None,
+                    result_store=None, smtp_pool=None, details=None, throttle=None, catch_all=False):
+    """Try the MX servers of hostname, most preferred first, racing the
+    next one when a server is slow to answer.  Without verify, returns True
+    as soon as one of them accepts a connection; with verify, returns the
+    answer of the first server giving a definite answer to RCPT TO, and
+    None when none of them did.  When a details dict is given, the last
+    server tried is recorded as details['mx'], and details['retry'] is set
+    when the None comes from temporary failures or servers skipped by the
+    throttle (an MXThrottle, when one is given), so that a later retry
+    may succeed.  The server's last reply is recorded as details['reply'],
+    the time spent at each stage of the session in details['timings'] and
+    whether the answer came from a cache in details['host_cached'].  With
+    catch_all, a domain not probed yet is asked for a random address after
+    an accepted one, and ACCEPT_ALL is returned when it accepts that too.
+    Concurrent connection checks (without verify) of the same MX servers
+    share one attempt."""
+    if verify:
+        return _probe_mx_hosts(email, hostname, mx_hosts, verify, smtp_timeout, sending_email, result_store,
+                               smtp_pool, details, throttle, catch_all)
+    if _reachable_mx(mx_hosts, result_store, details) is not None:
         return True
-    return False
+    verdict = _caches()[3].do(('check',) + _session_key(mx_hosts), _probe_mx_hosts, email, hostname, mx_hosts, verify,
+                              smtp_timeout, sending_email, result_store, smtp_pool, details, throttle, catch_all)
+    if details is not None and 'mx' not in details:  # Shared the check of another call.
+        _reachable_mx(mx_hosts, result_store, details)
+    return verdict
 
 
-def get_known_domain(hostname, sql_conn=None, decrypt=None):
-    # If sql_conn defined first check if this is a known domain we have options for.
-    if sql_conn:
-        c = sql_conn.cursor()
-        logger.debug(u"Selecting from view")
-        c.execute('SELECT * FROM connectionView WHERE domain = ?', [(hostname)])
-        data = c.fetchone()
-        logger.debug(u"SQL DATA: %s", pprint.pformat(data, indent=4))
-        if data:
-            # Decrypt username and password data if it exists.
-            username = data[2]
-            password = data[3]
-            if data[2] is not None:
-                if decrypt is not None:
-                    username = decrypt(data[2])
-                    logger.debug(u"Looked up username: %s", username)
-            if data[3] is not None:
-                if decrypt is not None:
-                    password = decrypt(data[3])
-            return {data[1]: {"domain": data[0], "username": username, "password": password, "is_ssl": data[4], "port": data[5]},}
-    logger.debug(u"RETURNING NONE")
+def _reachable_mx(mx_hosts, result_store=None, details=None):
+    """The first of the MX servers known to accept connections, or None."""
+    check_cache = _caches()[1]
+    for mx in mx_hosts:
+        if mx in check_cache:
+            _log.debug(u"    ~~~ Returning from cache: %s", mx)
+        elif result_store is not None and result_store.get('host', mx):
+            _log.debug(u"    ~~~ Returning from result store: %s", mx)
+            check_cache[mx] = True
+        else:
+            continue
+        if details is not None:
+            details['mx'] = mx
+            details['host_cached'] = True
+        return mx
     return None
 
 
-def get_mx_ip(hostname, sql_conn=None, decrypt=None):
-    logger.debug(u"Looking for MX Records for %s", hostname)
-    known_domain = get_known_domain(hostname, sql_conn, decrypt)
-    if known_domain:
-        logger.debug(u"Results of first lookup: %s", pprint.pformat(known_doamin, indent=4))
-        return known_domain
-  
-    # Import dnspython 
-    from dns import resolver, exception
-    # Perform DNS lookup with dnspython if this isn't already in cache.
-    if hostname not in MX_DNS_CACHE:
+def _probe_mx_hosts(email, hostname, mx_hosts, verify=False, smtp_timeout=5, sending_email=None,
+                    result_store=None, smtp_pool=None, details=None, throttle=None, catch_all=False):
+    """The network part of _check_mx_hosts()."""
+    throttle = throttle or _UNTHROTTLED
+    check_cache = _caches()[1]
+    servers = list(mx_hosts)
+    retry = False
+    while servers:
+        ready = [mx for mx in servers if throttle.available(mx)]
+        if not ready:
+            _log.debug(u"    ~~~ Circuit open for %s, retry later", u', '.join(servers))
+            retry = True
+            break
+        if details is not None:
+            details['mx'] = ready[0]
         try:
-            logger.debug(u"  ~~~~ get_mx_ip hostname not in MX_DNS_CACHE!!!")
-            # Store the DNS cache entry with same options as sql_conn cached item.
-            cache_item = {}
-            for mx in resolver.query(hostname, 'MX'):
-                server = mx.exchange.to_text(omit_final_dot=True)
-                logger.debug(u"  ~~~~ get_mx_ip checking server %s!!!", server)
-                # Check if this domain maps to a known top level domain
-                topleveldomain = '.'.join(server.split('.')[-2:])
-                logger.debug(u"  ~~~~ get_mx_ip topleveldomain %s!!!", topleveldomain)
-                known_domain = get_known_domain(topleveldomain, sql_conn, decrypt)
-                if known_domain:
-                    logger.debug(u"  ~~~~ get_mx_ip known_domain %s!!!", known_domain)
-                    return known_domain
-                # TODO: create way to discover if is_ssl (maybe check port(s) 465 and 587)
-                cache_item[server] = {"domain": hostname, "username": None, "password": None, "is_ssl": 0, "port": 25}
-            MX_DNS_CACHE[hostname] = cache_item
-        except exception.Timeout as e:
-            return False
-        except exception.DNSException as e:
-            if isinstance(e, resolver.NXDOMAIN):  # or e.rcode == 2:  # SERVFAIL
-                MX_DNS_CACHE[hostname] = None
-            else:
-                raise e
+            mx, smtp = _race_sessions(mx_hosts, ready, smtp_timeout, smtp_pool)
+        except socket.error as e:  # Also covers smtplib's errors and timeouts.
+            # Every server raced failed: go on with the next preferences.
+            tried = _raced(mx_hosts, ready)
+            _log.debug(u'Unable to connect to %s (%s).', u', '.join(tried), e)
+            for mx in tried:
+                throttle.failed(mx, mx_hosts[mx])
+                servers.remove(mx)
+            retry = True
+            continue
+        servers.remove(mx)
+        options = mx_hosts[mx]
+        if details is not None:
+            details['mx'] = mx
+            details.setdefault('timings', {}).update(getattr(smtp, 'timings', ()))
 
-    logger.debug(u"  ~~~~ LOOKED UP %s!!!", MX_DNS_CACHE[hostname])
-    return MX_DNS_CACHE[hostname]
+        def command(stage, send, *args):
+            started = time.monotonic()
+            reply = throttle.record(mx, send(*args), options)
+            if details is not None:
+                _timing(details, stage, started)
+                details['reply'] = reply
+            return reply
 
+        try:
+            check = check_command_for_server(mx)
+            check_cache[mx] = True
+            if result_store is not None:
+                result_store.set('host', mx, True)
 
-def check_command(result_tuple, server_name='server', ok_codes=[250], fail_codes=[550]):
-    status, mes = result_tuple
-    if status in fail_codes:
-        logger.debug(u'%s in fail codes, answer: %s - %s', server_name, status, mes)
-        return False
-    if status in ok_codes:
-        logger.debug(u'%s in success codes, answer: %s - %s', server_name, status, mes)
-        return True
-    return None
+            _log.debug(u"    ~~~ MX_CHECK_CACHE: %s VAL: %s", mx, check_cache[mx])
+            if not verify:
+                return True
 
+            reply = command('helo', smtp_greet, smtp)
+            if not check(reply):
+                retry |= _temporary(reply)
+                continue
 
-def check_command_for_server(server_name):
-    def wrapper(*args, **kwargs):
-        kwargs['server_name'] = server_name
-        return check_command(*args, **kwargs)
-    return wrapper
+            # Properly set the mail from address.
+            if options['username']:
+                sender = options['username']
+            elif sending_email:
+                sender = sending_email
+            else:
+                sender = 'admin@%s' % (hostname)
+
+            if not throttle.acquire(mx, options):
+                retry = True
+                continue
+            replies = smtp_envelope(smtp, sender, [email])
+            reply = command('mail', next, replies)
+            if not check(reply):
+                replies.close()
+                retry |= _temporary(reply)
+                continue
+
+            # Checking RCPT
+            reply = command('rcpt', next, replies)
+            rcpt = check(reply)
+            if rcpt is None:
+                retry |= _temporary(reply)
+                continue
+            throttle.succeeded(mx, options)
+            if catch_all and _catch_all_status(hostname, result_store) is _MISSING:
+                if not rcpt:  # Unknown recipients are rejected.
+                    _set_catch_all(hostname, False, result_store)
+                else:
+                    probe = check(throttle.record(mx, smtp.rcpt(_catch_all_probe(hostname)), options))
+                    return _set_catch_all(hostname, probe, result_store) or True
+            return rcpt  # False implies 550 on rcpt was given.
+        except socket.error as e:  # Dropped or timed out, also covers smtplib's errors.
+            _log.debug(u'%s disconected (%r).', mx, e)
+            throttle.failed(mx, options)
+            retry = True
+        finally:
+            throttle.settle(mx, options)
+            _close_session(smtp, smtp_pool)
+
+    if details is not None:
+        details['retry'] = retry
+    return None  # May want to return false here.
 
 
 def validate_email(email,
@@ -185,6 +1884,11 @@ def validate_email(email,
                    sending_email=None,
                    sql_conn=None,
                    decrypt=None,
+                   syntax_checker=is_valid_syntax,
+                   result_store=None,
+                   smtp_pool=None,
+                   throttle=None,
+                   detect_catch_all=False,
                    ):
     """Indicate whether the given string is a valid email address
     according to the 'addr-spec' portion of RFC 2822 (see section
@@ -192,94 +1896,1191 @@ def validate_email(email,
     included in this test, and certain arcane constructions that
     depend on circular definitions in the spec may not pass, but in
     general this should correctly identify any email address likely
-    to be in use as of 2011."""
+    to be in use as of 2011.
+
+    The syntax stage can be replaced by passing a callable taking the
+    address and returning a boolean as `syntax_checker`.  Passing a
+    ResultStore as `result_store` reuses MX answers, reachable MX servers
+    and verdicts cached by earlier runs, in this or other processes.
+    Sessions to servers requiring a login are borrowed from `smtp_pool`,
+    the module's SMTP_POOL by default.  smtp_timeout is a number of
+    seconds or an SMTPTimeouts splitting it into connect, banner and
+    per-command budgets.  Commands sent to each MX server are paced, and
+    servers that keep failing skipped, by `throttle` when an MXThrottle is
+    given; nothing is paced by default.  An address answered with a
+    temporary failure gives None.  With detect_catch_all, every domain is probed once for a
+    random address and addresses of domains accepting it (catch-all
+    domains) give ACCEPT_ALL, without any SMTP traffic once the domain's
+    status is cached.  With debug, the module's debug messages for this
+    call are written to stdout."""
     if debug:
-        logger.setLevel(logging.DEBUG)
-        ch.setLevel(logging.DEBUG)
+        with debug_logging():
+            return validate_email(email, check_mx=check_mx, verify=verify, smtp_timeout=smtp_timeout,
+                                  allow_disposable=allow_disposable, sending_email=sending_email,
+                                  sql_conn=sql_conn, decrypt=decrypt, syntax_checker=syntax_checker,
+                                  result_store=result_store, smtp_pool=smtp_pool, throttle=throttle,
+                                  detect_catch_all=detect_catch_all)
 
     try:
-        assert re.match(VALID_ADDRESS_REGEXP, email) is not None
+        assert syntax_checker(email)
         check_mx |= verify
         if not allow_disposable and is_disposable(email):
             return False
 
         if check_mx:
-            hostname = email[email.find('@') + 1:]
-            mx_hosts = get_mx_ip(hostname, sql_conn, decrypt)
-            logger.debug(pprint.pformat(mx_hosts, indent=4))
+            hostname = _domain_of(email)
+            if verify and result_store is not None:
+                verdict = result_store.get('verdict', email, _MISSING)
+                if verdict is not _MISSING:
+                    _log.debug(u"    ~~~ Returning from result store: %s", verdict)
+                    return verdict
+            if verify and detect_catch_all and _catch_all_status(hostname, result_store) == ACCEPT_ALL:
+                _log.debug(u"    ~~~ %s is a catch-all domain", hostname)
+                return ACCEPT_ALL
+            mx_hosts = get_mx_ip(hostname, sql_conn, decrypt, result_store)
+            _log.debug(u"%s", _Pretty(mx_hosts))
             if mx_hosts is None:     # Implies DNS couldn't find MX records
                 return False
             elif mx_hosts is False:  # Implies DNS timed out or failed.
                 return None
-            for mx in mx_hosts:
-                try:
-                    check = check_command_for_server(mx)
-                    if not verify and mx in MX_CHECK_CACHE:
-                        logger.debug(u"    ~~~ Returning from cache: %s", MX_CHECK_CACHE[mx])
-                        return MX_CHECK_CACHE[mx]
-                    
-                    if mx_hosts[mx]['is_ssl'] > 0:
-                        smtp = smtplib.SMTP_SSL(timeout=smtp_timeout)
-                        logger.debug(u"    ~~~ Connecting to: %s:%s over SSL socket", mx, mx_hosts[mx]['port'])
-                    else:
-                        smtp = smtplib.SMTP(timeout=smtp_timeout)
-                        logger.debug(u"    ~~~ Connecting to: %s:%s over standard socket", mx, mx_hosts[mx]['port'])
-
-                    smtp.connect(host=mx, port=mx_hosts[mx]['port'])
-
-                    if mx_hosts[mx]['username'] and mx_hosts[mx]['password']:  # Login is required.
-                        logger.debug(u"    ~~~ Logging Into: %s with user %s", mx, mx_hosts[mx]['username'])
-                        smtp.login(mx_hosts[mx]['username'], mx_hosts[mx]['password'])
-
-                    MX_CHECK_CACHE[mx] = True
-
-                    logger.debug(u"    ~~~ MX_CHECK_CACHE: %s VAL: %s", mx, MX_CHECK_CACHE[mx])
-                    if not verify:
-                        return True
-                    
-                    if not check(smtp.helo()):
-                        continue 
-
-                    # Properly set the mail from address.                    
-                    if mx_hosts[mx]['username']:
-                        sending_email = mx_hosts[mx]['username']
-                    elif not sending_email:
-                        sending_email = 'admin@%s' % (hostname)
-
-                    if not check(smtp.mail(sending_email)):
-                        continue
-                    
-                    # Checking RCPT
-                    rcpt = check(smtp.rcpt(email))
-                    if rcpt:
-                        return True
-                    elif rcpt is None:
-                        continue
-                    else:
-                        return False  # Implies 550 on rcpt was given.
-                except smtplib.SMTPServerDisconnected as ssd:  # Server not permits verify user
-                    logger.debug(u'%s disconected.', mx)
-                except smtplib.SMTPConnectError as sce:
-                    logger.debug(u'Unable to connect to %s.', mx)
-                finally:
-                    try:
-                        smtp.quit()
-                    except smtplib.SMTPServerDisconnected:
-                        pass
- 
-            return None  # May want to return false here.
+            details = {}
+            verdict = _check_mx_hosts(email, hostname, mx_hosts, verify, smtp_timeout, sending_email, result_store,
+                                      smtp_pool, details, throttle, detect_catch_all)
+            if verify and result_store is not None and not details.get('retry'):
+                result_store.set('verdict', email, verdict)
+            return verdict
     except AssertionError:
         return False
     except socket.error as e:
-        logger.debug('socket.error exception raised (%s).', e)
+        _log.debug('socket.error exception raised (%s).', e)
         return None
     #except Exception as e:  # Removing catch all so I can catch unknown error in service code.
-    #    logger.debug('Unknown exception raised (%s).', e)
+    #    _log.debug('Unknown exception raised (%s).', e)
     #    return False
 
     return True
 
 
+class ValidationResult(object):
+    """What validate_email_result() found out about an address: the verdict
+    validate_email() would return, a reason code, the last SMTP reply and
+    the MX server it came from, whether the MX answer, the reachable
+    server, the verdict or the catch-all status came from a cache, and the
+    seconds spent at each stage ('syntax', 'disposable', 'sql', 'dns',
+    'connect', 'tls', 'banner', 'login', 'helo', 'mail', 'rcpt' and
+    'total'), measured with the monotonic clock.
+
+    Reason codes are 'syntax', 'disposable', 'syntax_ok', 'no_mx',
+    'dns_failure', 'mx_ok', 'accepted', 'rejected', 'accept_all',
+    'retry_later', 'network_error' and 'unknown'."""
+
+    __slots__ = ('email', 'verdict', 'reason', 'smtp_code', 'smtp_message', 'mx',
+                 'mx_cached', 'host_cached', 'verdict_cached', 'catch_all_cached', 'timings')
+
+    def __init__(self, email):
+        self.email = email
+        self.verdict = None
+        self.reason = 'unknown'
+        self.smtp_code = None
+        self.smtp_message = None
+        self.mx = None
+        self.mx_cached = False
+        self.host_cached = False
+        self.verdict_cached = False
+        self.catch_all_cached = False
+        self.timings = {}
+
+    def __bool__(self):
+        return bool(self.verdict)
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __repr__(self):
+        return '<ValidationResult %s %r (%s)>' % (self.email, self.verdict, self.reason)
+
+
+class ValidationMetrics(object):
+    """Counters and latency histograms fed with the ValidationResults of
+    validate_email_result(..., metrics=...).  Results are counted per
+    reason, per (MX server, reason) and per cache hit, and the timings of
+    every stage go to a histogram per (stage, MX server).  Export them by
+    reading snapshot() periodically, or subclass and extend record() to
+    forward each result to a metrics system.  The per-server counters and
+    histograms of at most `max_hosts` MX servers are kept; those of the
+    least recently seen are dropped past that."""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+    def __init__(self, buckets=None, max_hosts=100000):
+        self.buckets = tuple(buckets or self.BUCKETS)
+        self.max_hosts = max_hosts
+        self.counters = {}
+        self.histograms = {}
+        self._hosts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _track(self, mx, name):
+        """Remember that name belongs to mx, forgetting the metrics of the
+        least recently seen servers past max_hosts.  Called with the lock
+        held."""
+        names = self._hosts.get(mx)
+        if names is None:
+            names = self._hosts[mx] = set()
+            while len(self._hosts) > self.max_hosts:
+                for stale in self._hosts.popitem(last=False)[1]:
+                    self.counters.pop(stale, None)
+                    self.histograms.pop(stale, None)
+        else:
+            self._hosts.move_to_end(mx)
+        names.add(name)
+
+    def increment(self, name, value=1, mx=None):
+        with self._lock:
+            if mx is not None:
+                self._track(mx, name)
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds, mx=None):
+        import bisect
+        with self._lock:
+            if mx is not None:
+                self._track(mx, name)
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            histogram["counts"][min(bisect.bisect_left(self.buckets, seconds), len(self.buckets) - 1)] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def record(self, result):
+        self.increment(('reason', result.reason))
+        if result.mx:
+            self.increment(('mx_reason', result.mx, result.reason), mx=result.mx)
+        for flag in ('mx_cached', 'host_cached', 'verdict_cached', 'catch_all_cached'):
+            if getattr(result, flag):
+                self.increment(('cache_hit', flag))
+        for stage, seconds in result.timings.items():
+            self.observe((stage, result.mx), seconds, mx=result.mx)
+
+    def snapshot(self):
+        with self._lock:
+            return {"buckets": self.buckets, "counters": dict(self.counters),
+                    "histograms": dict((name, {"counts": list(h["counts"]), "sum": h["sum"], "count": h["count"]})
+                                       for name, h in self.histograms.items())}
+
+
+def _reason(verdict, verify, retry=False):
+    """Reason code of a verdict reached by the MX check."""
+    if verdict is None:
+        return 'retry_later' if retry else 'unknown'
+    if not verify:
+        return 'mx_ok'
+    if verdict == ACCEPT_ALL:
+        return 'accept_all'
+    return 'accepted' if verdict else 'rejected'
+
+
+def validate_email_result(email,
+                          check_mx=False,
+                          verify=False,
+                          debug=False,
+                          smtp_timeout=5,
+                          allow_disposable=True,
+                          sending_email=None,
+                          sql_conn=None,
+                          decrypt=None,
+                          syntax_checker=is_valid_syntax,
+                          result_store=None,
+                          smtp_pool=None,
+                          throttle=None,
+                          detect_catch_all=False,
+                          metrics=None,
+                          ):
+    """validate_email() returning a ValidationResult instead of the bare
+    verdict, for finding out where the time goes.  Each result is also
+    passed to the record() method of `metrics`, such as a
+    ValidationMetrics, when one is given."""
+    if debug:
+        with debug_logging():
+            return validate_email_result(email, check_mx=check_mx, verify=verify, smtp_timeout=smtp_timeout,
+                                         allow_disposable=allow_disposable, sending_email=sending_email,
+                                         sql_conn=sql_conn, decrypt=decrypt, syntax_checker=syntax_checker,
+                                         result_store=result_store, smtp_pool=smtp_pool, throttle=throttle,
+                                         detect_catch_all=detect_catch_all, metrics=metrics)
+
+    result = ValidationResult(email)
+    details = {'timings': result.timings}
+    started = now = time.monotonic()
+    check_mx |= verify
+    try:
+        valid = syntax_checker(email)
+    except AssertionError:
+        valid = False
+    now = _timing(details, 'syntax', now)
+    if not valid:
+        result.verdict, result.reason = False, 'syntax'
+    elif not allow_disposable and is_disposable(email):
+        _timing(details, 'disposable', now)
+        result.verdict, result.reason = False, 'disposable'
+    elif not check_mx:
+        result.verdict, result.reason = True, 'syntax_ok'
+    else:
+        hostname = _domain_of(email)
+        try:
+            verdict = _MISSING
+            if verify and result_store is not None:
+                verdict = result_store.get('verdict', email, _MISSING)
+                result.verdict_cached = verdict is not _MISSING
+            if verdict is _MISSING and verify and detect_catch_all:
+                if _catch_all_status(hostname, result_store) == ACCEPT_ALL:
+                    verdict = ACCEPT_ALL
+                    result.catch_all_cached = True
+            if verdict is not _MISSING:
+                result.verdict, result.reason = verdict, _reason(verdict, verify)
+            else:
+                mx_hosts = get_mx_ip(hostname, sql_conn, decrypt, result_store, details)
+                result.mx_cached = details.get('mx_cached', False)
+                if mx_hosts is None:     # Implies DNS couldn't find MX records
+                    result.verdict, result.reason = False, 'no_mx'
+                elif mx_hosts is False:  # Implies DNS timed out or failed.
+                    result.reason = 'dns_failure'
+                else:
+                    verdict = _check_mx_hosts(email, hostname, mx_hosts, verify, smtp_timeout, sending_email,
+                                              result_store, smtp_pool, details, throttle, detect_catch_all)
+                    if verify and result_store is not None and not details.get('retry'):
+                        result_store.set('verdict', email, verdict)
+                    result.verdict, result.reason = verdict, _reason(verdict, verify, details.get('retry'))
+        except socket.error as e:
+            _log.debug('socket.error exception raised (%s).', e)
+            result.verdict, result.reason = None, 'network_error'
+        result.mx = details.get('mx')
+        result.host_cached = details.get('host_cached', False)
+        if details.get('reply'):
+            result.smtp_code, message = details['reply']
+            result.smtp_message = message.decode('utf-8', 'replace') if isinstance(message, bytes) else message
+    result.timings['total'] = time.monotonic() - started
+    if metrics is not None:
+        metrics.record(result)
+    return result
+
+
+def _verify_mx_group(mx_hosts, emails, smtp_timeout=5, sending_email=None, batch_size=50, smtp_pool=None,
+                     throttle=None, deferred=None):
+    """Run RCPT TO for every address in `emails` over one SMTP session per
+    MX server, starting a new MAIL transaction (after RSET) every
+    `batch_size` recipients; a transaction takes a single round trip on
+    servers offering PIPELINING (see smtp_envelope()).  Addresses a server
+    answers with neither an ok nor a fail code are retried on the next MX
+    server, and servers slow to answer are raced against the next one as in
+    _check_mx_hosts().
+    Each batch takes its recipients' worth of tokens from the throttle.
+    Addresses left unresolved by temporary failures are added to the
+    `deferred` set when one is given."""
+    import smtplib
+    throttle = throttle or _UNTHROTTLED
+    results = {}
+    pending = list(emails)
+    servers = list(mx_hosts)
+    temporary = False  # Whether every unresolved address deserves a retry.
+    tempfailed = set()
+    while pending and servers:
+        ready = [mx for mx in servers if throttle.available(mx)]
+        if not ready:
+            _log.debug(u"    ~~~ Circuit open for %s, retry later", u', '.join(servers))
+            temporary = True
+            break
+        try:
+            mx, smtp = _race_sessions(mx_hosts, ready, smtp_timeout, smtp_pool)
+        except socket.error as e:  # Also covers smtplib's errors and timeouts.
+            tried = _raced(mx_hosts, ready)
+            _log.debug(u'Unable to connect to %s (%s).', u', '.join(tried), e)
+            for mx in tried:
+                throttle.failed(mx, mx_hosts[mx])
+                servers.remove(mx)
+            temporary = True
+            continue
+        servers.remove(mx)
+        options = mx_hosts[mx]
+        check = check_command_for_server(mx)
+        try:
+            _caches()[1][mx] = True
+
+            reply = throttle.record(mx, smtp_greet(smtp), options)
+            if not check(reply):
+                temporary |= _temporary(reply)
+                continue
+
+            for start in range(0, len(pending), batch_size):
+                batch = pending[start:start + batch_size]
+                if start:
+                    smtp.rset()
+
+                # Properly set the mail from address.
+                if options['username']:
+                    sender = options['username']
+                elif sending_email:
+                    sender = sending_email
+                else:
+                    sender = 'admin@%s' % _domain_of(batch[0])
+
+                if not throttle.acquire(mx, options, len(batch)):
+                    temporary = True
+                    break
+                replies = smtp_envelope(smtp, sender, batch)
+                reply = throttle.record(mx, next(replies), options)
+                if not check(reply):
+                    replies.close()
+                    temporary |= _temporary(reply)
+                    break
+
+                _log.debug(u"    ~~~ Checking %d recipients on %s", len(batch), mx)
+                for email, reply in zip(batch, replies):
+                    reply = throttle.record(mx, reply, options)
+                    rcpt = check(reply)
+                    if rcpt is not None:
+                        throttle.succeeded(mx, options)
+                        results[email] = rcpt
+                    elif _temporary(reply):
+                        tempfailed.add(email)
+        except smtplib.SMTPServerDisconnected:
+            _log.debug(u'%s disconected.', mx)
+            throttle.failed(mx, options)
+            temporary = True
+        except socket.error as e:
+            _log.debug('socket.error exception raised (%s).', e)
+            throttle.failed(mx, options)
+            temporary = True
+        finally:
+            throttle.settle(mx, options)
+            _close_session(smtp, smtp_pool)
+        pending = [email for email in pending if email not in results]
+
+    for email in pending:
+        results[email] = None
+        if deferred is not None and (temporary or email in tempfailed):
+            deferred.add(email)
+    return results
+
+
+# Reason codes returned by screen_emails().
+SCREEN_OK = 0
+SCREEN_INVALID = 1
+SCREEN_DISPOSABLE = 2
+SCREEN_KNOWN = 3
+
+
+def _screen_domain(domain, allow_disposable, index, sql_conn, decrypt):
+    """Reason code of a normalized domain."""
+    if not allow_disposable and domain in index:
+        return SCREEN_DISPOSABLE
+    if sql_conn is not None and get_known_domain(domain, sql_conn, decrypt):
+        return SCREEN_KNOWN
+    return SCREEN_OK
+
+
+def screen_emails(emails, allow_disposable=True, sql_conn=None, decrypt=None, syntax_checker=is_valid_syntax,
+                  index=None):
+    """Run the offline checks of validate_email() (syntax and, unless
+    allow_disposable, disposable domains) over a whole column of addresses.
+    `emails` is any iterable of strings; NumPy and Arrow arrays are turned
+    into lists first.  Returns an array('B') of reason codes, one per
+    address: SCREEN_INVALID for bad syntax and missing values,
+    SCREEN_DISPOSABLE, SCREEN_KNOWN for domains of the known domain
+    database when `sql_conn` is given, and SCREEN_OK otherwise.  Domains
+    are looked up once, however many addresses share them and however
+    they are spelled (see normalize_domain())."""
+    from array import array
+    to_list = getattr(emails, 'to_pylist', None) or getattr(emails, 'tolist', None)
+    if to_list is not None:
+        emails = to_list()
+    if index is None:
+        index = DISPOSABLE_DOMAINS
+    codes = array('B')
+    append = codes.append
+    spellings = {}
+    domains = {}
+    for email in emails:
+        if not isinstance(email, str) or not syntax_checker(email):
+            append(SCREEN_INVALID)
+            continue
+        spelling = email[email.rfind('@') + 1:]
+        code = spellings.get(spelling)
+        if code is None:
+            domain = normalize_domain(spelling)
+            code = domains.get(domain)
+            if code is None:
+                code = domains[domain] = _screen_domain(domain, allow_disposable, index, sql_conn, decrypt)
+            spellings[spelling] = code
+        append(code)
+    return codes
+
+
+def _resolve_domains(hostnames, sql_conn=None, decrypt=None, result_store=None, concurrency=8):
+    """get_mx_ip() for each of `hostnames`, as a {hostname: mx_hosts} dict.
+    Domains missing from the MX cache are resolved `concurrency` at a time
+    by aget_mx_ip() on an event loop of its own, which keeps the known
+    domain database on the calling thread.  A domain whose lookup raises
+    gives False without affecting the others."""
+    misses = [hostname for hostname in hostnames if hostname not in _caches()[0]]
+    resolved = {}
+    if concurrency > 1 and len(misses) > 1:
+        import asyncio
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:  # Not called from a coroutine, so the loop is ours.
+            async def resolve(hostname, semaphore):
+                async with semaphore:
+                    try:
+                        resolved[hostname] = await aget_mx_ip(hostname, sql_conn, decrypt, result_store)
+                    except Exception as e:
+                        _log.debug(u'Looking up %s failed (%r).', hostname, e)
+                        resolved[hostname] = False
+
+            async def resolve_all():
+                semaphore = asyncio.Semaphore(concurrency)
+                await asyncio.gather(*[resolve(hostname, semaphore) for hostname in misses], return_exceptions=True)
+
+            asyncio.run(resolve_all())
+    for hostname in hostnames:
+        if hostname not in resolved:
+            try:
+                resolved[hostname] = get_mx_ip(hostname, sql_conn, decrypt, result_store)
+            except Exception as e:
+                _log.debug(u'Looking up %s failed (%r).', hostname, e)
+                resolved[hostname] = False
+    return resolved
+
+
+def validate_emails(emails,
+                    check_mx=False,
+                    verify=True,
+                    debug=False,
+                    smtp_timeout=5,
+                    allow_disposable=True,
+                    sending_email=None,
+                    sql_conn=None,
+                    decrypt=None,
+                    batch_size=50,
+                    syntax_checker=is_valid_syntax,
+                    result_store=None,
+                    smtp_pool=None,
+                    throttle=None,
+                    retry_queue=None,
+                    detect_catch_all=False,
+                    concurrency=8,
+                    ):
+    """Validate many addresses at once.  Addresses are grouped by the MX
+    servers get_mx_ip() resolves for their domain so that every group is
+    verified over a single SMTP session, sending many RCPT TO commands per
+    MAIL transaction instead of reconnecting for every address.  The
+    unique domains are resolved up front and up to `concurrency` groups
+    are verified at the same time (see validate_emails_as_completed()).
+
+    Returns a dict mapping each address, in input order, to the value
+    validate_email() would have returned for it (True, False or None).
+    Addresses that got None from temporary failures are parked in
+    `retry_queue`, a RetryQueue, when one is given.  With
+    detect_catch_all, the group of a domain not probed yet also carries a
+    random address of the domain, and accepted addresses of catch-all
+    domains give ACCEPT_ALL."""
+    emails = list(emails)
+    results = dict(validate_emails_as_completed(
+        emails, check_mx=check_mx, verify=verify, debug=debug, smtp_timeout=smtp_timeout,
+        allow_disposable=allow_disposable, sending_email=sending_email, sql_conn=sql_conn, decrypt=decrypt,
+        batch_size=batch_size, syntax_checker=syntax_checker, result_store=result_store, smtp_pool=smtp_pool,
+        throttle=throttle, retry_queue=retry_queue, detect_catch_all=detect_catch_all, concurrency=concurrency))
+    return dict((email, results[email]) for email in emails)
+
+
+def validate_emails_as_completed(emails,
+                                 check_mx=False,
+                                 verify=True,
+                                 debug=False,
+                                 smtp_timeout=5,
+                                 allow_disposable=True,
+                                 sending_email=None,
+                                 sql_conn=None,
+                                 decrypt=None,
+                                 batch_size=50,
+                                 syntax_checker=is_valid_syntax,
+                                 result_store=None,
+                                 smtp_pool=None,
+                                 throttle=None,
+                                 retry_queue=None,
+                                 detect_catch_all=False,
+                                 concurrency=8,
+                                 ):
+    """validate_emails() as a generator of (email, verdict) pairs, yielded
+    as the verdicts become known instead of in input order: first the
+    addresses settled by the offline checks or a stored verdict, then the
+    addresses of each group of MX servers as its SMTP session ends.  Every
+    address is yielded once, however many times it is given.
+
+    Addresses are grouped by normalized domain and the unique domains are
+    resolved before any SMTP work, `concurrency` at a time.  The addresses
+    are then dispatched per group of MX servers, each group over one
+    session, up to `concurrency` sessions at a time.  N addresses of U
+    domains served by H groups of MX servers take about U DNS queries and
+    H SMTP sessions."""
+    if debug:
+        with debug_logging():
+            yield from validate_emails_as_completed(
+                emails, check_mx=check_mx, verify=verify, smtp_timeout=smtp_timeout,
+                allow_disposable=allow_disposable, sending_email=sending_email, sql_conn=sql_conn,
+                decrypt=decrypt, batch_size=batch_size, syntax_checker=syntax_checker,
+                result_store=result_store, smtp_pool=smtp_pool, throttle=throttle, retry_queue=retry_queue,
+                detect_catch_all=detect_catch_all, concurrency=concurrency)
+        return
+
+    check_mx |= verify
+    seen = set()
+    domains = OrderedDict()
+    for email in emails:
+        if email in seen:
+            continue
+        seen.add(email)
+        # Syntax and disposable checks are cheap compared to DNS and SMTP, so run them up front.
+        if not validate_email(email, allow_disposable=allow_disposable, syntax_checker=syntax_checker):
+            yield email, False
+            continue
+        if not check_mx:
+            yield email, True
+            continue
+        if verify and result_store is not None:
+            verdict = result_store.get('verdict', email, _MISSING)
+            if verdict is not _MISSING:
+                yield email, verdict
+                continue
+        hostname = _domain_of(email)
+        if verify and detect_catch_all and _catch_all_status(hostname, result_store) == ACCEPT_ALL:
+            yield email, ACCEPT_ALL
+            continue
+        domains.setdefault(hostname, []).append(email)
+
+    resolved = _resolve_domains(list(domains), sql_conn, decrypt, result_store, concurrency)
+    groups = OrderedDict()
+    for hostname, addresses in domains.items():
+        mx_hosts = resolved[hostname]
+        if mx_hosts is None:     # Implies DNS couldn't find MX records
+            for email in addresses:
+                yield email, False
+        elif mx_hosts is False:  # Implies DNS timed out or failed.
+            for email in addresses:
+                yield email, None
+        elif not verify:
+            for email in addresses:  # Only connection checks left, answered from the cache after the first.
+                try:
+                    verdict = _check_mx_hosts(email, hostname, mx_hosts, False, smtp_timeout, sending_email,
+                                              result_store, smtp_pool, None, throttle)
+                except socket.error as e:
+                    _log.debug('socket.error exception raised (%s).', e)
+                    verdict = None
+                yield email, verdict
+        else:
+            groups.setdefault(_session_key(mx_hosts), (mx_hosts, []))[1].extend(addresses)
+
+    def verify_group(mx_hosts, group):
+        probes = OrderedDict()
+        if detect_catch_all:
+            for email in group:
+                hostname = _domain_of(email)
+                if hostname not in probes and _catch_all_status(hostname, result_store) is _MISSING:
+                    probes[hostname] = _catch_all_probe(hostname)
+        deferred = set()
+        verdicts = _verify_mx_group(mx_hosts, group + list(probes.values()), smtp_timeout, sending_email,
+                                    batch_size, smtp_pool, throttle, deferred)
+        return probes, verdicts, deferred
+
+    def finish(mx_hosts, group, probes, verdicts, deferred):
+        for hostname, probe in probes.items():
+            _set_catch_all(hostname, verdicts.pop(probe), result_store)
+        if detect_catch_all:
+            for email in group:
+                if verdicts[email] and _catch_all_status(_domain_of(email), result_store) == ACCEPT_ALL:
+                    verdicts[email] = ACCEPT_ALL
+        if deferred and retry_queue is not None:
+            retry_queue.defer([email for email in group if email in deferred], next(iter(mx_hosts)))
+        if result_store is not None:
+            for email, verdict in verdicts.items():
+                if email not in deferred:
+                    result_store.set('verdict', email, verdict)
+        return [(email, verdicts[email]) for email in group]
+
+    if concurrency <= 1 or len(groups) <= 1:
+        for mx_hosts, group in groups.values():
+            for pair in finish(mx_hosts, group, *verify_group(mx_hosts, group)):
+                yield pair
+        return
+
+    # Every session runs in the caller's context, so that a Validator's caches are used.
+    import contextvars
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    with ThreadPoolExecutor(min(concurrency, len(groups))) as pool:
+        futures = dict((pool.submit(contextvars.copy_context().run, verify_group, mx_hosts, group),
+                        (mx_hosts, group)) for mx_hosts, group in groups.values())
+        try:
+            for future in as_completed(futures):
+                mx_hosts, group = futures[future]
+                for pair in finish(mx_hosts, group, *future.result()):
+                    yield pair
+        finally:  # Don't start the sessions a caller that stopped listening won't see.
+            for future in futures:
+                future.cancel()
+
+
+def _stream(check, emails, window):
+    """Run check(email) in `window` threads over an iterable of any length,
+    yielding (email, result) pairs as the checks complete.  The next
+    address is only taken from `emails` when a thread is free."""
+    import contextvars
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+    source = iter(emails)
+    in_flight = {}
+    pool = ThreadPoolExecutor(window)
+    try:
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight) < window:
+                email = next(source, _MISSING)
+                if email is _MISSING:
+                    exhausted = True
+                else:
+                    in_flight[pool.submit(contextvars.copy_context().run, check, email)] = email
+            if not in_flight:
+                return
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield in_flight.pop(future), future.result()
+    finally:  # Closed early: let the running checks finish, drop their results.
+        pool.shutdown(wait=True)
+
+
+def validate_stream(emails, window=100, **kwargs):
+    """Validate an iterable of addresses of any length, a stream from a
+    queue say, with validate_email() in `window` threads.  A generator of
+    (email, verdict) pairs in the order the checks complete; addresses are
+    only taken from `emails` while fewer than `window` checks are in
+    flight, so memory use doesn't grow with the input.  Closing the
+    generator waits for the checks in flight.  Keyword arguments are
+    passed through to validate_email(); `sql_conn` is used from the worker
+    threads, so it has to be a KnownDomains snapshot or a connection
+    allowing that (see also Validator.validate_stream())."""
+    return _stream(lambda email: validate_email(email, **kwargs), emails, window)
+
+
+async def aget_mx_ip(hostname, sql_conn=None, decrypt=None, result_store=None):
+    """Asynchronous get_mx_ip(), looking domains up with the resolver's
+    amx()."""
+    hostname = normalize_domain(hostname)
+    known_domain = get_known_domain(hostname, sql_conn, decrypt)
+    if known_domain:
+        return known_domain
+
+    mx_cache, _, _, flights = _caches()
+    mx_hosts = mx_cache.get(hostname, _MISSING)
+    if mx_hosts is _MISSING:
+        mx_hosts = _stored_mx_ip(hostname, result_store)
+    if mx_hosts is _MISSING:
+        mx_hosts = await flights.ado(('mx', hostname), _aresolve_mx, hostname, sql_conn, decrypt, result_store)
+    return mx_hosts
+
+
+async def _aresolve_mx(hostname, sql_conn=None, decrypt=None, result_store=None):
+    """Asynchronous _resolve_mx()."""
+    mx_hosts = _caches()[0].get(hostname, _MISSING)
+    if mx_hosts is not _MISSING:
+        return mx_hosts
+    try:
+        answer = await _resolver().amx(hostname)
+    except (NoSuchDomain, DNSFailure) as e:
+        return _cache_dns_error(hostname, e, result_store)
+    mx_hosts, known = _mx_hosts_from_answer(hostname, answer, sql_conn, decrypt)
+    # The options of known domains may hold credentials, keep them off disk.
+    _cache_mx_hosts(hostname, mx_hosts, answer.ttl, None if known else result_store)
+    return mx_hosts
+
+
+class AsyncSMTPDisconnected(Exception):
+    pass
+
+
+class AsyncSMTP(object):
+    """Just enough of an SMTP client on top of asyncio streams to run the
+    EHLO / MAIL FROM / RCPT TO dialogue used for verification."""
+
+    def __init__(self, timeout=5):
+        self.timeouts = _smtp_timeouts(timeout)
+        self.timeout = self.timeouts.command
+        self.reader = None
+        self.writer = None
+        self.features = {}
+        self.ehlo_resp = None
+
+    async def connect(self, host, port=25, use_ssl=False):
+        import asyncio
+        context = None
+        if use_ssl:
+            import ssl
+            context = ssl.create_default_context()
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=context, happy_eyeballs_delay=HAPPY_EYEBALLS_DELAY),
+            self.timeouts.connect)
+        return await self.getreply(self.timeouts.banner)
+
+    async def getreply(self, timeout=None):
+        import asyncio
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), timeout or self.timeout)
+            if not line:
+                raise AsyncSMTPDisconnected('Connection unexpectedly closed')
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                break
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+        return code, b'\n'.join(lines)
+
+    async def docmd(self, cmd, args=''):
+        line = ('%s %s' % (cmd, args)).strip() + '\r\n'
+        self.writer.write(line.encode('utf-8'))
+        await self.writer.drain()
+        return await self.getreply()
+
+    async def helo(self, name=None):
+        return await self.docmd('helo', name or socket.getfqdn())
+
+    async def ehlo(self, name=None):
+        """EHLO, recording the extensions the server offers in `features`,
+        or HELO when the server doesn't speak ESMTP."""
+        code, resp = await self.docmd('ehlo', name or socket.getfqdn())
+        self.features = {}
+        if code != 250:
+            self.ehlo_resp = None
+            return await self.helo(name)
+        self.ehlo_resp = resp
+        for line in resp.split(b'\n')[1:]:
+            keyword, _, params = line.decode('ascii', 'replace').partition(' ')
+            self.features[keyword.lower()] = params
+        return code, resp
+
+    def has_extn(self, name):
+        return name.lower() in self.features
+
+    async def login(self, username, password):
+        """AUTH PLAIN, sending EHLO first when it wasn't yet, as
+        smtplib.SMTP.login() does.  Raises SMTPNotSupportedError when the
+        server offers no AUTH extension."""
+        import base64
+        import smtplib
+        if self.ehlo_resp is None:
+            code, resp = await self.ehlo()
+            if not 200 <= code <= 299:
+                raise smtplib.SMTPHeloError(code, resp)
+        if not self.has_extn('auth'):
+            raise smtplib.SMTPNotSupportedError('SMTP AUTH extension not supported by server.')
+        token = base64.b64encode(('\0%s\0%s' % (username, password)).encode('utf-8')).decode('ascii')
+        code, resp = await self.docmd('AUTH', 'PLAIN ' + token)
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, resp)
+        return code, resp
+
+    async def mail(self, sender):
+        return await self.docmd('mail', 'FROM:<%s>' % sender)
+
+    async def rcpt(self, recip):
+        return await self.docmd('rcpt', 'TO:<%s>' % recip)
+
+    async def envelope(self, sender, recipients):
+        """The replies to MAIL FROM and to a RCPT TO per recipient, sent
+        in one write when the server offers PIPELINING, as in
+        smtp_envelope()."""
+        if not self.has_extn('pipelining'):
+            reply = await self.mail(sender)
+            if reply[0] != 250:
+                return [reply]
+            return [reply] + [await self.rcpt(recipient) for recipient in recipients]
+        commands = ['mail FROM:<%s>' % sender] + ['rcpt TO:<%s>' % recipient for recipient in recipients]
+        self.writer.write(''.join(command + '\r\n' for command in commands).encode('utf-8'))
+        await self.writer.drain()
+        return [await self.getreply() for command in commands]
+
+    async def quit(self):
+        import asyncio
+        try:
+            if self.writer is not None and not self.writer.is_closing():
+                await self.docmd('quit')
+        except (AsyncSMTPDisconnected, socket.error, asyncio.TimeoutError):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class ConcurrencyLimiter(object):
+    """Bounds the number of validations in flight, both globally and for
+    every MX server, so a single slow server can't take every slot.  The
+    semaphore of an MX server is only kept while checks hold or await it."""
+
+    def __init__(self, concurrency=100, per_host=4):
+        import asyncio
+        self.total = asyncio.Semaphore(concurrency)
+        self.per_host = per_host
+        self.hosts = {}  # {mx: [semaphore, users]}
+
+    @contextlib.asynccontextmanager
+    async def host(self, mx):
+        import asyncio
+        entry = self.hosts.get(mx)
+        if entry is None:
+            entry = self.hosts[mx] = [asyncio.Semaphore(self.per_host), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.hosts[mx]
+
+
+async def _acheck_mx_hosts(email, hostname, mx_hosts, limiter, verify=False, smtp_timeout=5,
+                           sending_email=None, result_store=None, throttle=None, details=None, catch_all=False):
+    """Asynchronous _check_mx_hosts(), holding the per-host slot of the
+    limiter while talking to each MX server and pacing it by the throttle.
+    Sets details['retry'] and probes for catch-all domains as
+    _check_mx_hosts() does."""
+    if verify:
+        return await _aprobe_mx_hosts(email, hostname, mx_hosts, limiter, verify, smtp_timeout, sending_email,
+                                      result_store, throttle, details, catch_all)
+    if _reachable_mx(mx_hosts, result_store, details) is not None:
+        return True
+    return await _caches()[3].ado(('check',) + _session_key(mx_hosts), _aprobe_mx_hosts, email, hostname, mx_hosts,
+                                  limiter, verify, smtp_timeout, sending_email, result_store, throttle, details,
+                                  catch_all)
+
+
+async def _aprobe_mx_hosts(email, hostname, mx_hosts, limiter, verify=False, smtp_timeout=5,
+                           sending_email=None, result_store=None, throttle=None, details=None, catch_all=False):
+    """The network part of _acheck_mx_hosts()."""
+    import asyncio
+    throttle = throttle or _UNTHROTTLED
+    check_cache = _caches()[1]
+    retry = False
+    for mx in mx_hosts:
+        if not throttle.available(mx):
+            _log.debug(u"    ~~~ Circuit open for %s, retry later", mx)
+            retry = True
+            continue
+        check = check_command_for_server(mx)
+        options = mx_hosts[mx]
+        async with limiter.host(mx):
+            smtp = AsyncSMTP(timeout=smtp_timeout)
+            try:
+                reply = throttle.record(mx, await smtp.connect(mx, options['port'], options['is_ssl'] > 0), options)
+                if reply[0] != 220:
+                    _log.debug(u'Unable to connect to %s.', mx)
+                    retry |= _temporary(reply)
+                    continue
+                if options['username'] and options['password']:  # Login is required.
+                    await smtp.login(options['username'], options['password'])
+                check_cache[mx] = True
+                if result_store is not None:
+                    result_store.set('host', mx, True)
+                if not verify:
+                    return True
+
+                reply = throttle.record(mx, await smtp.ehlo(), options)
+                if not check(reply):
+                    retry |= _temporary(reply)
+                    continue
+
+                # Properly set the mail from address.
+                if options['username']:
+                    sender = options['username']
+                elif sending_email:
+                    sender = sending_email
+                else:
+                    sender = 'admin@%s' % (hostname)
+
+                delay = throttle.reserve(mx, options)
+                if delay is None:
+                    retry = True
+                    continue
+                if delay:
+                    await asyncio.sleep(delay)
+                replies = await smtp.envelope(sender, [email])
+                reply = throttle.record(mx, replies[0], options)
+                if not check(reply):
+                    retry |= _temporary(reply)
+                    continue
+
+                reply = throttle.record(mx, replies[1], options)
+                rcpt = check(reply)
+                if rcpt is None:
+                    retry |= _temporary(reply)
+                    continue
+                throttle.succeeded(mx, options)
+                if catch_all and _catch_all_status(hostname, result_store) is _MISSING:
+                    if not rcpt:  # Unknown recipients are rejected.
+                        _set_catch_all(hostname, False, result_store)
+                    else:
+                        probe = check(throttle.record(mx, await smtp.rcpt(_catch_all_probe(hostname)), options))
+                        return _set_catch_all(hostname, probe, result_store) or True
+                return rcpt
+            except (AsyncSMTPDisconnected, socket.error, asyncio.TimeoutError) as e:
+                # Refused, timed out or dropped: try the next server, as the sync path does.
+                _log.debug(u'%s disconected (%r).', mx, e)
+                throttle.failed(mx, options)
+                retry = True
+            finally:
+                throttle.settle(mx, options)
+                await smtp.quit()
+    if details is not None:
+        details['retry'] = retry
+    return None
+
+
+async def avalidate_email(email,
+                          check_mx=False,
+                          verify=False,
+                          debug=False,
+                          smtp_timeout=5,
+                          allow_disposable=True,
+                          sending_email=None,
+                          sql_conn=None,
+                          decrypt=None,
+                          limiter=None,
+                          syntax_checker=is_valid_syntax,
+                          result_store=None,
+                          throttle=None,
+                          retry_queue=None,
+                          detect_catch_all=False,
+                          ):
+    """Asynchronous validate_email() built on asyncio streams.  Returns the
+    same True, False or None verdicts.  Pass a ConcurrencyLimiter shared
+    between calls to bound how many checks run at once, and an MXThrottle
+    to pace them per MX server (nothing is paced without one).  Addresses that
+    got None from temporary failures are parked in `retry_queue`, a
+    RetryQueue, when one is given; detect_catch_all works as in
+    validate_email()."""
+    import asyncio
+    if debug:
+        with debug_logging():
+            return await avalidate_email(email, check_mx=check_mx, verify=verify, smtp_timeout=smtp_timeout,
+                                         allow_disposable=allow_disposable, sending_email=sending_email,
+                                         sql_conn=sql_conn, decrypt=decrypt, limiter=limiter,
+                                         syntax_checker=syntax_checker, result_store=result_store,
+                                         throttle=throttle, retry_queue=retry_queue,
+                                         detect_catch_all=detect_catch_all)
+    if not validate_email(email, allow_disposable=allow_disposable, syntax_checker=syntax_checker):
+        return False
+    check_mx |= verify
+    if not check_mx:
+        return True
+    if limiter is None:
+        limiter = ConcurrencyLimiter()
+
+    async with limiter.total:
+        if verify and result_store is not None:
+            verdict = result_store.get('verdict', email, _MISSING)
+            if verdict is not _MISSING:
+                return verdict
+        hostname = _domain_of(email)
+        if verify and detect_catch_all and _catch_all_status(hostname, result_store) == ACCEPT_ALL:
+            return ACCEPT_ALL
+        try:
+            mx_hosts = await aget_mx_ip(hostname, sql_conn, decrypt, result_store)
+            if mx_hosts is None:     # Implies DNS couldn't find MX records
+                return False
+            elif mx_hosts is False:  # Implies DNS timed out or failed.
+                return None
+            details = {}
+            verdict = await _acheck_mx_hosts(email, hostname, mx_hosts, limiter, verify, smtp_timeout,
+                                             sending_email, result_store, throttle, details, detect_catch_all)
+        except (socket.error, asyncio.TimeoutError) as e:
+            _log.debug('socket.error exception raised (%s).', e)
+            return None
+        if details.get('retry'):
+            if retry_queue is not None:
+                retry_queue.defer([email], next(iter(mx_hosts)))
+        elif verify and result_store is not None:
+            result_store.set('verdict', email, verdict)
+        return verdict
+
+
+async def avalidate_many(emails, concurrency=100, per_host=4, **kwargs):
+    """Validate many addresses concurrently with avalidate_email(), with at
+    most `concurrency` checks in flight and at most `per_host` sessions
+    open to any one MX server.  Keyword arguments are passed through to
+    avalidate_email().  Returns a dict mapping each address, in input
+    order, to its verdict."""
+    import asyncio
+    limiter = ConcurrencyLimiter(concurrency, per_host)
+    order = list(dict.fromkeys(emails))
+    verdicts = await asyncio.gather(*[avalidate_email(email, limiter=limiter, **kwargs) for email in order])
+    return dict(zip(order, verdicts))
+
+
+async def _astream(check, emails, window, per_host):
+    """Asynchronous _stream(): runs up to `window` check(email, limiter)
+    coroutines at once over an iterable or asynchronous iterable, sharing a
+    ConcurrencyLimiter(window, per_host)."""
+    import asyncio
+    limiter = ConcurrencyLimiter(window, per_host)
+    if hasattr(emails, '__aiter__'):
+        source = emails.__aiter__()
+    else:
+        async def iterate():
+            for email in emails:
+                yield email
+        source = iterate()
+
+    async def pull():
+        return await source.__anext__()
+
+    in_flight = {}
+    pulling = None
+    try:
+        exhausted = False
+        while True:
+            if pulling is None and not exhausted and len(in_flight) < window:
+                pulling = asyncio.ensure_future(pull())
+            waiting = set(in_flight)
+            if pulling is not None:
+                waiting.add(pulling)
+            if not waiting:
+                return
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            if pulling in done:
+                try:
+                    email = pulling.result()
+                except StopAsyncIteration:
+                    exhausted = True
+                else:
+                    in_flight[asyncio.ensure_future(check(email, limiter))] = email
+                pulling = None
+            for task in done:
+                if task in in_flight:
+                    yield in_flight.pop(task), task.result()
+    finally:
+        if pulling is not None:
+            pulling.cancel()
+        for task in in_flight:
+            task.cancel()
+        await asyncio.gather(*in_flight, return_exceptions=True)
+
+
+def avalidate_stream(emails, window=100, per_host=4, **kwargs):
+    """Asynchronous validate_stream(): an asynchronous generator of (email,
+    verdict) pairs from avalidate_email() checks, at most `window` of them
+    in flight and at most `per_host` sessions open to any one MX server.
+    `emails` is an iterable or an asynchronous iterable; the next address
+    is only awaited while a slot is free.  Closing the generator cancels
+    the checks in flight.  Keyword arguments are passed through to
+    avalidate_email()."""
+    return _astream(lambda email, limiter: avalidate_email(email, limiter=limiter, **kwargs), emails, window,
+                    per_host)
+
+
+class Validator(object):
+    """Validates addresses with settings and caches of its own, and can be
+    shared between threads.  What it learns about MX records, reachable
+    servers and catch-all domains stays out of the module's caches and
+    those of other validators, and concurrent lookups of a domain or
+    connection checks of the same MX servers run once for all callers (see
+    SingleFlight).
+
+    `database` is the path of a known domain database, opened once per
+    thread, or a KnownDomains snapshot.  MX records are looked up with
+    `resolver`, a Resolver, or the module's RESOLVER.  The other arguments
+    are the defaults of the calls made through the validator; every method
+    takes them again as keyword arguments to override them for one call."""
+
+    def __init__(self, check_mx=False, verify=False, smtp_timeout=5, allow_disposable=True, sending_email=None,
+                 database=None, decrypt=None, syntax_checker=is_valid_syntax, result_store=None, smtp_pool=None,
+                 throttle=None, detect_catch_all=False, debug=False, mx_cache=None, resolver=None):
+        self.settings = {"check_mx": check_mx, "verify": verify, "smtp_timeout": smtp_timeout,
+                         "allow_disposable": allow_disposable, "sending_email": sending_email, "decrypt": decrypt,
+                         "syntax_checker": syntax_checker, "result_store": result_store, "smtp_pool": smtp_pool,
+                         "throttle": throttle, "detect_catch_all": detect_catch_all, "debug": debug}
+        self.database = database
+        self.resolver = resolver
+        self.mx_cache = mx_cache if mx_cache is not None else MXCache()
+        self.check_cache = MXCache(default_ttl=86400)
+        self.catch_all_cache = MXCache(default_ttl=86400)
+        self.flights = SingleFlight()
+        self._db = _SQLiteFile(database, wal=False) if isinstance(database, str) else None
+
+    def connection(self):
+        """The known domain database as seen from the calling thread."""
+        if self._db is not None:
+            return self._db._conn()
+        return self.database
+
+    def _options(self, overrides, *unsupported):
+        options = dict(self.settings, sql_conn=self.connection())
+        for name in unsupported:
+            del options[name]
+        options.update(overrides)
+        return options
+
+    def _run(self, func, *args, **options):
+        token = _validator.set(self)
+        try:
+            return func(*args, **options)
+        finally:
+            _validator.reset(token)
+
+    def validate(self, email, **overrides):
+        """validate_email() with the validator's settings and caches."""
+        return self._run(validate_email, email, **self._options(overrides))
+
+    def validate_result(self, email, **overrides):
+        """validate_email_result() with the validator's settings and caches."""
+        return self._run(validate_email_result, email, **self._options(overrides))
+
+    def validate_many(self, emails, **overrides):
+        """validate_emails() with the validator's settings and caches."""
+        return self._run(validate_emails, emails, **self._options(overrides))
+
+    async def avalidate(self, email, **overrides):
+        """avalidate_email() with the validator's settings and caches."""
+        token = _validator.set(self)
+        try:
+            return await avalidate_email(email, **self._options(overrides, 'smtp_pool'))
+        finally:
+            _validator.reset(token)
+
+    def validate_stream(self, emails, window=100, **overrides):
+        """validate_stream() with the validator's settings and caches, every
+        worker thread using its own database connection."""
+        return _stream(lambda email: self.validate(email, **overrides), emails, window)
+
+    def avalidate_stream(self, emails, window=100, per_host=4, **overrides):
+        """avalidate_stream() with the validator's settings and caches."""
+        return _astream(lambda email, limiter: self.avalidate(email, limiter=limiter, **overrides), emails,
+                        window, per_host)
+
+    def clear(self):
+        """Forget the cached MX records, servers and catch-all domains."""
+        self.mx_cache.clear()
+        self.check_cache.clear()
+        self.catch_all_cache.clear()
+
+    def close(self):
+        """Close the calling thread's database connection."""
+        if self._db is not None:
+            self._db.close()
+
+
 _disposable = ["0-mail.com", "027168.com", "0815.ru", "0815.ry", "0815.su", "0845.ru", "0clickemail.com", "0wnd.net",
                "0wnd.org", "0x207.info", "1-8.biz", "100likers.com", "10mail.com", "10mail.org", "10minut.com.pl",
                "10minutemail.cf", "10minutemail.co.uk", "10minutemail.co.za", "10minutemail.com", "10minutemail.de",
@@ -334,10 +3135,10 @@ _disposable = ["0-mail.com", "027168.com", "0815.ru", "0815.ry", "0815.su", "084
                "civx.org", "ckiso.com", "cl-cl.org", "cl0ne.net", "clandest.in", "clipmail.eu", "clixser.com",
                "clrmail.com", "cmail.com", "cmail.net", "cmail.org", "cnamed.com", "cnew.ir", "cnew.ir", "cnmsg.net",
                "cnsds.de", "cobarekyo1.ml", "codeandscotch.com", "codivide.com", "coieo.com", "coldemail.info",
-               "com.ar", "compareshippingrates.org", "completegolfswing.com", "comwest.de", "consumerriot.com",
+               "compareshippingrates.org", "completegolfswing.com", "comwest.de", "consumerriot.com",
                "coolandwacky.us", "coolimpool.org", "correo.blogos.net", "cosmorph.com", "courrieltemporaire.com",
                "coza.ro", "crankhole.com", "crapmail.org", "crastination.de", "crazespaces.pw", "crazymailing.com",
-               "crossroadsmail.com", "cszbl.com", "ctos.ch", "cu.cc", "cubiclink.com", "curryworld.de", "cust.in",
+               "crossroadsmail.com", "cszbl.com", "ctos.ch", "cubiclink.com", "curryworld.de", "cust.in",
                "cuvox.de", "cylab.org", "d3p.dk", "dab.ro", "dacoolest.com", "daemsteam.com", "daintly.com",
                "dammexe.net", "dandikmail.com", "darkharvestfilms.com", "daryxfox.net", "dash-pads.com", "dataarca.com",
                "datafilehost", "datarca.com", "datazo.ca", "davidkoh.net", "davidlcreative.com", "dayrep.com",
@@ -362,7 +3163,7 @@ _disposable = ["0-mail.com", "027168.com", "0815.ru", "0815.ry", "0815.su", "084
                "dumpandjunk.com", "dumpmail.de", "dumpyemail.com", "durandinterstellar.com", "duskmail.com",
                "dyceroprojects.com", "dz17.net", "e-mail.com", "e-mail.org", "e3z.de", "e4ward.com",
                "easy-trash-mail.com", "easytrashmail.com", "ebeschlussbuch.de", "ecallheandi.com", "edgex.ru",
-               "edinburgh-airporthotels.com", "edu.my", "edu.sg", "edv.to", "ee1.pl", "ee2.pl", "eelmail.com",
+               "edinburgh-airporthotels.com", "edv.to", "ee1.pl", "ee2.pl", "eelmail.com",
                "efxs.ca", "einmalmail.de", "einrot.com", "einrot.de", "eintagsmail.de", "elearningjournal.org",
                "electro.mn", "elitevipatlantamodels.com", "email-fake.cf", "email-fake.ga", "email-fake.gq",
                "email-fake.ml", "email-fake.tk", "email-jetable.fr", "email.cbes.net", "email.net", "email60.com",
@@ -425,7 +3226,7 @@ _disposable = ["0-mail.com", "027168.com", "0815.ru", "0815.ry", "0815.su", "084
                "hopemail.biz", "hot-mail.cf", "hot-mail.ga", "hot-mail.gq", "hot-mail.ml", "hot-mail.tk", "hotmai.com",
                "hotmial.com", "hotpop.com", "hpc.tw", "hs.vc", "ht.cx", "hulapla.de", "humaility.com", "humn.ws.gy",
                "hungpackage.com", "huskion.net", "hvastudiesucces.nl", "hwsye.net", "ibnuh.bz",
-               "icantbelieveineedtoexplainthisshit.com", "icx.in", "icx.ro", "id.au", "ieatspam.eu", "ieatspam.info",
+               "icantbelieveineedtoexplainthisshit.com", "icx.in", "icx.ro", "ieatspam.eu", "ieatspam.info",
                "ieh-mail.de", "ige.es", "ignoremail.com", "ihateyoualot.info", "iheartspam.org", "ikbenspamvrij.nl",
                "illistnoise.com", "ilovespam.com", "imails.info", "imgof.com", "imgv.de", "imstations.com", "inbax.tk",
                "inbound.plus", "inbox.si", "inbox2.info", "inboxalias.com", "inboxclean.com", "inboxclean.org",
@@ -486,7 +3287,7 @@ _disposable = ["0-mail.com", "027168.com", "0815.ru", "0815.ry", "0815.su", "084
                "mjukglass.nu", "mkpfilm.com", "ml8.ca", "mm.my", "mm5.se", "moakt.com", "moakt.ws", "mobileninja.co.uk",
                "moburl.com", "mockmyid.com", "moeri.org", "mohmal.com", "momentics.ru", "moneypipe.net",
                "monumentmail.com", "moonwake.com", "moot.es", "moreawesomethanyou.com", "moreorcs.com", "motique.de",
-               "mountainregionallibrary.net", "moza.pl", "msgos.com", "msk.ru", "mspeciosa.com", "mswork.ru",
+               "mountainregionallibrary.net", "moza.pl", "msgos.com", "mspeciosa.com", "mswork.ru",
                "msxd.com", "mt2009.com", "mt2014.com", "mt2015.com", "mtmdev.com", "muathegame.com", "muchomail.com",
                "mucincanon.com", "mutant.me", "mvrht.com", "mwarner.org", "mxfuel.com", "my10minutemail.com",
                "mybitti.de", "mycleaninbox.net", "mycorneroftheinter.net", "mydemo.equipment", "myecho.es",
@@ -495,12 +3296,12 @@ _disposable = ["0-mail.com", "027168.com", "0815.ru", "0815.ry", "0815.su", "084
                "myspaceinc.net", "myspaceinc.org", "myspacepimpedup.com", "myspamless.com", "mytemp.email",
                "mytempemail.com", "mytempmail.com", "mytrashmail.com", "mywarnernet.net", "myzx.com", "n1nja.org",
                "nabuma.com", "nakedtruth.biz", "nanonym.ch", "nationalgardeningclub.com", "naver.com", "negated.com",
-               "neomailbox.com", "nepwk.com", "nervmich.net", "nervtmich.net", "net.ua", "netmails.com", "netmails.net",
+               "neomailbox.com", "nepwk.com", "nervmich.net", "nervtmich.net", "netmails.com", "netmails.net",
                "netricity.nl", "netris.net", "netviewer-france.com", "netzidiot.de", "nevermail.de",
                "nextstopvalhalla.com", "nfast.net", "nguyenusedcars.com", "nh3.ro", "nice-4u.com", "nicknassar.com",
                "nincsmail.hu", "niwl.net", "nm7.cc", "nmail.cf", "nnh.com", "nnot.net", "no-spam.ws", "no-ux.com",
                "noblepioneer.com", "nobugmail.com", "nobulk.com", "nobuma.com", "noclickemail.com", "nodezine.com",
-               "nogmailspam.info", "nokiamail.com", "nom.za", "nomail.pw", "nomail2me.com", "nomorespamemails.com",
+               "nogmailspam.info", "nokiamail.com", "nomail.pw", "nomail2me.com", "nomorespamemails.com",
                "nonspam.eu", "nonspammer.de", "nonze.ro", "noref.in", "norseforce.com", "nospam.ze.tc", "nospam4.us",
                "nospamfor.us", "nospamthanks.info", "nothingtoseehere.ca", "notmailinator.com", "notrnailinator.com",
                "notsharingmy.info", "now.im", "nowhere.org", "nowmymail.com", "ntlhelp.net", "nubescontrol.com",
@@ -509,7 +3310,7 @@ _disposable = ["0-mail.com", "027168.com", "0815.ru", "0815.ry", "0815.su", "084
                "oerpub.org", "offshore-proxies.net", "ohaaa.de", "ohi.tw", "okclprojects.com", "okrent.us", "okzk.com",
                "olypmall.ru", "omail.pro", "omnievents.org", "one-time.email", "oneoffemail.com", "oneoffmail.com",
                "onet.pl", "onewaymail.com", "onlatedotcom.info", "online.ms", "onlineidea.info", "onqin.com",
-               "ontyne.biz", "oolus.com", "oopi.org", "opayq.com", "opp24.com", "ordinaryamerican.net", "org.ua",
+               "ontyne.biz", "oolus.com", "oopi.org", "opayq.com", "opp24.com", "ordinaryamerican.net",
                "oroki.de", "oshietechan.link", "otherinbox.com", "ourklips.com", "ourpreviewdomain.com",
                "outlawspam.com", "ovpn.to", "owlpic.com", "ownsyou.de", "oxopoha.com", "ozyl.de", "pa9e.com",
                "pagamenti.tk", "pancakemail.com", "paplease.com", "pastebitch.com", "pcusers.otherinbox.com",
@@ -518,7 +3319,7 @@ _disposable = ["0-mail.com", "027168.com", "0815.ru", "0815.ry", "0815.su", "084
                "pisls.com", "pjjkp.com", "plexolan.de", "plhk.ru", "plw.me", "pojok.ml", "pokiemobile.com",
                "politikerclub.de", "pooae.com", "poofy.org", "pookmail.com", "poopiebutt.club", "popesodomy.com",
                "popgx.com", "postacin.com", "postonline.me", "poutineyourface.com", "powered.name", "powlearn.com",
-               "pp.ua", "primabananen.net", "privacy.net", "privatdemail.net", "privy-mail.com", "privy-mail.de",
+               "primabananen.net", "privacy.net", "privatdemail.net", "privy-mail.com", "privy-mail.de",
                "privymail.de", "pro-tag.org", "procrackers.com", "projectcl.com", "propscore.com", "proxymail.eu",
                "proxyparking.com", "prtnx.com", "prtz.eu", "psh.me", "punkass.com", "purcell.email",
                "purelogistics.org", "put2.net", "putthisinyourspamdatabase.com", "pwrby.com", "qasti.com", "qc.to",
@@ -561,7 +3362,7 @@ _disposable = ["0-mail.com", "027168.com", "0815.ru", "0815.ry", "0815.su", "084
                "spamfree24.net", "spamfree24.org", "spamgoes.in", "spamherelots.com", "spamhereplease.com",
                "spamhole.com", "spamify.com", "spaminator.de", "spamkill.info", "spaml.com", "spaml.de", "spamlot.net",
                "spammotel.com", "spamobox.com", "spamoff.de", "spamsalad.in", "spamslicer.com", "spamspot.com",
-               "spamstack.net", "spamthis.co.uk", "spamthisplease.com", "spamtrail.com", "spamtroll.net", "spb.ru",
+               "spamstack.net", "spamthis.co.uk", "spamthisplease.com", "spamtrail.com", "spamtroll.net",
                "speed.1s.fr", "speedgaus.net", "spikio.com", "spoofmail.de", "spr.io", "spritzzone.de", "spybox.de",
                "squizzy.de", "sry.li", "ssoia.com", "stanfordujjain.com", "starlight-breaker.net", "startfu.com",
                "startkeys.com", "statdvr.com", "stathost.net", "statiix.com", "steambot.net", "stexsy.com",
@@ -599,9 +3400,9 @@ _disposable = ["0-mail.com", "027168.com", "0815.ru", "0815.ry", "0815.su", "084
                "trialmail.de", "trickmail.net", "trillianpro.com", "trollproject.com", "tropicalbass.info",
                "trungtamtoeic.com", "tryalert.com", "ttszuo.xyz", "tualias.com", "turoid.com", "turual.com",
                "twinmail.de", "twoweirdtricks.com", "txtadvertise.com", "tyhe.ro", "tyldd.com", "ubismail.net",
-               "ubm.md", "ufacturing.com", "uggsrock.com", "uguuchantele.com", "uhhu.ru", "uk.to", "umail.net",
+               "ubm.md", "ufacturing.com", "uggsrock.com", "uguuchantele.com", "uhhu.ru", "umail.net",
                "undo.it", "unimark.org", "unit7lahaina.com", "unmail.ru", "upliftnow.com", "uplipht.com",
-               "uploadnolimit.com", "urfunktion.se", "uroid.com", "us.af", "us.to", "utiket.us", "uu.gl", "uwork4.us",
+               "uploadnolimit.com", "urfunktion.se", "uroid.com", "us.af", "utiket.us", "uwork4.us",
                "uyhip.com", "vaati.org", "valemail.net", "valhalladev.com", "vankin.de", "vda.ro", "vdig.com",
                "venompen.com", "verdejo.com", "veryday.ch", "veryday.eu", "veryday.info", "veryrealemail.com",
                "vesa.pw", "vfemail.net", "victime.ninja", "victoriantwins.com", "vidchart.com", "viditag.com",
@@ -611,7 +3412,7 @@ _disposable = ["0-mail.com", "027168.com", "0815.ru", "0815.ry", "0815.su", "084
                "voxelcore.com", "vpn.st", "vrmtr.com", "vsimcard.com", "vubby.com", "vztc.com", "w3internet.co.uk",
                "wakingupesther.com", "walala.org", "walkmail.net", "walkmail.ru", "wallm.com", "wasteland.rfc822.org",
                "watch-harry-potter.com", "watchever.biz", "watchfull.net", "watchironman3onlinefreefullmovie.com",
-               "wbml.net", "web-mail.pp.ua", "web.id", "webemail.me", "webm4il.info", "webtrip.ch", "webuser.in",
+               "wbml.net", "web-mail.pp.ua", "webemail.me", "webm4il.info", "webtrip.ch", "webuser.in",
                "wee.my", "wef.gr", "wefjo.grn.cc", "weg-werf-email.de", "wegwerf-email-addressen.de",
                "wegwerf-email-adressen.de", "wegwerf-email.de", "wegwerf-email.net", "wegwerf-emails.de",
                "wegwerfadresse.de", "wegwerfemail.com", "wegwerfemail.de", "wegwerfemail.net", "wegwerfemail.org",
@@ -629,12 +3430,14 @@ _disposable = ["0-mail.com", "027168.com", "0815.ru", "0815.ry", "0815.su", "084
                "ynmrealty.com", "yodx.ro", "yogamaven.com", "yomail.info", "yoo.ro", "yopmail.com", "yopmail.fr",
                "yopmail.gq", "yopmail.net", "you-spam.com", "yougotgoated.com", "youmail.ga", "youmailr.com",
                "youneedmore.info", "yourdomain.com", "yourewronghereswhy.com", "yourlms.biz", "yspend.com",
-               "yugasandrika.com", "yui.it", "yuurok.com", "yxzx.net", "z0d.eu", "z1p.biz", "z86.ru", "za.com",
+               "yugasandrika.com", "yui.it", "yuurok.com", "yxzx.net", "z0d.eu", "z1p.biz", "z86.ru",
                "zasod.com", "zebins.com", "zebins.eu", "zehnminuten.de", "zehnminutenmail.de", "zepp.dk", "zetmail.com",
                "zfymail.com", "zik.dj", "zippymail.info", "zipsendtest.com", "zoaxe.com", "zoemail.com", "zoemail.net",
-               "zoemail.org", "zoetropes.org", "zombie-hive.com", "zomg.info", "zp.ua", "zumpul.com", "zxcv.com",
+               "zoemail.org", "zoetropes.org", "zombie-hive.com", "zomg.info", "zumpul.com", "zxcv.com",
                "zxcvbnm.com", "zzz.com"]
 
+DISPOSABLE_DOMAINS = DisposableIndex(_disposable)
+
 
 def interactive_check():
     import time
@@ -683,5 +3486,236 @@ def interactive_check():
         time.sleep(1)
 
 
+# Batch validation of large lists from the command line.  The parent
+# process streams the input, runs the syntax and disposable checks itself
+# and hands the addresses needing DNS or SMTP to a pool of workers.  Only a
+# bounded window of rows is in flight, so memory stays constant however
+# large the input is, and records are written in input order so a
+# checkpoint can record how far the output is complete.
+
+_BATCH = {}
+
+
+def _batch_init(options):
+    """Pool initializer: open the known domain snapshot and the result store
+    once per worker process."""
+    _BATCH.clear()
+    _BATCH.update(options)
+    if options.get('database'):
+        _BATCH['sql_conn'] = KnownDomains(options['database'])
+    if options.get('cache'):
+        _BATCH['result_store'] = ResultStore(options['cache'])
+
+
+def _batch_local_check(email, allow_disposable=True):
+    """Return the record for an address rejected without the network, or
+    None when it has to go to a worker."""
+    if not is_valid_syntax(email):
+        return {"email": email, "verdict": False, "reason": "syntax", "mx": None}
+    if not allow_disposable and is_disposable(email):
+        return {"email": email, "verdict": False, "reason": "disposable", "mx": None}
+    return None
+
+
+def _batch_network_check(email):
+    """Worker side of the batch: MX lookup and, with verify, RCPT TO."""
+    result = validate_email_result(email, check_mx=True, verify=_BATCH.get('verify', False),
+                                   smtp_timeout=_BATCH.get('smtp_timeout', 5),
+                                   sending_email=_BATCH.get('sending_email'), sql_conn=_BATCH.get('sql_conn'),
+                                   result_store=_BATCH.get('result_store'),
+                                   detect_catch_all=_BATCH.get('detect_catch_all', False))
+    return {"email": email, "verdict": result.verdict, "reason": result.reason, "mx": result.mx}
+
+
+def _batch_read(path, fmt, column='email'):
+    """Yield an (address, None) pair for every row of a csv, jsonl or plain
+    text file, or (line, 'malformed') for a jsonl line that is not valid
+    JSON, or neither a string nor an object with a string `column`."""
+    import csv
+    import io
+    import json
+    with io.open(path, encoding='utf-8', newline='') as f:
+        if fmt == 'csv':
+            for row in csv.DictReader(f):
+                yield (row.get(column) or '').strip(), None
+        elif fmt == 'jsonl':
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    item = None
+                if isinstance(item, dict):
+                    item = item.get(column) or ''
+                yield (item, None) if isinstance(item, str) else (line, 'malformed')
+        else:
+            for line in f:
+                yield line.strip(), None
+
+
+def _batch_format(path, fmt=None):
+    if fmt:
+        return fmt
+    ext = os.path.splitext(path)[1].lower()
+    return {'.csv': 'csv', '.jsonl': 'jsonl', '.json': 'jsonl', '.ndjson': 'jsonl'}.get(ext, 'txt')
+
+
+def _batch_checkpoint(path):
+    import json
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {"rows": 0, "offset": 0}
+
+
+def validate_file(input_path, output_path, check_mx=False, verify=False, allow_disposable=True,
+                  smtp_timeout=5, sending_email=None, database=None, cache=None, processes=None,
+                  input_format=None, column='email', resume=False, window=10000, checkpoint_every=1000,
+                  detect_catch_all=False):
+    """Validate every address of input_path (csv, jsonl or one address per
+    line) and write a record with the verdict, reason code and MX server
+    used for each to output_path (csv or jsonl), in input order.  Malformed
+    jsonl rows get a record with the 'malformed' reason.  With
+    detect_catch_all, addresses of catch-all domains get the ACCEPT_ALL
+    verdict as in validate_email().
+
+    Progress is saved to output_path + '.checkpoint'; with resume, rows
+    already written are skipped and the output is appended to.  Returns the
+    number of rows written by this run."""
+    import csv
+    import io
+    import json
+    import multiprocessing
+
+    check_mx |= verify
+    input_format = _batch_format(input_path, input_format)
+    output_format = _batch_format(output_path)
+    checkpoint_path = output_path + '.checkpoint'
+    state = _batch_checkpoint(checkpoint_path) if resume else {"rows": 0, "offset": 0}
+
+    out = io.open(output_path, 'a+' if resume else 'w', encoding='utf-8', newline='')
+    out.seek(state["offset"])
+    out.truncate()  # Drop records written after the last checkpoint.
+    fields = ["email", "verdict", "reason", "mx"]
+    writer = csv.DictWriter(out, fields) if output_format == 'csv' else None
+    if writer is not None and state["offset"] == 0:
+        writer.writeheader()
+
+    def write(record):
+        if writer is not None:
+            verdict = record["verdict"]
+            writer.writerow(dict(record, verdict='unknown' if verdict is None else str(verdict).lower()))
+        else:
+            out.write(json.dumps(record) + u'\n')
+
+    def save(rows):
+        out.flush()
+        os.fsync(out.fileno())
+        tmp = checkpoint_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({"rows": rows, "offset": out.tell()}, f)
+        os.replace(tmp, checkpoint_path)
+
+    rows = itertools.islice(_batch_read(input_path, input_format, column), state["rows"], None)
+    chunksize = 16
+    options = {"verify": verify, "smtp_timeout": smtp_timeout, "sending_email": sending_email,
+               "database": database, "cache": cache, "detect_catch_all": detect_catch_all}
+    # Rows settled locally never leave this process: their records wait in
+    # their block, next to None placeholders for the addresses sent to the
+    # pool.  A block goes to the pool once it holds `chunksize` addresses to
+    # check, and at most `window` rows are read ahead of the output.
+    pool = None
+    pending = deque()  # (records, AsyncResult or None) per block, in input order.
+    block, emails = [], []
+    ahead = written = 0
+
+    def submit():
+        nonlocal pool, block, emails
+        result = None
+        if emails:
+            if pool is None:
+                pool = multiprocessing.Pool(processes, initializer=_batch_init, initargs=(options,))
+            result = pool.map_async(_batch_network_check, emails)
+        pending.append((block, result))
+        block, emails = [], []
+
+    def drain(limit):
+        nonlocal ahead, written
+        while ahead > limit:
+            if not pending:
+                submit()
+            records, result = pending.popleft()
+            checked = iter(result.get() if result is not None else ())
+            for record in records:
+                write(record if record is not None else next(checked))
+                written += 1
+                if written % checkpoint_every == 0:
+                    save(state["rows"] + written)
+            ahead -= len(records)
+
+    try:
+        for email, error in rows:
+            if error is not None:
+                record = {"email": email, "verdict": None, "reason": error, "mx": None}
+            else:
+                record = _batch_local_check(email, allow_disposable)
+                if record is None and not check_mx:
+                    record = {"email": email, "verdict": True, "reason": "syntax_ok", "mx": None}
+                elif record is None:
+                    emails.append(email)
+            block.append(record)
+            ahead += 1
+            if len(emails) == chunksize or len(block) >= window:
+                submit()
+            drain(window)
+        drain(0)
+        save(state["rows"] + written)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        out.close()
+    return written
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m validate_email',
+                                     description='Validate email addresses. Without a command, '
+                                                 'check addresses interactively.')
+    commands = parser.add_subparsers(dest='command')
+    batch = commands.add_parser('batch', help='validate a csv, jsonl or text file of addresses')
+    batch.add_argument('input', help='csv, jsonl or text file with one address per line')
+    batch.add_argument('output', help='csv or jsonl file to write the results to')
+    batch.add_argument('--format', dest='input_format', choices=['csv', 'jsonl', 'txt'],
+                       help='input format, guessed from the extension by default')
+    batch.add_argument('--column', default='email', help='csv column or json field holding the address')
+    batch.add_argument('--check-mx', action='store_true', help='check the domain has a reachable MX server')
+    batch.add_argument('--verify', action='store_true', help='ask the MX server whether the address exists')
+    batch.add_argument('--reject-disposable', action='store_true', help='reject disposable domains')
+    batch.add_argument('--detect-catch-all', action='store_true',
+                       help='probe domains for catch-all servers and report their addresses as accept-all')
+    batch.add_argument('--smtp-timeout', type=float, default=5)
+    batch.add_argument('--sending-email', help='MAIL FROM address used for verification')
+    batch.add_argument('--database', help='known domain sqlite database')
+    batch.add_argument('--cache', help='sqlite file of the persistent result store')
+    batch.add_argument('--processes', type=int, help='worker processes, one per core by default')
+    batch.add_argument('--resume', action='store_true', help='continue from the last checkpoint')
+    args = parser.parse_args(argv)
+
+    if args.command != 'batch':
+        interactive_check()
+        return 0
+    written = validate_file(args.input, args.output, check_mx=args.check_mx, verify=args.verify,
+                            allow_disposable=not args.reject_disposable, smtp_timeout=args.smtp_timeout,
+                            sending_email=args.sending_email, database=args.database, cache=args.cache,
+                            processes=args.processes, input_format=args.input_format, column=args.column,
+                            resume=args.resume, detect_catch_all=args.detect_catch_all)
+    _log.info(u"Wrote %d results to %s", written, args.output)
+    return 0
+
+
 if __name__ == "__main__":
-    interactive_check()
+    sys.exit(main())